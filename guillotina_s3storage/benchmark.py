@@ -0,0 +1,608 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput and latency benchmarks of the storage manager and blob store::
+
+    python -m guillotina_s3storage.benchmark --output results.json
+    python -m guillotina_s3storage.benchmark --endpoint-url http://localhost:5000
+    python -m guillotina_s3storage.benchmark --baseline results.json
+
+Without `--endpoint-url` S3 is replaced by an in-process fake that adds
+`--latency` seconds to every call and transfers at most `--bandwidth` bytes
+per second per connection, or with `--local-path` by a `LocalBlobStore`.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import math
+import sys
+import time
+import uuid
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import cast
+
+import botocore
+from guillotina import task_vars
+from guillotina.component import provide_utility
+from guillotina.interfaces import IContainer
+
+from guillotina_s3storage.interfaces import IS3BlobStore
+from guillotina_s3storage.local import LocalBlobStore
+from guillotina_s3storage.storage import CHUNK_SIZE
+from guillotina_s3storage.storage import S3BlobStore
+from guillotina_s3storage.storage import S3File
+from guillotina_s3storage.storage import S3FileStorageManager
+
+MB = 1024 * 1024
+
+DEFAULT_FILE_SIZES = [1 * MB, 16 * MB, 64 * MB]
+DEFAULT_PART_SIZES = [5 * MB, 16 * MB]
+DEFAULT_CONCURRENCY = [1, 4]
+DEFAULT_RANGE_SIZES = [8 * MB]
+DEFAULT_LIST_CONCURRENCY = [1, 8]
+
+
+def _client_error(code: str, operation: str) -> botocore.exceptions.ClientError:
+    return botocore.exceptions.ClientError(
+        {"Error": {"Code": code, "Message": code}}, operation
+    )
+
+
+class _Content:
+    def __init__(self, client: "MemoryS3Client", data: bytes):
+        self._client = client
+        self._data = data
+
+    async def read(self) -> bytes:
+        await self._client._transfer(len(self._data))
+        return self._data
+
+    async def iter_chunked(self, size: int):
+        for offset in range(0, len(self._data), size):
+            chunk = self._data[offset : offset + size]
+            await self._client._transfer(len(chunk))
+            yield chunk
+
+    async def iter_chunks(self):
+        async for chunk in self.iter_chunked(CHUNK_SIZE):
+            yield chunk, False
+
+
+class _Body:
+    def __init__(self, client: "MemoryS3Client", data: bytes):
+        self.content = _Content(client, data)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class MemoryS3Client:
+    """
+    In-process stand-in for the subset of the S3 client used by the
+    storage, keeping objects in memory.
+    """
+
+    def __init__(self, latency: float = 0, bandwidth: float = 0):
+        self._latency = latency
+        self._bandwidth = bandwidth
+        self._buckets: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._uploads: Dict[str, Dict[int, bytes]] = {}
+
+    async def _call(self):
+        if self._latency:
+            await asyncio.sleep(self._latency)
+
+    async def _transfer(self, size: int):
+        if self._bandwidth:
+            await asyncio.sleep(size / self._bandwidth)
+        else:
+            await asyncio.sleep(0)
+
+    def _bucket(self, bucket: str, operation: str) -> Dict[str, Dict[str, Any]]:
+        if bucket not in self._buckets:
+            raise _client_error("404", operation)
+        return self._buckets[bucket]
+
+    def _object(self, bucket: str, key: str, operation: str) -> Dict[str, Any]:
+        objects = self._bucket(bucket, operation)
+        if key not in objects:
+            raise _client_error("NoSuchKey", operation)
+        return objects[key]
+
+    def _store(self, bucket: str, key: str, data: bytes) -> str:
+        etag = '"' + hashlib.md5(data).hexdigest() + '"'
+        self._bucket(bucket, "PutObject")[key] = {"data": data, "etag": etag}
+        return etag
+
+    async def head_bucket(self, Bucket: str, **kwargs):
+        await self._call()
+        self._bucket(Bucket, "HeadBucket")
+        return {"ResponseMetadata": {"HTTPStatusCode": 200}}
+
+    async def create_bucket(self, Bucket: str, **kwargs):
+        await self._call()
+        self._buckets.setdefault(Bucket, {})
+        return {}
+
+    async def put_object(self, Bucket: str, Key: str, Body: bytes = b"", **kwargs):
+        await self._call()
+        await self._transfer(len(Body))
+        return {"ETag": self._store(Bucket, Key, bytes(Body))}
+
+    async def get_object(self, Bucket: str, Key: str, Range=None, **kwargs):
+        await self._call()
+        obj = self._object(Bucket, Key, "GetObject")
+        if kwargs.get("IfMatch") not in (None, obj["etag"]):
+            raise _client_error("PreconditionFailed", "GetObject")
+        if kwargs.get("IfNoneMatch") == obj["etag"]:
+            raise _client_error("304", "GetObject")
+        data = obj["data"]
+        if Range:
+            start, _, end = Range.split("bytes=")[-1].partition("-")
+            data = data[int(start) : int(end) + 1 if end else len(data)]
+        return {
+            "Body": _Body(self, data),
+            "ContentLength": len(data),
+            "ETag": obj["etag"],
+        }
+
+    async def head_object(self, Bucket: str, Key: str, **kwargs):
+        await self._call()
+        obj = self._object(Bucket, Key, "HeadObject")
+        return {"ContentLength": len(obj["data"]), "ETag": obj["etag"]}
+
+    async def copy_object(self, Bucket: str, Key: str, CopySource, **kwargs):
+        await self._call()
+        obj = self._object(CopySource["Bucket"], CopySource["Key"], "CopyObject")
+        return {"CopyObjectResult": {"ETag": self._store(Bucket, Key, obj["data"])}}
+
+    async def delete_object(self, Bucket: str, Key: str, **kwargs):
+        await self._call()
+        self._bucket(Bucket, "DeleteObject").pop(Key, None)
+        return {}
+
+    async def delete_objects(self, Bucket: str, Delete, **kwargs):
+        await self._call()
+        objects = self._bucket(Bucket, "DeleteObjects")
+        for item in Delete["Objects"]:
+            objects.pop(item["Key"], None)
+        return {"Deleted": [{"Key": item["Key"]} for item in Delete["Objects"]]}
+
+    async def create_multipart_upload(self, Bucket: str, Key: str, **kwargs):
+        await self._call()
+        self._bucket(Bucket, "CreateMultipartUpload")
+        upload_id = uuid.uuid4().hex
+        self._uploads[upload_id] = {}
+        return {"Bucket": Bucket, "Key": Key, "UploadId": upload_id}
+
+    async def upload_part(
+        self, Bucket: str, Key: str, PartNumber: int, UploadId: str, Body, **kwargs
+    ):
+        await self._call()
+        await self._transfer(len(Body))
+        if UploadId not in self._uploads:
+            raise _client_error("NoSuchUpload", "UploadPart")
+        self._uploads[UploadId][PartNumber] = bytes(Body)
+        return {"ETag": '"' + hashlib.md5(Body).hexdigest() + '"'}
+
+    async def upload_part_copy(
+        self,
+        Bucket: str,
+        Key: str,
+        PartNumber: int,
+        UploadId: str,
+        CopySource,
+        CopySourceRange: str,
+        **kwargs,
+    ):
+        await self._call()
+        obj = self._object(CopySource["Bucket"], CopySource["Key"], "UploadPartCopy")
+        start, _, end = CopySourceRange.split("bytes=")[-1].partition("-")
+        data = obj["data"][int(start) : int(end) + 1]
+        self._uploads[UploadId][PartNumber] = data
+        return {"CopyPartResult": {"ETag": '"' + hashlib.md5(data).hexdigest() + '"'}}
+
+    async def complete_multipart_upload(
+        self, Bucket: str, Key: str, UploadId: str, MultipartUpload, **kwargs
+    ):
+        await self._call()
+        parts = self._uploads.pop(UploadId)
+        data = b"".join(
+            parts[part["PartNumber"]] for part in MultipartUpload.get("Parts", [])
+        )
+        return {"ETag": self._store(Bucket, Key, data)}
+
+    async def abort_multipart_upload(self, Bucket: str, Key: str, UploadId: str):
+        await self._call()
+        self._uploads.pop(UploadId, None)
+        return {}
+
+    async def list_objects_v2(
+        self,
+        Bucket: str,
+        Prefix: str = "",
+        Delimiter: Optional[str] = None,
+        StartAfter: Optional[str] = None,
+        ContinuationToken: Optional[str] = None,
+        MaxKeys: int = 1000,
+        **kwargs,
+    ):
+        await self._call()
+        objects = self._bucket(Bucket, "ListObjectsV2")
+        after = ContinuationToken or StartAfter or ""
+        entries: List[Dict[str, Any]] = []
+        for key in sorted(objects):
+            if not key.startswith(Prefix) or key <= after:
+                continue
+            if Delimiter and Delimiter in key[len(Prefix) :]:
+                prefix = Prefix + key[len(Prefix) :].split(Delimiter)[0] + Delimiter
+                if prefix <= after:
+                    continue
+                if not entries or entries[-1].get("Prefix") != prefix:
+                    entries.append({"Prefix": prefix})
+            else:
+                entries.append(
+                    {
+                        "Key": key,
+                        "Size": len(objects[key]["data"]),
+                        "ETag": objects[key]["etag"],
+                        "LastModified": None,
+                    }
+                )
+            if len(entries) > MaxKeys:
+                break
+        page = entries[:MaxKeys]
+        result: Dict[str, Any] = {
+            "Contents": [entry for entry in page if "Key" in entry],
+            "CommonPrefixes": [entry for entry in page if "Prefix" in entry],
+            "IsTruncated": len(entries) > MaxKeys,
+        }
+        if result["IsTruncated"]:
+            last = page[-1]
+            # skip every key rolled up into a common prefix
+            result["NextContinuationToken"] = last.get("Key") or (
+                last["Prefix"] + "\uffff"
+            )
+        return result
+
+    async def close(self):
+        pass
+
+
+class _Container:
+    def __init__(self, id: str):
+        self.id = id
+
+
+class _Resource:
+    __name__ = "benchmark"
+    __parent__ = None
+    __uuid__ = "benchmark"
+
+
+class _Field:
+    context = None
+
+    def __init__(self, file=None):
+        self.file = file
+
+    def query(self, context, default=None):
+        return self.file or default
+
+
+class _DataManager:
+    def __init__(self, **data):
+        self._data = data
+
+    def get(self, name: str, default: Any = None) -> Any:
+        return self._data.get(name, default)
+
+    async def update(self, **data):
+        self._data.update(data)
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    ordered = sorted(values)
+    index = max(0, math.ceil(len(ordered) * percent / 100) - 1)
+    return ordered[index]
+
+
+def _summary(name: str, params: Dict[str, Any], timings: List[float], size: int = 0):
+    result: Dict[str, Any] = {
+        "benchmark": name,
+        "params": params,
+        "runs": len(timings),
+        "p50_ms": _percentile(timings, 50) * 1000,
+        "p99_ms": _percentile(timings, 99) * 1000,
+    }
+    if size:
+        result["throughput_mb_s"] = size * len(timings) / sum(timings) / MB
+    return result
+
+
+async def _timed(func: Callable[[], Awaitable[Any]], repeat: int) -> List[float]:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+async def _upload(manager: S3FileStorageManager, data: bytes) -> str:
+    dm = _DataManager(size=len(data))
+    await manager.start(dm)
+
+    async def chunks():
+        for offset in range(0, len(data), CHUNK_SIZE):
+            yield data[offset : offset + CHUNK_SIZE]
+
+    await manager.append(dm, chunks(), 0)
+    await manager.finish(dm)
+    return dm.get("uri")
+
+
+async def bench_upload(store: S3BlobStore, args) -> List[Dict[str, Any]]:
+    results = []
+    for size, part_size, concurrency in itertools.product(
+        args.file_sizes, args.part_sizes, args.concurrency
+    ):
+        store._upload_part_size = part_size
+        store._upload_concurrency = concurrency
+        data = b"x" * size
+        manager = S3FileStorageManager(_Resource(), None, _Field())
+        uris = []
+
+        async def upload():
+            uris.append(await _upload(manager, data))
+
+        timings = await _timed(upload, args.repeat)
+        for uri in uris:
+            await manager.delete_upload(uri)
+        results.append(
+            _summary(
+                "upload",
+                {"size": size, "part_size": part_size, "concurrency": concurrency},
+                timings,
+                size,
+            )
+        )
+    return results
+
+
+async def bench_download(store: S3BlobStore, args) -> List[Dict[str, Any]]:
+    results = []
+    for size in args.file_sizes:
+        store._upload_concurrency = max(args.concurrency)
+        uri = await _upload(
+            S3FileStorageManager(_Resource(), None, _Field()), b"x" * size
+        )
+        file = S3File(content_type="application/octet-stream")
+        file.uri = uri
+        file.size = size
+        manager = S3FileStorageManager(_Resource(), None, _Field(file))
+
+        async def download():
+            async for _ in manager.iter_data():
+                pass
+
+        for range_size, concurrency in itertools.product(
+            args.range_sizes, args.concurrency
+        ):
+            store._download_range_size = range_size
+            store._download_concurrency = concurrency
+            timings = await _timed(download, args.repeat)
+            results.append(
+                _summary(
+                    "download",
+                    {
+                        "size": size,
+                        "range_size": range_size,
+                        "concurrency": concurrency,
+                    },
+                    timings,
+                    size,
+                )
+            )
+    return results
+
+
+async def bench_bucket_name(store: S3BlobStore, args) -> List[Dict[str, Any]]:
+    async def uncached():
+        store._cached_buckets.clear()
+        await store.get_bucket_name()
+
+    calls = args.repeat * 100
+    return [
+        _summary("get_bucket_name", {"cached": False}, await _timed(uncached, calls)),
+        _summary(
+            "get_bucket_name",
+            {"cached": True},
+            await _timed(store.get_bucket_name, calls),
+        ),
+    ]
+
+
+async def bench_listing(store: S3BlobStore, args) -> List[Dict[str, Any]]:
+    container = task_vars.container.get()
+    assert container is not None, "the benchmark sets a container"
+    bucket_name = await store.get_bucket_name()
+    prefix = container.id
+    async with store.s3_client() as client:
+        for index in range(args.list_objects):
+            await client.put_object(
+                Bucket=bucket_name,
+                Key=f"{prefix}/{index % args.list_prefixes}/{index}",
+                Body=b"x",
+            )
+
+    results = []
+    for concurrency in args.list_concurrency:
+
+        async def listing():
+            async for _ in store.iterate_bucket(concurrency=concurrency):
+                pass
+
+        timings = await _timed(listing, args.repeat)
+        result = _summary("listing", {"concurrency": concurrency}, timings)
+        result["objects_s"] = args.list_objects * len(timings) / sum(timings)
+        results.append(result)
+    return results
+
+
+BENCHMARKS = {
+    "upload": bench_upload,
+    "download": bench_download,
+    "get_bucket_name": bench_bucket_name,
+    "listing": bench_listing,
+}
+
+
+async def run(args) -> Dict[str, Any]:
+    settings = {
+        "aws_client_id": args.aws_client_id,
+        "aws_client_secret": args.aws_client_secret,
+        "bucket": args.bucket,
+        "region_name": args.region_name,
+        "endpoint_url": args.endpoint_url,
+        "ssl": False,
+        "max_pool_connections": args.max_pool_connections,
+        "clients": args.clients,
+    }
+    if args.local_path:
+        store: S3BlobStore = LocalBlobStore({**settings, "path": args.local_path})
+    else:
+        store = S3BlobStore(settings)
+    if args.endpoint_url or args.local_path:
+        await store.initialize()
+    else:
+        store._s3aioclient = MemoryS3Client(args.latency, args.bandwidth)
+    provide_utility(store, IS3BlobStore)
+    # stands in for the only attribute of a container used by the store
+    container = _Container(f"benchmark-{uuid.uuid4().hex[:8]}")
+    task_vars.container.set(cast(IContainer, container))
+
+    results: List[Dict[str, Any]] = []
+    try:
+        for name in args.benchmarks:
+            results.extend(await BENCHMARKS[name](store, args))
+    finally:
+        if args.endpoint_url or args.local_path:
+            await store.finalize()
+    return {
+        "settings": {
+            "endpoint_url": args.endpoint_url,
+            "local_path": args.local_path,
+            "latency": args.latency,
+            "bandwidth": args.bandwidth,
+            "chunk_size": CHUNK_SIZE,
+            "max_pool_connections": args.max_pool_connections,
+            "clients": args.clients,
+        },
+        "results": results,
+    }
+
+
+def compare(
+    results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float
+) -> List[str]:
+    """
+    Describe the results that are more than `tolerance` slower than the
+    same benchmark in `baseline`
+    """
+
+    def key(result):
+        return result["benchmark"], json.dumps(result["params"], sort_keys=True)
+
+    previous = {key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in results["results"]:
+        before = previous.get(key(result))
+        if before is None:
+            continue
+        if result["p50_ms"] > before["p50_ms"] * (1 + tolerance):
+            regressions.append(
+                f"{key(result)}: p50 {before['p50_ms']:.2f}ms -> "
+                f"{result['p50_ms']:.2f}ms"
+            )
+    return regressions
+
+
+def _sizes(value: str) -> List[int]:
+    return [int(float(size) * MB) for size in value.split(",")]
+
+
+def _ints(value: str) -> List[int]:
+    return [int(item) for item in value.split(",")]
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.split("::")[0].strip())
+    parser.add_argument(
+        "--benchmarks",
+        type=lambda value: value.split(","),
+        default=list(BENCHMARKS),
+        help="comma separated benchmarks to run: " + ", ".join(BENCHMARKS),
+    )
+    parser.add_argument("--file-sizes", type=_sizes, default=DEFAULT_FILE_SIZES)
+    parser.add_argument("--part-sizes", type=_sizes, default=DEFAULT_PART_SIZES)
+    parser.add_argument("--range-sizes", type=_sizes, default=DEFAULT_RANGE_SIZES)
+    parser.add_argument("--concurrency", type=_ints, default=DEFAULT_CONCURRENCY)
+    parser.add_argument(
+        "--list-concurrency", type=_ints, default=DEFAULT_LIST_CONCURRENCY
+    )
+    parser.add_argument("--list-objects", type=int, default=5000)
+    parser.add_argument("--list-prefixes", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--max-pool-connections", type=int, default=30)
+    parser.add_argument(
+        "--clients", type=int, default=1, help="S3 clients with --endpoint-url"
+    )
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument("--bandwidth", type=float, default=100 * MB)
+    parser.add_argument("--endpoint-url")
+    parser.add_argument(
+        "--local-path", help="benchmark a LocalBlobStore in this directory"
+    )
+    parser.add_argument("--bucket", default="benchmark")
+    parser.add_argument("--region-name", default="us-east-1")
+    parser.add_argument("--aws-client-id", default="x" * 10)
+    parser.add_argument("--aws-client-secret", default="x" * 10)
+    parser.add_argument("--output", help="file to write the JSON results to")
+    parser.add_argument("--baseline", help="JSON results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = get_parser().parse_args(argv)
+    results = asyncio.run(run(args))
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as fi:
+            fi.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as fi:
+            regressions = compare(results, json.load(fi), args.tolerance)
+        for regression in regressions:
+            print(f"Regression {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,435 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import collections
+import contextlib
+import hashlib
+import json
+import os
+import time
+import uuid
+from typing import Any
+from typing import AsyncIterator
+from typing import BinaryIO
+from typing import Dict
+from typing import Hashable
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+from guillotina_s3storage import metrics
+from guillotina_s3storage.utils import SingleFlight
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Mapping whose entries expire `ttl` seconds after being set.
+
+    When `max_size` is reached the oldest entry is dropped to make room.
+    """
+
+    def __init__(self, ttl: float, max_size: int = 1024):
+        self._ttl = ttl
+        self._max_size = max_size
+        self._data: Dict[Hashable, Tuple[Any, float]] = {}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        value, expires = self._data.get(key, (_MISSING, 0.0))
+        if value is _MISSING:
+            return default
+        if expires <= time.monotonic():
+            del self._data[key]
+            return default
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        if ttl is None:
+            ttl = self._ttl
+        self._data.pop(key, None)
+        if ttl <= 0:
+            return
+        while len(self._data) >= self._max_size:
+            del self._data[next(iter(self._data))]
+        self._data[key] = (value, time.monotonic() + ttl)
+
+    def invalidate(self, key: Optional[Hashable] = None):
+        """
+        Drop `key`, or every entry when no key is given
+        """
+        if key is None:
+            self._data.clear()
+        else:
+            self._data.pop(key, None)
+
+
+class LRUSet:
+    """
+    Set holding at most `max_size` items, dropping the least recently
+    used one when full. Membership checks count as a use.
+    """
+
+    def __init__(self, max_size: int):
+        self._max_size = max_size
+        self._data: "collections.OrderedDict[Hashable, None]" = (
+            collections.OrderedDict()
+        )
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, item: Hashable) -> bool:
+        if item in self._data:
+            self._data.move_to_end(item)
+            return True
+        return False
+
+    def add(self, item: Hashable):
+        self._data[item] = None
+        self._data.move_to_end(item)
+        while len(self._data) > self._max_size:
+            self._data.popitem(last=False)
+
+    def discard(self, item: Hashable):
+        self._data.pop(item, None)
+
+    def clear(self):
+        self._data.clear()
+
+
+class ByteLRU:
+    """
+    Mapping of byte strings holding at most `max_size` bytes in total,
+    dropping the least recently used values when full.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self._data: "collections.OrderedDict[Hashable, bytes]" = (
+            collections.OrderedDict()
+        )
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        value = self._data.get(key)
+        if value is None:
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: bytes):
+        self.discard(key)
+        if len(value) > self.max_size:
+            return
+        self._data[key] = value
+        self.size += len(value)
+        while self.size > self.max_size:
+            _, dropped = self._data.popitem(last=False)
+            self.size -= len(dropped)
+
+    def discard(self, key: Hashable):
+        value = self._data.pop(key, None)
+        if value is not None:
+            self.size -= len(value)
+
+    def clear(self):
+        self._data.clear()
+        self.size = 0
+
+
+class MemoryCache:
+    """
+    Cache of whole objects of up to `max_object_size` bytes, keyed by
+    bucket and key, holding at most `max_size` bytes in memory.
+    """
+
+    def __init__(
+        self, max_size: int = 64 * 1024 * 1024, max_object_size: int = 256 * 1024
+    ):
+        self.max_object_size = max_object_size
+        self.objects = ByteLRU(max_size)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, bucket: str, key: str) -> Optional[bytes]:
+        data = self.objects.get((bucket, key))
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        metrics.record_cache_lookup("memory", data is not None)
+        return data
+
+    def set(self, bucket: str, key: str, data: bytes):
+        if len(data) <= self.max_object_size:
+            self.objects.set((bucket, key), data)
+
+    def invalidate(self, bucket: str, key: str):
+        self.objects.discard((bucket, key))
+
+
+class RangeCache:
+    """
+    Memory bounded, least recently used cache of `block_size` aligned
+    blocks of objects, for range reads.
+
+    Blocks are keyed by bucket, key, ETag and block number. The ETag an
+    object was last read with is trusted for `revalidate_after` seconds;
+    callers are expected to send it as `IfMatch` when fetching blocks.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 64 * 1024 * 1024,
+        block_size: int = 1024 * 1024,
+        read_ahead: int = 1,
+        revalidate_after: float = 300,
+    ):
+        self.block_size = block_size
+        self.read_ahead = read_ahead
+        self.blocks = ByteLRU(max_size)
+        self.etags = TTLCache(revalidate_after, max_size=max(1, max_size // block_size))
+        # blocks being fetched, shared by overlapping reads
+        self.fetches = SingleFlight()
+        self.read_aheads: Set[asyncio.Future] = set()
+
+    def get_etag(self, bucket: str, key: str) -> Optional[str]:
+        return self.etags.get((bucket, key))
+
+    def get_block(self, bucket: str, key: str, block: int) -> Optional[bytes]:
+        etag = self.get_etag(bucket, key)
+        if etag is None:
+            return None
+        return self.blocks.get((bucket, key, etag, block))
+
+    def set_block(self, bucket: str, key: str, etag: str, block: int, data: bytes):
+        self.etags.set((bucket, key), etag)
+        self.blocks.set((bucket, key, etag, block), data)
+
+    def invalidate(self, bucket: str, key: str):
+        # blocks of the previous ETag are not reachable anymore and age out
+        self.etags.invalidate((bucket, key))
+
+
+class DiskCacheEntry:
+    def __init__(self, name: str, etag: str, size: int, validated: float):
+        self.name = name
+        self.etag = etag
+        self.size = size
+        self.validated = validated
+
+
+class DiskCacheWriter:
+    """
+    Fills one cache entry. Data is written to a temporary file which only
+    replaces the entry on `commit`, so readers never see partial objects.
+    """
+
+    def __init__(self, cache: "DiskCache", name: str, etag: str, size: int):
+        self._cache = cache
+        self._name = name
+        self._etag = etag
+        self._size = size
+        self._written = 0
+        self._tmp_path = os.path.join(cache.path, f".{name}.{uuid.uuid4().hex}")
+        self._file: Optional[BinaryIO] = None
+
+    async def write(self, data: bytes):
+        if self._file is None:
+            self._file = await self._cache._run(open, self._tmp_path, "wb")
+        await self._cache._run(self._file.write, data)
+        self._written += len(data)
+
+    async def commit(self):
+        if self._written != self._size:
+            await self.abort()
+            return
+        await self._cache._run(self._commit)
+        self._cache._add(DiskCacheEntry(self._name, self._etag, self._size, _now()))
+
+    def _commit(self):
+        if self._file is None:
+            # zero length objects never called write
+            self._file = open(self._tmp_path, "wb")
+        self._file.close()
+        meta_path = self._tmp_path + ".json"
+        with open(meta_path, "w") as meta:
+            json.dump({"etag": self._etag, "size": self._size}, meta)
+        os.replace(self._tmp_path, self._cache._data_path(self._name))
+        os.replace(meta_path, self._cache._meta_path(self._name))
+
+    async def abort(self):
+        await self._cache._run(self._abort)
+
+    def _abort(self):
+        if self._file is not None:
+            self._file.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self._tmp_path)
+
+
+class DiskCache:
+    """
+    Size bounded, least recently used cache of whole objects on local disk.
+
+    Entries are keyed by bucket and key and remember the ETag they were
+    filled from. An entry is served as is for `revalidate_after` seconds
+    after it was last validated; after that callers are expected to check
+    the ETag with S3 and call `validated`.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_size: int = 1024 * 1024 * 1024,
+        max_object_size: int = 64 * 1024 * 1024,
+        revalidate_after: float = 300,
+        chunk_size: int = 1024 * 1024,
+    ):
+        self.path = path
+        self.max_size = max_size
+        self.max_object_size = max_object_size
+        self.revalidate_after = revalidate_after
+        self.chunk_size = chunk_size
+        self.size = 0
+        self._entries: "collections.OrderedDict[str, DiskCacheEntry]" = (
+            collections.OrderedDict()
+        )
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    def _name(self, bucket: str, key: str) -> str:
+        return hashlib.sha256(f"{bucket}/{key}".encode("utf-8")).hexdigest()
+
+    def _data_path(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _meta_path(self, name: str) -> str:
+        return os.path.join(self.path, name + ".json")
+
+    async def initialize(self):
+        """
+        Load the entries left on disk by a previous process
+        """
+        for entry in await self._run(self._scan):
+            self._add(entry)
+
+    def _scan(self) -> List[DiskCacheEntry]:
+        os.makedirs(self.path, exist_ok=True)
+        found = []
+        for filename in os.listdir(self.path):
+            path = os.path.join(self.path, filename)
+            if filename.startswith("."):
+                # temporary files of fills that never finished
+                os.unlink(path)
+                continue
+            if filename.endswith(".json"):
+                continue
+            try:
+                with open(self._meta_path(filename)) as meta_file:
+                    meta = json.load(meta_file)
+                stat = os.stat(path)
+            except (OSError, ValueError):
+                self._remove_files(filename)
+                continue
+            if stat.st_size != meta["size"]:
+                self._remove_files(filename)
+                continue
+            found.append((stat.st_mtime, filename, meta))
+        # oldest first; loaded entries are revalidated before being served
+        return [
+            DiskCacheEntry(filename, meta["etag"], meta["size"], 0)
+            for _, filename, meta in sorted(found)
+        ]
+
+    def get(self, bucket: str, key: str) -> Optional[DiskCacheEntry]:
+        name = self._name(bucket, key)
+        entry = self._entries.get(name)
+        if entry is not None:
+            self._entries.move_to_end(name)
+        return entry
+
+    def is_fresh(self, entry: DiskCacheEntry) -> bool:
+        return _now() - entry.validated < self.revalidate_after
+
+    def validated(self, entry: DiskCacheEntry):
+        entry.validated = _now()
+
+    def writer(self, bucket: str, key: str, etag: str, size: int) -> DiskCacheWriter:
+        return DiskCacheWriter(self, self._name(bucket, key), etag, size)
+
+    async def open(self, entry: DiskCacheEntry) -> Optional[BinaryIO]:
+        """
+        Open the data of a cached object, or return None if it is gone.
+        Once open the data stays readable even if the entry gets evicted.
+        """
+        try:
+            return await self._run(open, self._data_path(entry.name), "rb")
+        except FileNotFoundError:
+            self.invalidate_entry(entry)
+            return None
+
+    async def read(self, file: BinaryIO, start: int, end: int) -> AsyncIterator[bytes]:
+        """
+        Read bytes `start` to `end` of an opened cached object
+        """
+        try:
+            await self._run(file.seek, start)
+            while start < end:
+                data = await self._run(file.read, min(self.chunk_size, end - start))
+                if not data:
+                    break
+                start += len(data)
+                yield data
+        finally:
+            file.close()
+
+    def _add(self, entry: DiskCacheEntry):
+        previous = self._entries.pop(entry.name, None)
+        if previous is not None:
+            self.size -= previous.size
+        self._entries[entry.name] = entry
+        self.size += entry.size
+        evicted = []
+        while self.size > self.max_size and len(self._entries) > 1:
+            _, oldest = self._entries.popitem(last=False)
+            self.size -= oldest.size
+            evicted.append(oldest.name)
+        if evicted:
+            asyncio.get_running_loop().run_in_executor(
+                None, self._remove_files, *evicted
+            )
+
+    def invalidate(self, bucket: str, key: str):
+        entry = self._entries.get(self._name(bucket, key))
+        if entry is not None:
+            self.invalidate_entry(entry)
+
+    def invalidate_entry(self, entry: DiskCacheEntry):
+        if self._entries.get(entry.name) is entry:
+            del self._entries[entry.name]
+            self.size -= entry.size
+            asyncio.get_running_loop().run_in_executor(
+                None, self._remove_files, entry.name
+            )
+
+    def _remove_files(self, *names: str):
+        for name in names:
+            for path in (self._data_path(name), self._meta_path(name)):
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(path)
+
+
+def _now() -> float:
+    return time.time()
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+import base64
+import hashlib
+import zlib
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+
+try:
+    from crc32c import crc32c as _crc32c
+except ImportError:
+    _crc32c = None
+
+
+class CRC:
+    """
+    hashlib-like wrapper of a zlib style `crc(data, value)` function
+    """
+
+    def __init__(self, crc: Callable[[bytes, int], int]):
+        self._crc = crc
+        self._value = 0
+
+    def update(self, data: bytes):
+        self._value = self._crc(data, self._value)
+
+    def digest(self) -> bytes:
+        return self._value.to_bytes(4, "big")
+
+
+def _hashers() -> Dict[str, Callable]:
+    hashers: Dict[str, Callable] = {
+        "md5": hashlib.md5,
+        "sha256": hashlib.sha256,
+        "crc32": lambda: CRC(zlib.crc32),
+    }
+    if _crc32c is not None:
+        hashers["crc32c"] = lambda: CRC(_crc32c)
+    return hashers
+
+
+HASHERS = _hashers()
+
+# request parameters carrying the checksum of a body
+PARAMETERS = {
+    "md5": "ContentMD5",
+    "sha256": "ChecksumSHA256",
+    "crc32": "ChecksumCRC32",
+    "crc32c": "ChecksumCRC32C",
+}
+
+
+def check_algorithm(algorithm: Optional[str]):
+    if algorithm is not None and algorithm not in HASHERS:
+        if algorithm == "crc32c":
+            raise ValueError("crc32c checksums need the crc32c package")
+        raise ValueError(f"Unknown checksum algorithm {algorithm}")
+
+
+def checksum(algorithm: str, data: bytes) -> str:
+    """
+    Base64 encoded checksum of `data`, as S3 sends them
+    """
+    hasher = HASHERS[algorithm]()
+    hasher.update(data)
+    return base64.b64encode(hasher.digest()).decode()
+
+
+def combine(algorithm: str, part_checksums: List[str]) -> str:
+    """
+    Checksum of a multipart upload from the checksums of its parts, as S3
+    computes it: the checksum of the concatenated digests, followed by
+    the number of parts
+    """
+    digests = b"".join(base64.b64decode(value) for value in part_checksums)
+    return f"{checksum(algorithm, digests)}-{len(part_checksums)}"
+
+
+def multipart_parameters(algorithm: Optional[str]) -> Dict[str, str]:
+    """
+    Parameters of `create_multipart_upload` for parts sent with checksums.
+    S3 has no multipart MD5 checksum, parts carry a Content-MD5 instead
+    """
+    if algorithm is None or algorithm == "md5":
+        return {}
+    return {"ChecksumAlgorithm": algorithm.upper()}
+
+
+def request_parameters(
+    algorithm: Optional[str], value: Optional[str]
+) -> Dict[str, str]:
+    """
+    Parameters sending the checksum of a part or object to S3, which
+    rejects the data when it does not match
+    """
+    if algorithm is None or value is None:
+        return {}
+    return {PARAMETERS[algorithm]: value}
+
+
+class ChecksumVerifier:
+    """
+    Computes the checksum of data as it is read, using the part sizes the
+    object was uploaded with
+    """
+
+    def __init__(self, algorithm: str, part_sizes: List[int]):
+        self._algorithm = algorithm
+        self._part_sizes = part_sizes
+        self._checksums: List[str] = []
+        self._hasher = HASHERS[algorithm]()
+        self._remaining = part_sizes[0] if part_sizes else 0
+        self._extra = 0
+
+    def update(self, data: bytes):
+        with memoryview(data) as view:
+            while view:
+                if len(self._checksums) >= len(self._part_sizes):
+                    self._extra += len(view)
+                    return
+                size = min(len(view), self._remaining)
+                self._hasher.update(view[:size])
+                self._remaining -= size
+                view = view[size:]
+                if not self._remaining:
+                    self._next_part()
+        self._skip_empty_parts()
+
+    def _next_part(self):
+        self._checksums.append(base64.b64encode(self._hasher.digest()).decode())
+        self._hasher = HASHERS[self._algorithm]()
+        if len(self._checksums) < len(self._part_sizes):
+            self._remaining = self._part_sizes[len(self._checksums)]
+            self._skip_empty_parts()
+
+    def _skip_empty_parts(self):
+        if (
+            len(self._checksums) < len(self._part_sizes)
+            and not self._part_sizes[len(self._checksums)]
+        ):
+            self._next_part()
+
+    def matches(self, expected: str) -> bool:
+        self._skip_empty_parts()
+        if self._extra or len(self._checksums) != len(self._part_sizes):
+            return False
+        if "-" in expected:
+            return combine(self._algorithm, self._checksums) == expected
+        return self._checksums == [expected]
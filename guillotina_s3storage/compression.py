@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+import fnmatch
+import zlib
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# codecs, named like the HTTP content codings they produce
+CODECS = ("gzip", "zstd") if zstandard is not None else ("gzip",)
+
+
+def check_codec(codec: str):
+    if codec not in CODECS:
+        if codec == "zstd":
+            raise ValueError("zstd compression needs the zstandard package")
+        raise ValueError(f"Unknown compression codec {codec}")
+
+
+def accepts(accept_encoding: Optional[str], codec: str) -> bool:
+    """
+    Whether an `Accept-Encoding` header accepts `codec`
+    """
+    for item in (accept_encoding or "").split(","):
+        token, _, params = item.partition(";")
+        if token.strip().lower() not in (codec, "*"):
+            continue
+        name, _, value = params.strip().partition("=")
+        try:
+            return name.strip() != "q" or float(value) > 0
+        except ValueError:
+            return False
+    return False
+
+
+def frame_range(
+    frames: Optional[List[List[int]]], start: int, end: int
+) -> Tuple[int, int, Optional[int]]:
+    """
+    Offsets of the frames holding decompressed bytes `start` to `end`:
+    the decompressed offset of the first frame, and the compressed range
+    of the frames. Without a frame index the whole object has to be read.
+    """
+    if not frames:
+        return 0, 0, None
+    raw_offset = encoded_offset = 0
+    frames_iter = iter(frames)
+    for raw_size, encoded_size in frames_iter:
+        if raw_offset + raw_size > start:
+            break
+        raw_offset += raw_size
+        encoded_offset += encoded_size
+    else:
+        return raw_offset, encoded_offset, encoded_offset
+    first_raw, first_encoded = raw_offset, encoded_offset
+    raw_offset += raw_size
+    encoded_offset += encoded_size
+    for raw_size, encoded_size in frames_iter:
+        if raw_offset >= end:
+            break
+        raw_offset += raw_size
+        encoded_offset += encoded_size
+    return first_raw, first_encoded, encoded_offset
+
+
+class StreamDecoder:
+    """
+    Decompresses a stream of concatenated gzip members or zstd frames
+    """
+
+    def __init__(self, codec: str):
+        self._codec = codec
+        self._decoder: Any = None
+
+    def _new_decoder(self):
+        if self._codec == "gzip":
+            return zlib.decompressobj(zlib.MAX_WBITS | 16)
+        return zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data: bytes) -> bytes:
+        output = []
+        while data:
+            if self._decoder is None:
+                self._decoder = self._new_decoder()
+            output.append(self._decoder.decompress(data))
+            if not self._decoder.eof:
+                break
+            data = self._decoder.unused_data
+            self._decoder = None
+        return b"".join(output)
+
+    @property
+    def complete(self) -> bool:
+        """
+        Whether the data given so far ended with a complete frame
+        """
+        return self._decoder is None
+
+
+class Compression:
+    """
+    Compression of uploads by content type.
+
+    `content_types` maps content type patterns (`text/*`,
+    `application/json`...) to the codec used for them. Data is compressed
+    in independent frames of `frame_size` bytes, so ranges can be read
+    without decompressing everything before them; files of more than
+    `max_frames` frames keep no frame index.
+    """
+
+    def __init__(
+        self,
+        content_types: Dict[str, str],
+        level: Optional[int] = None,
+        frame_size: int = 1024 * 1024,
+        max_frames: int = 10000,
+        threads: int = 4,
+    ):
+        for codec in content_types.values():
+            check_codec(codec)
+        self.content_types = content_types
+        self.level = level
+        self.frame_size = frame_size
+        self.max_frames = max_frames
+        self.threads = threads
+
+    def codec_for(self, content_type: Optional[str]) -> Optional[str]:
+        if not content_type:
+            return None
+        content_type = content_type.split(";")[0].strip().lower()
+        for pattern, codec in self.content_types.items():
+            if fnmatch.fnmatchcase(content_type, pattern):
+                return codec
+        return None
+
+    def compress(self, codec: str, data: bytes) -> bytes:
+        """
+        Compress `data` as a single, self contained frame
+        """
+        if codec == "gzip":
+            compressor = zlib.compressobj(
+                zlib.Z_DEFAULT_COMPRESSION if self.level is None else self.level,
+                zlib.DEFLATED,
+                zlib.MAX_WBITS | 16,
+            )
+            return compressor.compress(data) + compressor.flush()
+        if self.level is None:
+            return zstandard.ZstdCompressor().compress(data)
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def compress_frames(self, codec: str, data: bytes) -> Tuple[bytes, List[List[int]]]:
+        """
+        Compress `data` in frames, returning the compressed data and the
+        decompressed and compressed size of every frame
+        """
+        output = []
+        frames = []
+        with memoryview(data) as view:
+            for offset in range(0, len(view), self.frame_size):
+                frame = view[offset : offset + self.frame_size]
+                encoded = self.compress(codec, frame)
+                output.append(encoded)
+                frames.append([len(frame), len(encoded)])
+        return b"".join(output), frames
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import contextlib
+import json
+import os
+import sqlite3
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+from guillotina import task_vars
+from guillotina.annotations import AnnotationData
+from guillotina.component import get_adapter
+from guillotina.interfaces import IAnnotations
+
+# values of a file that describe how its object was stored, shared by the
+# files deduplicated to that object
+METADATA = (
+    "checksum_algorithm",
+    "checksum",
+    "part_sizes",
+    "content_encoding",
+    "encoded_size",
+    "encoded_frames",
+)
+# keys per statement, below SQLite's limit of bound parameters
+SQLITE_BATCH_SIZE = 500
+
+
+class DedupIndex:
+    """
+    Index of the objects holding the data of each digest, in each bucket,
+    with the metadata of the upload that stored them and the number of
+    files referencing them.
+    """
+
+    # whether changes are part of the guillotina transaction, in which
+    # case objects released are only deleted once it commits
+    transactional = False
+
+    async def initialize(self):
+        pass
+
+    async def finalize(self):
+        pass
+
+    async def acquire(
+        self, bucket: str, digest: str, uri: str, metadata: Dict[str, Any]
+    ) -> Tuple[str, Dict[str, Any]]:
+        """
+        Reference the object holding `digest`, registering `uri` with its
+        `metadata` when there is none. Returns the uri and metadata of the
+        object referenced.
+        """
+        raise NotImplementedError()
+
+    async def reference(self, bucket: str, digest: str, uri: str) -> bool:
+        """
+        Add a reference to `uri`, when it is the object holding `digest`
+        """
+        raise NotImplementedError()
+
+    async def release(self, bucket: str, digest: str, uri: str) -> Optional[int]:
+        """
+        Drop a reference to `uri`, returning how many are left, or None
+        when it is not the object holding `digest`
+        """
+        raise NotImplementedError()
+
+    async def forget(self, bucket: str, digest: str, uri: str):
+        """
+        Drop the entry of `digest` if its object is `uri`, which is gone
+        """
+        raise NotImplementedError()
+
+    async def referenced(self, bucket: str, uris: Iterable[str]) -> Set[str]:
+        """
+        The `uris` that are objects of the index
+        """
+        raise NotImplementedError()
+
+
+class SQLiteIndex(DedupIndex):
+    """
+    Index in a SQLite database on local disk, for deployments sharing a
+    filesystem. It is not part of the guillotina transaction: references
+    are taken as uploads finish, so those of transactions that abort are
+    never dropped and keep their objects, and are only released once the
+    transaction deleting a file commits.
+    """
+
+    def __init__(self, path: str, timeout: float = 30):
+        self.path = path
+        self.timeout = timeout
+        self._db: Optional[sqlite3.Connection] = None
+        # a single thread, which owns the connection
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="s3-dedup")
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, func, *args
+        )
+
+    async def initialize(self):
+        await self._run(self._connect)
+
+    async def finalize(self):
+        await self._run(self._close)
+        self._executor.shutdown(wait=False)
+
+    def _connect(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(
+            self.path,
+            timeout=self.timeout,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS blobs ("
+            "bucket TEXT NOT NULL, digest TEXT NOT NULL, uri TEXT NOT NULL, "
+            "refs INTEGER NOT NULL, metadata TEXT NOT NULL, "
+            "PRIMARY KEY (bucket, digest))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS blobs_uri ON blobs (bucket, uri)")
+
+    def _close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # other processes using the database wait for the write lock
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            yield self._db
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+
+    async def acquire(self, bucket, digest, uri, metadata):
+        return await self._run(self._acquire, bucket, digest, uri, metadata)
+
+    def _acquire(self, bucket, digest, uri, metadata):
+        with self._transaction() as db:
+            row = db.execute(
+                "SELECT uri, metadata FROM blobs WHERE bucket = ? AND digest = ?",
+                (bucket, digest),
+            ).fetchone()
+            if row is None:
+                db.execute(
+                    "INSERT INTO blobs VALUES (?, ?, ?, 1, ?)",
+                    (bucket, digest, uri, json.dumps(metadata)),
+                )
+                return uri, metadata
+            db.execute(
+                "UPDATE blobs SET refs = refs + 1 WHERE bucket = ? AND digest = ?",
+                (bucket, digest),
+            )
+            return row[0], json.loads(row[1])
+
+    async def reference(self, bucket, digest, uri):
+        return await self._run(self._reference, bucket, digest, uri)
+
+    def _reference(self, bucket, digest, uri):
+        with self._transaction() as db:
+            return (
+                db.execute(
+                    "UPDATE blobs SET refs = refs + 1 "
+                    "WHERE bucket = ? AND digest = ? AND uri = ?",
+                    (bucket, digest, uri),
+                ).rowcount
+                > 0
+            )
+
+    async def release(self, bucket, digest, uri):
+        return await self._run(self._release, bucket, digest, uri)
+
+    def _release(self, bucket, digest, uri):
+        with self._transaction() as db:
+            row = db.execute(
+                "SELECT refs FROM blobs WHERE bucket = ? AND digest = ? AND uri = ?",
+                (bucket, digest, uri),
+            ).fetchone()
+            if row is None:
+                return None
+            refs = row[0] - 1
+            if refs > 0:
+                db.execute(
+                    "UPDATE blobs SET refs = ? WHERE bucket = ? AND digest = ?",
+                    (refs, bucket, digest),
+                )
+            else:
+                db.execute(
+                    "DELETE FROM blobs WHERE bucket = ? AND digest = ?",
+                    (bucket, digest),
+                )
+            return max(refs, 0)
+
+    async def forget(self, bucket, digest, uri):
+        await self._run(self._forget, bucket, digest, uri)
+
+    def _forget(self, bucket, digest, uri):
+        with self._transaction() as db:
+            db.execute(
+                "DELETE FROM blobs WHERE bucket = ? AND digest = ? AND uri = ?",
+                (bucket, digest, uri),
+            )
+
+    async def referenced(self, bucket, uris):
+        return await self._run(self._referenced, bucket, list(uris))
+
+    def _referenced(self, bucket, uris):
+        found: Set[str] = set()
+        for offset in range(0, len(uris), SQLITE_BATCH_SIZE):
+            batch = uris[offset : offset + SQLITE_BATCH_SIZE]
+            found.update(
+                row[0]
+                for row in self._db.execute(
+                    "SELECT uri FROM blobs WHERE bucket = ? AND uri IN "
+                    f"({', '.join('?' * len(batch))})",
+                    (bucket, *batch),
+                )
+            )
+        return found
+
+
+class AnnotationIndex(DedupIndex):
+    """
+    Index kept in annotations of the current container, changed within the
+    transaction of the request: references of transactions that abort are
+    dropped with them. Entries are spread over `shards` annotations, by
+    digest and by uri, so concurrent uploads seldom write the same one.
+    """
+
+    transactional = True
+
+    def __init__(self, shards: int = 256):
+        self.shards = shards
+
+    async def _shard(self, name: str, create: bool = False):
+        container = task_vars.container.get()
+        assert container is not None, "AnnotationIndex needs a container"
+        annotations = get_adapter(container, IAnnotations)
+        key = f"s3storage-dedup-{name}"
+        shard = await annotations.async_get(key)
+        if shard is None and create:
+            shard = AnnotationData()
+            await annotations.async_set(key, shard)
+        return shard
+
+    def _digest_shard(self, digest: str) -> str:
+        return f"d{int(digest[:8], 16) % self.shards}"
+
+    def _uri_shard(self, uri: str) -> str:
+        return f"u{zlib.crc32(uri.encode('utf-8')) % self.shards}"
+
+    async def acquire(self, bucket, digest, uri, metadata):
+        shard = await self._shard(self._digest_shard(digest), create=True)
+        entry = shard.get(f"{bucket}/{digest}")
+        if entry is None:
+            entry = {"uri": uri, "refs": 0, "metadata": metadata}
+            uris = await self._shard(self._uri_shard(uri), create=True)
+            uris[f"{bucket}/{uri}"] = digest
+            uris.register()
+        entry = dict(entry, refs=entry["refs"] + 1)
+        shard[f"{bucket}/{digest}"] = entry
+        shard.register()
+        return entry["uri"], entry["metadata"]
+
+    async def _entry(self, bucket, digest, uri):
+        shard = await self._shard(self._digest_shard(digest))
+        entry = shard.get(f"{bucket}/{digest}") if shard is not None else None
+        if entry is None or entry["uri"] != uri:
+            return None, None
+        return shard, entry
+
+    async def _drop(self, shard, bucket, digest, uri):
+        del shard[f"{bucket}/{digest}"]
+        shard.register()
+        uris = await self._shard(self._uri_shard(uri))
+        if uris is not None and uris.pop(f"{bucket}/{uri}", None) is not None:
+            uris.register()
+
+    async def reference(self, bucket, digest, uri):
+        shard, entry = await self._entry(bucket, digest, uri)
+        if entry is None:
+            return False
+        shard[f"{bucket}/{digest}"] = dict(entry, refs=entry["refs"] + 1)
+        shard.register()
+        return True
+
+    async def release(self, bucket, digest, uri):
+        shard, entry = await self._entry(bucket, digest, uri)
+        if entry is None:
+            return None
+        refs = entry["refs"] - 1
+        if refs > 0:
+            shard[f"{bucket}/{digest}"] = dict(entry, refs=refs)
+            shard.register()
+        else:
+            await self._drop(shard, bucket, digest, uri)
+        return max(refs, 0)
+
+    async def forget(self, bucket, digest, uri):
+        shard, entry = await self._entry(bucket, digest, uri)
+        if entry is not None:
+            await self._drop(shard, bucket, digest, uri)
+
+    async def referenced(self, bucket, uris):
+        found: Set[str] = set()
+        for uri in uris:
+            shard = await self._shard(self._uri_shard(uri))
+            if shard is not None and f"{bucket}/{uri}" in shard:
+                found.add(uri)
+        return found
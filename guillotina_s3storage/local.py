@@ -0,0 +1,482 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import contextlib
+import hashlib
+import os
+import shutil
+import urllib.parse
+import uuid
+from datetime import datetime
+from datetime import timezone
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import botocore
+
+from guillotina_s3storage.storage import S3BlobStore
+
+UPLOADS_DIR = ".uploads"
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+def _client_error(code: str, operation: str) -> botocore.exceptions.ClientError:
+    return botocore.exceptions.ClientError(
+        {"Error": {"Code": code, "Message": code}}, operation
+    )
+
+
+def _encode(segment: str) -> str:
+    """
+    File name for a segment of a key, which may be empty or start with a
+    dot (names starting with a dot are left for internal files)
+    """
+    if not segment:
+        return "%"
+    segment = segment.replace("%", "%25")
+    if segment.startswith("."):
+        segment = "%2E" + segment[1:]
+    return segment
+
+
+def _decode(name: str) -> str:
+    if name == "%":
+        return ""
+    return urllib.parse.unquote(name)
+
+
+def _etag(stat: os.stat_result) -> str:
+    # objects are always replaced, never rewritten in place
+    return f'"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def _parse_range(value: str, size: int) -> Tuple[int, int]:
+    start, _, end = value.split("bytes=")[-1].partition("-")
+    return int(start), min(int(end) + 1, size) if end else size
+
+
+class LocalStreamContent:
+    def __init__(self, file, start: int, end: int):
+        self._file = file
+        self._offset = start
+        self._end = end
+
+    async def _read(self, size: int) -> bytes:
+        size = min(size, self._end - self._offset)
+        if size <= 0:
+            return b""
+        data = await asyncio.get_running_loop().run_in_executor(
+            None, os.pread, self._file.fileno(), size, self._offset
+        )
+        self._offset += len(data)
+        return data
+
+    async def read(self, size: int = -1) -> bytes:
+        return await self._read(self._end - self._offset if size < 0 else size)
+
+    async def iter_chunked(self, size: int):
+        while True:
+            data = await self._read(size)
+            if not data:
+                break
+            yield data
+
+    async def iter_chunks(self):
+        async for data in self.iter_chunked(READ_CHUNK_SIZE):
+            yield data, False
+
+
+class LocalStreamingBody:
+    """
+    Body of a local object, read from a file opened when the object was
+    requested so later replacements of the object do not affect it
+    """
+
+    def __init__(self, file, start: int, end: int):
+        self._file = file
+        self.content = LocalStreamContent(file, start, end)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+
+class LocalClient:
+    """
+    Implements the S3 client calls used by the storage on top of a local
+    directory, with one sub-directory per bucket and keys as paths in it.
+    """
+
+    def __init__(self, path: str):
+        self._path = os.path.abspath(path)
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    def _bucket_path(self, bucket: str) -> str:
+        return os.path.join(self._path, bucket)
+
+    def object_path(self, bucket: str, key: str) -> str:
+        return os.path.join(
+            self._bucket_path(bucket), *(_encode(part) for part in key.split("/"))
+        )
+
+    def _upload_path(self, bucket: str, upload_id: str) -> str:
+        return os.path.join(self._bucket_path(bucket), UPLOADS_DIR, upload_id)
+
+    def _check_bucket(self, bucket: str, operation: str):
+        if not os.path.isdir(self._bucket_path(bucket)):
+            raise _client_error("404", operation)
+
+    def _write(self, path: str, data: bytes) -> os.stat_result:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = os.path.join(os.path.dirname(path), f".{uuid.uuid4().hex}")
+        with open(tmp_path, "wb") as fi:
+            fi.write(data)
+        os.replace(tmp_path, path)
+        return os.stat(path)
+
+    def _remove(self, bucket: str, key: str):
+        path = self.object_path(bucket, key)
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+        # drop the directories left empty
+        bucket_path = self._bucket_path(bucket)
+        path = os.path.dirname(path)
+        while path != bucket_path:
+            try:
+                os.rmdir(path)
+            except OSError:
+                break
+            path = os.path.dirname(path)
+
+    async def head_bucket(self, Bucket: str, **kwargs):
+        await self._run(self._check_bucket, Bucket, "HeadBucket")
+        return {"ResponseMetadata": {"HTTPStatusCode": 200}}
+
+    async def create_bucket(self, Bucket: str, **kwargs):
+        await self._run(lambda: os.makedirs(self._bucket_path(Bucket), exist_ok=True))
+        return {}
+
+    def _delete_bucket(self, bucket: str):
+        self._check_bucket(bucket, "DeleteBucket")
+        path = self._bucket_path(bucket)
+        if any(not name.startswith(".") for name in os.listdir(path)):
+            raise _client_error("BucketNotEmpty", "DeleteBucket")
+        shutil.rmtree(path)
+
+    async def delete_bucket(self, Bucket: str, **kwargs):
+        await self._run(self._delete_bucket, Bucket)
+        return {"ResponseMetadata": {"HTTPStatusCode": 204}}
+
+    async def put_object(self, Bucket: str, Key: str, Body: bytes = b"", **kwargs):
+        self._check_bucket(Bucket, "PutObject")
+        stat = await self._run(self._write, self.object_path(Bucket, Key), Body)
+        return {"ETag": _etag(stat)}
+
+    def _open(self, bucket: str, key: str, operation: str):
+        self._check_bucket(bucket, operation)
+        try:
+            file = open(self.object_path(bucket, key), "rb")
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            raise _client_error("NoSuchKey", operation)
+        return file, os.fstat(file.fileno())
+
+    async def get_object(
+        self,
+        Bucket: str,
+        Key: str,
+        Range: Optional[str] = None,
+        IfMatch: Optional[str] = None,
+        IfNoneMatch: Optional[str] = None,
+        **kwargs,
+    ):
+        file, stat = await self._run(self._open, Bucket, Key, "GetObject")
+        etag = _etag(stat)
+        if IfMatch is not None and IfMatch != etag:
+            file.close()
+            raise _client_error("PreconditionFailed", "GetObject")
+        if IfNoneMatch is not None and IfNoneMatch == etag:
+            file.close()
+            raise _client_error("304", "GetObject")
+        start, end = 0, stat.st_size
+        if Range:
+            start, end = _parse_range(Range, stat.st_size)
+        return {
+            "Body": LocalStreamingBody(file, start, end),
+            "ContentLength": end - start,
+            "ETag": etag,
+            "LastModified": datetime.fromtimestamp(stat.st_mtime, timezone.utc),
+        }
+
+    def _stat(self, bucket: str, key: str, operation: str) -> os.stat_result:
+        self._check_bucket(bucket, operation)
+        try:
+            return os.stat(self.object_path(bucket, key))
+        except (FileNotFoundError, NotADirectoryError):
+            raise _client_error("404", operation)
+
+    async def head_object(self, Bucket: str, Key: str, **kwargs):
+        stat = await self._run(self._stat, Bucket, Key, "HeadObject")
+        return {
+            "ContentLength": stat.st_size,
+            "ETag": _etag(stat),
+            "LastModified": datetime.fromtimestamp(stat.st_mtime, timezone.utc),
+        }
+
+    def _copy(self, source: str, dest: str) -> os.stat_result:
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp_path = os.path.join(os.path.dirname(dest), f".{uuid.uuid4().hex}")
+        try:
+            # objects are never modified in place, so they can share data
+            os.link(source, tmp_path)
+        except OSError:
+            shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, dest)
+        return os.stat(dest)
+
+    async def copy_object(self, Bucket: str, Key: str, CopySource, **kwargs):
+        await self._run(
+            self._stat, CopySource["Bucket"], CopySource["Key"], "CopyObject"
+        )
+        stat = await self._run(
+            self._copy,
+            self.object_path(CopySource["Bucket"], CopySource["Key"]),
+            self.object_path(Bucket, Key),
+        )
+        return {"CopyObjectResult": {"ETag": _etag(stat)}}
+
+    async def delete_object(self, Bucket: str, Key: str, **kwargs):
+        await self._run(self._remove, Bucket, Key)
+        return {}
+
+    async def delete_objects(self, Bucket: str, Delete, **kwargs):
+        deleted, errors = [], []
+        for item in Delete["Objects"]:
+            try:
+                await self._run(self._remove, Bucket, item["Key"])
+            except (OSError, botocore.exceptions.ClientError) as ex:
+                errors.append({"Key": item["Key"], "Code": "InternalError"})
+                errors[-1]["Message"] = str(ex)
+            else:
+                deleted.append({"Key": item["Key"]})
+        return {"Deleted": deleted, "Errors": errors}
+
+    async def create_multipart_upload(self, Bucket: str, Key: str, **kwargs):
+        self._check_bucket(Bucket, "CreateMultipartUpload")
+        upload_id = uuid.uuid4().hex
+        await self._run(lambda: os.makedirs(self._upload_path(Bucket, upload_id)))
+        return {"Bucket": Bucket, "Key": Key, "UploadId": upload_id}
+
+    def _part_path(self, bucket: str, upload_id: str, part_number: int) -> str:
+        upload_path = self._upload_path(bucket, upload_id)
+        if not os.path.isdir(upload_path):
+            raise _client_error("NoSuchUpload", "UploadPart")
+        return os.path.join(upload_path, str(part_number))
+
+    async def upload_part(
+        self, Bucket: str, Key: str, PartNumber: int, UploadId: str, Body, **kwargs
+    ):
+        path = self._part_path(Bucket, UploadId, PartNumber)
+        await self._run(self._write, path, Body)
+        return {"ETag": '"' + hashlib.md5(Body).hexdigest() + '"'}
+
+    def _read_range(self, path: str, start: int, end: int) -> bytes:
+        with open(path, "rb") as fi:
+            return os.pread(fi.fileno(), end - start, start)
+
+    async def upload_part_copy(
+        self,
+        Bucket: str,
+        Key: str,
+        PartNumber: int,
+        UploadId: str,
+        CopySource,
+        CopySourceRange: str,
+        **kwargs,
+    ):
+        stat = await self._run(
+            self._stat, CopySource["Bucket"], CopySource["Key"], "UploadPartCopy"
+        )
+        start, end = _parse_range(CopySourceRange, stat.st_size)
+        data = await self._run(
+            self._read_range,
+            self.object_path(CopySource["Bucket"], CopySource["Key"]),
+            start,
+            end,
+        )
+        await self._run(
+            self._write, self._part_path(Bucket, UploadId, PartNumber), data
+        )
+        return {"CopyPartResult": {"ETag": '"' + hashlib.md5(data).hexdigest() + '"'}}
+
+    def _complete(self, bucket: str, key: str, upload_id: str, parts: List[int]):
+        upload_path = self._upload_path(bucket, upload_id)
+        if not os.path.isdir(upload_path):
+            raise _client_error("NoSuchUpload", "CompleteMultipartUpload")
+        path = self.object_path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = os.path.join(os.path.dirname(path), f".{uuid.uuid4().hex}")
+        with open(tmp_path, "wb") as output:
+            for part_number in parts:
+                with open(os.path.join(upload_path, str(part_number)), "rb") as part:
+                    shutil.copyfileobj(part, output, READ_CHUNK_SIZE)
+        os.replace(tmp_path, path)
+        shutil.rmtree(upload_path)
+        return os.stat(path)
+
+    async def complete_multipart_upload(
+        self, Bucket: str, Key: str, UploadId: str, MultipartUpload, **kwargs
+    ):
+        parts = [part["PartNumber"] for part in MultipartUpload.get("Parts", [])]
+        stat = await self._run(self._complete, Bucket, Key, UploadId, parts)
+        return {"Bucket": Bucket, "Key": Key, "ETag": _etag(stat)}
+
+    async def abort_multipart_upload(
+        self, Bucket: str, Key: str, UploadId: str, **kwargs
+    ):
+        await self._run(
+            lambda: shutil.rmtree(self._upload_path(Bucket, UploadId), True)
+        )
+        return {}
+
+    def _walk(
+        self, path: str, key_prefix: str, prefix: str, after: str, rollup: bool
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Yield the objects below `path` in key order, and with `rollup` the
+        directories as common prefixes instead of their objects. Keys not
+        starting with `prefix` are skipped, but may still be yielded.
+        """
+        try:
+            entries = list(os.scandir(path))
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        names = []
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir():
+                names.append((key_prefix + _decode(entry.name) + "/", entry))
+            else:
+                names.append((key_prefix + _decode(entry.name), entry))
+        for key, entry in sorted(names, key=lambda name: name[0]):
+            if key.endswith("/"):
+                if key <= after and not after.startswith(key):
+                    continue
+                if not key.startswith(prefix) and not prefix.startswith(key):
+                    continue
+                if rollup and key.startswith(prefix):
+                    if key > after:
+                        yield {"Prefix": key}
+                    continue
+                yield from self._walk(entry.path, key, prefix, after, rollup)
+            elif key > after:
+                stat = entry.stat()
+                yield {
+                    "Key": key,
+                    "Size": stat.st_size,
+                    "ETag": _etag(stat),
+                    "LastModified": datetime.fromtimestamp(stat.st_mtime, timezone.utc),
+                }
+
+    def _list(
+        self,
+        bucket: str,
+        prefix: str,
+        delimiter: Optional[str],
+        after: str,
+        max_keys: int,
+    ) -> Dict[str, Any]:
+        self._check_bucket(bucket, "ListObjectsV2")
+        # only walk the directory the prefix points into
+        base, separator, _ = prefix.rpartition("/")
+        base_path = self._bucket_path(bucket)
+        if separator:
+            base_path = self.object_path(bucket, base)
+        key_prefix = base + separator
+        entries: List[Dict[str, Any]] = []
+        for entry in self._walk(base_path, key_prefix, prefix, after, delimiter == "/"):
+            name = entry.get("Key") or entry["Prefix"]
+            if not name.startswith(prefix):
+                if name > prefix:
+                    # keys are walked in order, none of the rest match
+                    break
+                continue
+            if len(entries) == max_keys:
+                return {
+                    "Contents": [item for item in entries if "Key" in item],
+                    "CommonPrefixes": [item for item in entries if "Prefix" in item],
+                    "IsTruncated": True,
+                    "NextContinuationToken": entries[-1].get("Key")
+                    or entries[-1]["Prefix"],
+                    "KeyCount": len(entries),
+                }
+            entries.append(entry)
+        return {
+            "Contents": [item for item in entries if "Key" in item],
+            "CommonPrefixes": [item for item in entries if "Prefix" in item],
+            "IsTruncated": False,
+            "KeyCount": len(entries),
+        }
+
+    async def list_objects_v2(
+        self,
+        Bucket: str,
+        Prefix: str = "",
+        Delimiter: Optional[str] = None,
+        StartAfter: Optional[str] = None,
+        ContinuationToken: Optional[str] = None,
+        MaxKeys: int = 1000,
+        **kwargs,
+    ):
+        after = max(ContinuationToken or "", StartAfter or "")
+        return await self._run(self._list, Bucket, Prefix, Delimiter, after, MaxKeys)
+
+    async def generate_presigned_url(self, *args, **kwargs):
+        raise _client_error("NotImplemented", "GeneratePresignedUrl")
+
+    async def close(self):
+        pass
+
+
+class LocalBlobStore(S3BlobStore):
+    """
+    Blob store keeping objects in the local `path` directory instead of S3
+    """
+
+    def __init__(self, settings, loop=None):
+        settings = {
+            "aws_client_id": None,
+            "aws_client_secret": None,
+            # buckets have no region
+            "bucket_region_routing": False,
+            **settings,
+        }
+        super().__init__(settings, loop=loop)
+        self._path = settings["path"]
+
+    async def initialize(self, app=None):
+        self.app = app
+        self._s3aioclient = LocalClient(self._path)
+        await asyncio.get_running_loop().run_in_executor(
+            None, lambda: os.makedirs(self._path, exist_ok=True)
+        )
+        if self._disk_cache is not None:
+            await self._disk_cache.initialize()
+        if self._dedup_index is not None:
+            await self._dedup_index.initialize()
+
+    def object_path(self, bucket_name: str, key: str) -> str:
+        """
+        Path of the file holding an object, to serve it with `sendfile`
+        """
+        return self._s3aioclient.object_path(bucket_name, key)
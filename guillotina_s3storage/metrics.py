@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import functools
+from typing import Any
+from typing import Mapping
+
+import botocore
+from guillotina import metrics
+
+# client methods that do not call S3
+NOT_INSTRUMENTED = frozenset(
+    ("close", "generate_presigned_url", "generate_presigned_post", "get_paginator")
+)
+
+try:
+    import prometheus_client
+
+    S3_OPS = prometheus_client.Counter(
+        "guillotina_s3storage_ops_total",
+        "Total count of S3 calls by operation and the error if there was.",
+        labelnames=["type", "error"],
+    )
+    S3_OPS_PROCESSING_TIME = prometheus_client.Histogram(
+        "guillotina_s3storage_ops_processing_time_seconds",
+        "Histogram of S3 call processing time by operation (in seconds)",
+        labelnames=["type"],
+    )
+    S3_ERRORS = prometheus_client.Counter(
+        "guillotina_s3storage_errors_total",
+        "Total count of S3 errors by operation and error code.",
+        labelnames=["type", "code"],
+    )
+    S3_RETRIES = prometheus_client.Counter(
+        "guillotina_s3storage_retries_total",
+        "Total count of retried storage calls by function.",
+        labelnames=["type"],
+    )
+    S3_BYTES = prometheus_client.Counter(
+        "guillotina_s3storage_bytes_total",
+        "Total bytes sent to and received from S3.",
+        labelnames=["direction"],
+    )
+    S3_POOL_WAIT_TIME = prometheus_client.Histogram(
+        "guillotina_s3storage_pool_wait_time_seconds",
+        "Histogram of time spent waiting for a free S3 connection by request "
+        "priority (in seconds)",
+        labelnames=["priority"],
+    )
+    CACHE_LOOKUPS = prometheus_client.Counter(
+        "guillotina_s3storage_cache_lookups_total",
+        "Total count of cache lookups by cache and result (hit or miss).",
+        labelnames=["cache", "result"],
+    )
+    STORAGE_OPS_PROCESSING_TIME = prometheus_client.Histogram(
+        "guillotina_s3storage_storage_ops_processing_time_seconds",
+        "Histogram of storage manager operation time by type (in seconds)",
+        labelnames=["type"],
+    )
+
+    class watch(metrics.watch):
+        def __init__(self, operation: str):
+            super().__init__(
+                counter=S3_OPS,
+                histogram=S3_OPS_PROCESSING_TIME,
+                labels={"type": operation},
+                error_mappings={"client_error": botocore.exceptions.ClientError},
+            )
+
+    class watch_storage(metrics.watch):
+        def __init__(self, operation: str):
+            super().__init__(
+                histogram=STORAGE_OPS_PROCESSING_TIME,
+                labels={"type": operation},
+            )
+
+    def record_error(operation: str, ex: Exception):
+        if isinstance(ex, botocore.exceptions.ClientError):
+            code = ex.response.get("Error", {}).get("Code", "unknown")
+        else:
+            code = ex.__class__.__name__
+        S3_ERRORS.labels(type=operation, code=code).inc()
+
+    def record_retry(details: Mapping[str, Any]):
+        S3_RETRIES.labels(type=details["target"].__name__).inc()
+
+    def record_bytes(direction: str, size: int):
+        S3_BYTES.labels(direction=direction).inc(size)
+
+    def record_pool_wait(priority: str, seconds: float):
+        S3_POOL_WAIT_TIME.labels(priority=priority).observe(seconds)
+
+    def record_cache_lookup(cache: str, hit: bool):
+        CACHE_LOOKUPS.labels(cache=cache, result="hit" if hit else "miss").inc()
+
+    def instrument(client):
+        return InstrumentedClient(client)
+
+except ImportError:
+
+    class watch:  # type: ignore
+        def __init__(self, operation: str):
+            pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc_value, traceback):
+            pass
+
+    watch_storage = watch  # type: ignore
+
+    def record_error(operation: str, ex: Exception):
+        pass
+
+    def record_retry(details: Mapping[str, Any]):
+        pass
+
+    def record_bytes(direction: str, size: int):
+        pass
+
+    def record_pool_wait(priority: str, seconds: float):
+        pass
+
+    def record_cache_lookup(cache: str, hit: bool):
+        pass
+
+    def instrument(client):
+        return client
+
+
+def timed(operation: str):
+    """
+    Record the processing time of a storage manager coroutine
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with watch_storage(operation):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class InstrumentedClient:
+    """
+    Proxy of an aiobotocore client recording the latency, errors and bytes
+    transferred of every S3 call
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._client, name)
+        if name in NOT_INSTRUMENTED or not asyncio.iscoroutinefunction(attr):
+            return attr
+
+        async def call(*args, **kwargs):
+            body = kwargs.get("Body")
+            if isinstance(body, (bytes, bytearray, memoryview)):
+                record_bytes("sent", len(body))
+            try:
+                with watch(name):
+                    result = await attr(*args, **kwargs)
+            except Exception as ex:
+                record_error(name, ex)
+                raise
+            if name == "get_object":
+                record_bytes("received", result.get("ContentLength", 0))
+            return result
+
+        return call
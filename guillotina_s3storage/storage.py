@@ -1,20 +1,31 @@
 # -*- coding: utf-8 -*-
 import asyncio
+import collections
 import contextlib
+import hashlib
+import itertools
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 from typing import Any
+from typing import AsyncIterable
 from typing import AsyncIterator
+from typing import Callable
+from typing import Deque
 from typing import Dict
+from typing import Iterable
 from typing import List
 from typing import Optional
+from typing import Set
 from typing import Tuple
+from typing import Union
 
 import aiohttp
 import backoff
 import botocore
+from aiobotocore.config import AioConfig
 from aiobotocore.session import get_session
-from botocore.config import Config
 from guillotina import configure
 from guillotina import task_vars
 from guillotina.component import get_utility
@@ -30,27 +41,213 @@ from guillotina.interfaces import IResource
 from guillotina.interfaces.files import IBlobVacuum  # type: ignore
 from guillotina.response import HTTPNotFound
 from guillotina.response import HTTPPreconditionFailed
+from guillotina.utils import resolve_dotted_name
 from zope.interface import implementer
 
 from guillotina.schema import Object
+from guillotina_s3storage import checksums
+from guillotina_s3storage import compression
+from guillotina_s3storage import dedup
+from guillotina_s3storage import metrics
+from guillotina_s3storage.cache import DiskCache
+from guillotina_s3storage.cache import LRUSet
+from guillotina_s3storage.cache import MemoryCache
+from guillotina_s3storage.cache import RangeCache
+from guillotina_s3storage.cache import TTLCache
 from guillotina_s3storage.interfaces import IS3BlobStore
 from guillotina_s3storage.interfaces import IS3File
 from guillotina_s3storage.interfaces import IS3FileField
+from guillotina_s3storage.utils import BACKGROUND
+from guillotina_s3storage.utils import Broadcast
+from guillotina_s3storage.utils import BufferPool
+from guillotina_s3storage.utils import INTERACTIVE
+from guillotina_s3storage.utils import MAINTENANCE
+from guillotina_s3storage.utils import PriorityLimiter
+from guillotina_s3storage.utils import SingleFlight
+from guillotina_s3storage.utils import request_priority
+from guillotina_s3storage.vacuum import BlobVacuum
+from guillotina_s3storage.vacuum import VacuumResult
 
 log = logging.getLogger("guillotina_s3storage")
 
 MAX_SIZE = 1073741824
 DEFAULT_MAX_POOL_CONNECTIONS = 30
+DEFAULT_CLIENTS = 1
+# botocore defaults
+DEFAULT_CONNECT_TIMEOUT = 60
+DEFAULT_READ_TIMEOUT = 60
+DEFAULT_UPLOAD_CONCURRENCY = 1
+DEFAULT_DOWNLOAD_CONCURRENCY = 1
+DEFAULT_DOWNLOAD_RANGE_SIZE = 8 * 1024 * 1024
+DEFAULT_DOWNLOAD_RESUME_ATTEMPTS = 3
+DEFAULT_COPY_CONCURRENCY = 10
+DEFAULT_MULTIPART_COPY_THRESHOLD = MAX_SIZE
+DEFAULT_MULTIPART_COPY_PART_SIZE = 256 * 1024 * 1024
+MAX_COPY_OBJECT_SIZE = 5 * 1024 * 1024 * 1024
+MAX_PUT_OBJECT_SIZE = 5 * 1024 * 1024 * 1024
+MAX_MULTIPART_PARTS = 10000
+DEFAULT_BUCKET_ACCESSIBLE_TTL = 60
+DEFAULT_BUCKET_INACCESSIBLE_TTL = 10
+DEFAULT_BUCKET_CACHE_SIZE = 10000
+DEFAULT_BUCKET_REGION_TTL = 3600
 
 MIN_UPLOAD_SIZE = 5 * 1024 * 1024
 CHUNK_SIZE = MIN_UPLOAD_SIZE
 MAX_RETRIES = 5
+# DeleteObjects accepts at most 1000 keys per call
+MAX_DELETE_OBJECTS_KEYS = 1000
+DEFAULT_DELETE_CONCURRENCY = 4
+DEFAULT_LIST_CONCURRENCY = 1
+DEFAULT_COALESCE_BUFFER_CHUNKS = 4
+# idle upload part buffers kept for reuse
+DEFAULT_PART_BUFFER_POOL_SIZE = 64 * 1024 * 1024
+DEFAULT_CHECKSUM_THREADS = 4
+DEFAULT_DEDUP_INDEX = "guillotina_s3storage.dedup.SQLiteIndex"
+# how long the digest of an upload is kept between two of its requests
+DEFAULT_DEDUP_UPLOAD_TTL = 3600
+DEFAULT_DEDUP_MAX_UPLOADS = 10000
+# listed pages buffered per shard while iterating a bucket in parallel
+LIST_SHARD_BUFFER_PAGES = 2
+DELETE_RETRY_DELAY = 0.5
+# per-key DeleteObjects errors worth retrying
+RETRIABLE_DELETE_ERRORS = frozenset(
+    ("SlowDown", "InternalError", "ServiceUnavailable", "RequestTimeout")
+)
 
 RETRIABLE_EXCEPTIONS = (
     botocore.exceptions.ClientError,
     aiohttp.client_exceptions.ClientPayloadError,
     botocore.exceptions.BotoCoreError,
 )
+# connection errors while streaming a body, after which it can be resumed
+RESUMABLE_DOWNLOAD_EXCEPTIONS = (
+    aiohttp.client_exceptions.ClientPayloadError,
+    aiohttp.client_exceptions.ClientConnectionError,
+    asyncio.TimeoutError,
+)
+
+
+def _is_precondition_error(ex: Exception) -> bool:
+    """
+    Failed If-Match / If-None-Match conditions, which retrying cannot fix
+    """
+    return isinstance(ex, botocore.exceptions.ClientError) and ex.response.get(
+        "Error", {}
+    ).get("Code") in ("304", "NotModified", "412", "PreconditionFailed")
+
+
+def _parse_range(value: str, size: int) -> Tuple[int, int]:
+    """
+    Turn a `bytes=start-end` header into python (start, end) offsets
+    """
+    start, _, end = value.split("bytes=")[-1].partition("-")
+    return int(start), int(end) + 1 if end else size
+
+
+def _get_part_size(declared_size: Optional[int], min_part_size: int) -> int:
+    """
+    Size of the parts an upload is split into: `min_part_size`, grown in
+    whole megabytes when needed to fit `declared_size` within the
+    multipart upload part limit.
+    """
+    part_size = max(min_part_size, MIN_UPLOAD_SIZE)
+    if declared_size:
+        needed = -(-declared_size // MAX_MULTIPART_PARTS)
+        part_size = max(part_size, -(-needed // (1024 * 1024)) * 1024 * 1024)
+    return part_size
+
+
+async def _coalesce_parts(
+    iterable: AsyncIterator[bytes], part_size: int, buffers: BufferPool
+) -> AsyncIterator[Union[bytes, bytearray]]:
+    """
+    Regroup incoming chunks into parts of at least `part_size` bytes; only
+    the last part may be smaller.
+
+    Full parts are copied straight into buffers taken from `buffers`, to be
+    released once uploaded. Chunks making a whole part on their own are
+    passed through untouched.
+    """
+    chunks: Deque[Union[bytes, memoryview]] = collections.deque()
+    buffered = 0
+    async for chunk in iterable:
+        if not chunks and len(chunk) >= part_size:
+            yield chunk
+            continue
+        chunks.append(chunk)
+        buffered += len(chunk)
+        while buffered >= part_size:
+            buffer = buffers.acquire(part_size)
+            filled = 0
+            while filled < part_size:
+                view = memoryview(chunks[0])
+                size = min(len(view), part_size - filled)
+                buffer[filled : filled + size] = view[:size]
+                filled += size
+                if size == len(view):
+                    chunks.popleft()
+                else:
+                    chunks[0] = view[size:]
+            buffered -= part_size
+            yield buffer
+    if chunks:
+        yield b"".join(chunks)
+
+
+async def _chain(first: bytes, iterable: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    yield first
+    async for chunk in iterable:
+        yield chunk
+
+
+async def _split_frames(
+    iterable: AsyncIterator[bytes], frame_size: int
+) -> AsyncIterator[Union[bytes, bytearray, memoryview]]:
+    """
+    Regroup incoming chunks into frames of `frame_size` bytes; only the
+    last frame may be smaller. Frames within large chunks are views of them.
+    """
+    pending = bytearray()
+    async for chunk in iterable:
+        view = memoryview(chunk)
+        if pending:
+            needed = frame_size - len(pending)
+            pending += view[:needed]
+            view = view[needed:]
+            if len(pending) < frame_size:
+                continue
+            yield pending
+            pending = bytearray()
+        while len(view) >= frame_size:
+            yield view[:frame_size]
+            view = view[frame_size:]
+        pending += view
+    if pending:
+        yield pending
+
+
+async def _read_body(downloader) -> bytearray:
+    """
+    Read a whole response body into a single buffer allocated upfront,
+    instead of collecting its chunks and joining them
+    """
+    size = downloader["ContentLength"]
+    buffer = bytearray(size)
+    offset = 0
+    with memoryview(buffer) as view:
+        async with downloader["Body"] as stream:
+            async for data, _ in stream.content.iter_chunks():
+                if offset + len(data) > size:
+                    raise aiohttp.ClientPayloadError(
+                        f"Response body longer than {size} bytes"
+                    )
+                view[offset : offset + len(data)] = data
+                offset += len(data)
+    if offset != size:
+        raise aiohttp.ClientPayloadError(
+            f"Response body of {offset} bytes, expected {size}"
+        )
+    return buffer
 
 
 class IS3FileStorageManager(IExternalFileStorageManager):
@@ -61,6 +258,20 @@ class S3Exception(Exception):
     pass
 
 
+async def _gather_bounded(aws, limit: int) -> List[Any]:
+    """
+    Await `aws` with at most `limit` running at once, like
+    `asyncio.gather(..., return_exceptions=True)`.
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(aw):
+        async with semaphore:
+            return await aw
+
+    return await asyncio.gather(*(run(aw) for aw in aws), return_exceptions=True)
+
+
 @implementer(IS3File)
 class S3File(BaseCloudFile):
     """File stored in a S3, with a filename."""
@@ -98,29 +309,365 @@ class S3FileStorageManager:
         cleanup = IFileCleanup(self.context, None)
         return cleanup is None or cleanup.should_clean(file=file, field=self.field)
 
-    @backoff.on_exception(backoff.expo, RETRIABLE_EXCEPTIONS, max_tries=3)
+    @backoff.on_exception(
+        backoff.expo,
+        RETRIABLE_EXCEPTIONS,
+        max_tries=3,
+        giveup=_is_precondition_error,
+        on_backoff=metrics.record_retry,
+    )
     async def _download(self, uri, bucket=None, **kwargs):
         util = get_utility(IS3BlobStore)
         if bucket is None:
             bucket = await util.get_bucket_name()
-        async with util.s3_client() as client:
+        async with util.s3_client(bucket_name=bucket) as client:
             return await client.get_object(Bucket=bucket, Key=uri, **kwargs)
 
-    async def iter_data(self, uri=None, **kwargs):
+    @backoff.on_exception(
+        backoff.expo,
+        RETRIABLE_EXCEPTIONS,
+        max_tries=3,
+        on_backoff=metrics.record_retry,
+    )
+    async def _download_range(self, uri, bucket, start: int, end: int) -> bytearray:
+        util = get_utility(IS3BlobStore)
+        async with util.s3_client(bucket_name=bucket) as client:
+            downloader = await client.get_object(
+                Bucket=bucket, Key=uri, Range=f"bytes={start}-{end - 1}"
+            )
+        return await _read_body(downloader)
+
+    async def _get_object_size(self, uri, bucket) -> int:
+        util = get_utility(IS3BlobStore)
+        async with util.s3_client(bucket_name=bucket) as client:
+            result = await client.head_object(Bucket=bucket, Key=uri)
+        return result["ContentLength"]
+
+    async def _iter_ranges(
+        self, uri, bucket, start: int, end: int, range_size: int, concurrency: int
+    ) -> AsyncIterator[bytearray]:
+        """
+        Download bytes `start` to `end` as concurrent ranged GETs.
+
+        Ranges are yielded in order; no more than `concurrency` ranges are
+        in flight or waiting to be consumed at any time.
+        """
+        offsets = iter(range(start, end, range_size))
+        pending: Deque[asyncio.Future] = collections.deque()
+
+        def schedule(offset):
+            pending.append(
+                asyncio.ensure_future(
+                    self._download_range(
+                        uri, bucket, offset, min(offset + range_size, end)
+                    )
+                )
+            )
+
+        try:
+            for offset in itertools.islice(offsets, concurrency):
+                schedule(offset)
+            while pending:
+                data = await pending.popleft()
+                next_offset = next(offsets, None)
+                if next_offset is not None:
+                    schedule(next_offset)
+                yield data
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def iter_data(self, uri=None, accept_encoding=None, **kwargs):
+        """
+        Iterate over the data of the file, or of the object at `uri`.
+
+        Compressed files are decompressed, unless `accept_encoding` (an
+        `Accept-Encoding` header) accepts their `content_encoding`: their
+        `encoded_size` bytes are then sent as they are stored.
+        """
+        size = None
+        file = None
         if uri is None:
             file = self.field.query(self.field.context or self.context, None)
             if not _is_uploaded_file(file):
                 raise FileNotFoundException("File not found")
             else:
                 uri = file.uri
+                size = file.size
+
+        encoding = getattr(file, "content_encoding", None)
+        start, end, frame_start = 0, None, 0
+        if encoding is not None:
+            size = file.encoded_size
+            if "Range" in kwargs:
+                start, end = _parse_range(kwargs.pop("Range"), file.size)
+                frame_start, encoded_start, encoded_end = compression.frame_range(
+                    file.encoded_frames, start, end
+                )
+                if encoded_end is not None:
+                    if encoded_end <= encoded_start:
+                        return
+                    kwargs["Range"] = f"bytes={encoded_start}-{encoded_end - 1}"
+            elif compression.accepts(accept_encoding, encoding):
+                encoding = None
+
+        util = get_utility(IS3BlobStore)
+        bucket = await util.get_bucket_name()
+        disk_cache = util._disk_cache
+        if disk_cache is not None and (not size or size <= disk_cache.max_object_size):
+            source = self._iter_disk_cached(disk_cache, uri, bucket, **kwargs)
+        elif util._coalesce_downloads:
+            source = self._iter_shared(uri, bucket, size, **kwargs)
+        else:
+            source = self._iter_object(uri, bucket, size, **kwargs)
+
+        algorithm = getattr(file, "checksum_algorithm", None)
+        if (
+            util._verify_checksums
+            and "Range" not in kwargs
+            and algorithm in checksums.HASHERS
+            and getattr(file, "checksum", None)
+        ):
+            source = self._iter_verified(
+                source, uri, algorithm, file.checksum, file.part_sizes
+            )
+
+        memory_cache = util._memory_cache
+        if (
+            memory_cache is not None
+            and "Range" not in kwargs
+            and (size is None or size <= memory_cache.max_object_size)
+        ):
+            source = self._iter_memory_cached(memory_cache, uri, bucket, size, source)
+        if encoding is not None:
+            source = self._iter_decoded(
+                source,
+                encoding,
+                start - frame_start,
+                None if end is None else end - frame_start,
+            )
+        async for data in source:
+            yield data
 
-        downloader = await self._download(uri, **kwargs)
+    async def _iter_decoded(
+        self, source, codec: str, start: int = 0, end: Optional[int] = None
+    ) -> AsyncIterator[bytes]:
+        """
+        Decompress the frames read from `source`, yielding bytes `start` to
+        `end` of the decompressed data
+        """
+        util = get_utility(IS3BlobStore)
+        decoder = compression.StreamDecoder(codec)
+        offset = 0
+        try:
+            async for data in source:
+                data = await util._run_compression(decoder.decompress, data)
+                if end is not None and offset + len(data) >= end:
+                    yield data[max(start - offset, 0) : end - offset]
+                    return
+                if offset + len(data) > start:
+                    yield data[max(start - offset, 0) :]
+                offset += len(data)
+        finally:
+            await source.aclose()
+        if not decoder.complete:
+            raise S3Exception("Compressed data ended in the middle of a frame")
+
+    async def _iter_verified(
+        self, source, uri, algorithm: str, checksum: str, part_sizes: List[int]
+    ) -> AsyncIterator[bytes]:
+        """
+        Check the data read from `source` against the checksum stored on the
+        file, hashing each chunk in a thread while the next one is read
+        """
+        util = get_utility(IS3BlobStore)
+        verifier = checksums.ChecksumVerifier(algorithm, part_sizes)
+        hashing = None
+        async for data in source:
+            if hashing is not None:
+                await hashing
+            hashing = util._run_checksum(verifier.update, data)
+            yield data
+        if hashing is not None:
+            await hashing
+        if not verifier.matches(checksum):
+            raise S3Exception(f"Checksum mismatch downloading {uri}")
+
+    async def _iter_memory_cached(
+        self, memory_cache: MemoryCache, uri, bucket, size, source
+    ) -> AsyncIterator[bytes]:
+        """
+        Serve small objects from memory, keeping the ones read from `source`
+        """
+        data = memory_cache.get(bucket, uri)
+        if data is not None:
+            yield data
+            return
+        if size is None:
+            async for data in source:
+                yield data
+            return
+        chunks = []
+        async for data in source:
+            chunks.append(data)
+            yield data
+        data = b"".join(chunks)
+        if len(data) == size:
+            memory_cache.set(bucket, uri, data)
+
+    async def _iter_object(self, uri, bucket, size=None, **kwargs):
+        util = get_utility(IS3BlobStore)
+        if util._download_concurrency > 1 and "Range" not in kwargs:
+            if not size:
+                size = await self._get_object_size(uri, bucket)
+            if size > util._download_range_size:
+                async for data in self._iter_ranges(
+                    uri,
+                    bucket,
+                    0,
+                    size,
+                    util._download_range_size,
+                    util._download_concurrency,
+                ):
+                    yield data
+                return
+
+        downloader = await self._download(uri, bucket, **kwargs)
 
         # we do not want to timeout ever from this...
         # downloader['Body'].set_socket_timeout(999999)
-        async with downloader["Body"] as stream:
-            async for data in stream.content.iter_chunked(CHUNK_SIZE):
+        async for data in self._iter_body(uri, bucket, downloader, **kwargs):
+            yield data
+
+    async def _iter_body(self, uri, bucket, downloader, **kwargs):
+        """
+        Stream the body of a GET made with `kwargs`.
+
+        When the connection breaks mid-way, the rest is requested from the
+        last byte delivered, with If-Match on the ETag of the first response
+        so that a newer version of the object is never spliced in. Up to
+        `download_resume_attempts` times per download.
+        """
+        util = get_utility(IS3BlobStore)
+        start, _, end = (
+            kwargs.get("Range", "bytes=0-").split("bytes=")[-1].partition("-")
+        )
+        offset = int(start)
+        resumes = 0
+        while True:
+            async with downloader["Body"] as stream:
+                chunks = stream.content.iter_chunked(CHUNK_SIZE).__aiter__()
+                while True:
+                    try:
+                        data = await chunks.__anext__()
+                    except StopAsyncIteration:
+                        return
+                    except RESUMABLE_DOWNLOAD_EXCEPTIONS as ex:
+                        error = ex
+                        break
+                    offset += len(data)
+                    yield data
+            if resumes >= util._download_resume_attempts or not downloader.get("ETag"):
+                raise error
+            resumes += 1
+            metrics.record_retry({"target": self._iter_body})
+            log.info(f"Resuming download of {uri} from byte {offset}: {error!r}")
+            kwargs.pop("IfNoneMatch", None)
+            kwargs.update(Range=f"bytes={offset}-{end}", IfMatch=downloader["ETag"])
+            downloader = await self._download(uri, bucket, **kwargs)
+
+    async def _iter_shared(self, uri, bucket, size=None, **kwargs):
+        """
+        Share one download between the readers of the same object and range
+        that start reading it at the same time
+        """
+        util = get_utility(IS3BlobStore)
+        key = (bucket, uri, tuple(sorted(kwargs.items())))
+        broadcast = util._shared_downloads.get(key)
+        if broadcast is None or not broadcast.joinable:
+            broadcast = Broadcast(
+                self._iter_object(uri, bucket, size, **kwargs),
+                util._coalesce_buffer_chunks,
+            )
+            util._shared_downloads[key] = broadcast
+        subscription = broadcast.subscribe()
+
+        offset = 0
+        try:
+            while True:
+                data = await subscription.get()
+                if data is Broadcast.DONE:
+                    return
+                if data is None:
+                    break
+                offset += len(data)
                 yield data
+        finally:
+            broadcast.unsubscribe(subscription)
+            if not broadcast.joinable and util._shared_downloads.get(key) is broadcast:
+                del util._shared_downloads[key]
+
+        # too slow to keep up with the others, read the rest on our own
+        start, _, end = (
+            kwargs.get("Range", "bytes=0-").split("bytes=")[-1].partition("-")
+        )
+        kwargs["Range"] = f"bytes={int(start) + offset}-{end}"
+        async for data in self._iter_object(uri, bucket, **kwargs):
+            yield data
+
+    async def _iter_disk_cached(self, disk_cache: DiskCache, uri, bucket, **kwargs):
+        """
+        Serve data from the local disk cache, filling it on full downloads
+        """
+        entry = disk_cache.get(bucket, uri)
+        if "Range" in kwargs:
+            if entry is not None and disk_cache.is_fresh(entry):
+                start, end = _parse_range(kwargs["Range"], entry.size)
+                file = await disk_cache.open(entry)
+                if file is not None:
+                    async for data in disk_cache.read(file, start, end):
+                        yield data
+                    return
+            async for data in self._iter_object(uri, bucket, **kwargs):
+                yield data
+            return
+
+        downloader = None
+        if entry is not None:
+            if not disk_cache.is_fresh(entry):
+                try:
+                    downloader = await self._download(
+                        uri, bucket, IfNoneMatch=entry.etag
+                    )
+                except botocore.exceptions.ClientError as ex:
+                    if not _is_precondition_error(ex):
+                        raise
+                    disk_cache.validated(entry)
+            if downloader is None:
+                file = await disk_cache.open(entry)
+                if file is not None:
+                    async for data in disk_cache.read(file, 0, entry.size):
+                        yield data
+                    return
+        if downloader is None:
+            downloader = await self._download(uri, bucket)
+
+        writer = None
+        if downloader["ContentLength"] <= disk_cache.max_object_size:
+            writer = disk_cache.writer(
+                bucket, uri, downloader["ETag"], downloader["ContentLength"]
+            )
+        try:
+            async for data in self._iter_body(uri, bucket, downloader):
+                if writer is not None:
+                    await writer.write(data)
+                yield data
+            if writer is not None:
+                await writer.commit()
+                writer = None
+        finally:
+            if writer is not None:
+                await writer.abort()
 
     async def range_supported(self) -> bool:
         return True
@@ -129,91 +676,525 @@ class S3FileStorageManager:
         """
         Iterate through ranges of data
         """
-        async for chunk in self.iter_data(Range=f"bytes={start}-{end - 1}"):
+        util = get_utility(IS3BlobStore)
+        file = self.field.query(self.field.context or self.context, None)
+        if (
+            util._range_cache is None
+            or not _is_uploaded_file(file)
+            or not file.size
+            # ranges of compressed files are decompressed from their frames
+            or getattr(file, "content_encoding", None) is not None
+        ):
+            async for chunk in self.iter_data(Range=f"bytes={start}-{end - 1}"):
+                yield chunk
+            return
+
+        bucket = await util.get_bucket_name()
+        async for chunk in self._iter_range_cached(
+            util._range_cache, file.uri, bucket, start, min(end, file.size), file.size
+        ):
             yield chunk
 
-    async def delete_upload(self, uri, bucket=None):
+    async def _iter_range_cached(
+        self, range_cache: RangeCache, uri, bucket, start: int, end: int, size: int
+    ) -> AsyncIterator[bytes]:
+        """
+        Serve bytes `start` to `end` from cached blocks, fetching missing
+        blocks and reading ahead the ones that follow
+        """
+        block_size = range_cache.block_size
+        first = start // block_size
+        last = (end - 1) // block_size
+        for block in range(last + 1, last + 1 + range_cache.read_ahead):
+            if block * block_size >= size:
+                break
+            if range_cache.get_block(bucket, uri, block) is None:
+                task = asyncio.ensure_future(
+                    self._read_ahead(range_cache, uri, bucket, block, size)
+                )
+                range_cache.read_aheads.add(task)
+                task.add_done_callback(range_cache.read_aheads.discard)
+
+        for block in range(first, last + 1):
+            data = range_cache.get_block(bucket, uri, block)
+            if data is None:
+                data = await range_cache.fetches.do(
+                    (bucket, uri, block),
+                    self._fetch_block,
+                    range_cache,
+                    uri,
+                    bucket,
+                    block,
+                    size,
+                )
+            offset = block * block_size
+            yield data[max(start - offset, 0) : end - offset]
+
+    async def _fetch_block(
+        self, range_cache: RangeCache, uri, bucket, block: int, size: int
+    ) -> bytearray:
+        start = block * range_cache.block_size
+        byte_range = f"bytes={start}-{min(start + range_cache.block_size, size) - 1}"
+        etag = range_cache.get_etag(bucket, uri)
+        try:
+            if etag is None:
+                downloader = await self._download(uri, bucket, Range=byte_range)
+            else:
+                downloader = await self._download(
+                    uri, bucket, Range=byte_range, IfMatch=etag
+                )
+        except botocore.exceptions.ClientError as ex:
+            if etag is None or not _is_precondition_error(ex):
+                raise
+            # the object changed since its blocks were cached
+            range_cache.invalidate(bucket, uri)
+            downloader = await self._download(uri, bucket, Range=byte_range)
+        data = await _read_body(downloader)
+        range_cache.set_block(bucket, uri, downloader["ETag"], block, data)
+        return data
+
+    async def _read_ahead(
+        self, range_cache: RangeCache, uri, bucket, block: int, size: int
+    ):
+        try:
+            await range_cache.fetches.do(
+                (bucket, uri, block),
+                self._fetch_block,
+                range_cache,
+                uri,
+                bucket,
+                block,
+                size,
+            )
+        except Exception:
+            log.info(f"Could not read ahead block {block} of {uri}", exc_info=True)
+
+    async def delete_upload(self, uri, bucket=None, digest=None):
         util = get_utility(IS3BlobStore)
         if bucket is None:
             bucket = await util.get_bucket_name()
+        if uri is not None and digest is not None and util._dedup_index is not None:
+            # objects shared by deduplicated files are only deleted with
+            # their last reference
+            index = util._dedup_index
+            txn = task_vars.txn.get()
+            if index.transactional:
+                remaining = await index.release(bucket, digest, uri)
+                if remaining is not None:
+                    if remaining == 0:
+                        txn.add_after_commit_hook(self._delete_released, uri, bucket)
+                    return
+            elif txn is not None:
+                # the index is not part of the transaction, which may abort
+                # or be retried: release once it is committed
+                txn.add_after_commit_hook(self._delete_released, uri, bucket, digest)
+                return
+            elif await index.release(bucket, digest, uri):
+                return
         if uri is not None:
+            if util._disk_cache is not None:
+                util._disk_cache.invalidate(bucket, uri)
+            if util._range_cache is not None:
+                util._range_cache.invalidate(bucket, uri)
+            if util._memory_cache is not None:
+                util._memory_cache.invalidate(bucket, uri)
             try:
-                async with util.s3_client() as client:
+                async with util.s3_client(bucket_name=bucket) as client:
                     await client.delete_object(Bucket=bucket, Key=uri)
             except botocore.exceptions.ClientError:
                 log.warn("Error deleting object", exc_info=True)
         else:
             raise AttributeError("No valid uri")
 
+    async def _delete_released(self, status, uri, bucket, digest=None):
+        if not status:
+            return
+        util = get_utility(IS3BlobStore)
+        if digest is not None and await util._dedup_index.release(bucket, digest, uri):
+            return
+        await self.delete_upload(uri, bucket)
+
     async def _abort_multipart(self, dm):
         util = get_utility(IS3BlobStore)
         try:
             mpu = dm.get("_mpu")
             upload_file_id = dm.get("_upload_file_id")
             bucket_name = dm.get("_bucket_name")
-            async with util.s3_client() as client:
+            async with util.s3_client(bucket_name=bucket_name) as client:
                 await client.abort_multipart_upload(
                     Bucket=bucket_name, Key=upload_file_id, UploadId=mpu["UploadId"]
                 )
         except Exception:
             log.warn("Could not abort multipart upload", exc_info=True)
 
+    @metrics.timed("start")
     async def start(self, dm):
         util = get_utility(IS3BlobStore)
         upload_file_id = dm.get("_upload_file_id")
         if upload_file_id is not None:
             if dm.get("_mpu") is not None:
                 await self._abort_multipart(dm)
+            elif dm.get("_single_put"):
+                await self.delete_upload(upload_file_id, dm.get("_bucket_name"))
 
         bucket_name = await util.get_bucket_name()
         upload_id = generate_key(self.context)
+        content_encoding = None
+        if util._compression is not None:
+            content_encoding = util._compression.codec_for(dm.get("content_type"))
+        hashed = None
+        if util._dedup_index is not None:
+            # digest of the data, as it is appended
+            util._upload_digests.set(upload_id, (hashlib.sha256(), 0))
+            hashed = 0
+        if util._single_put_threshold > 0:
+            # the multipart upload is only created if the data outgrows
+            # the threshold, see _append_buffered
+            await dm.update(
+                _bucket_name=bucket_name,
+                _upload_file_id=upload_id,
+                _multipart={"Parts": []},
+                _block=1,
+                _mpu=None,
+                _single_put=False,
+                _put_checksum=None,
+                _frames=[],
+                _tail=None,
+                checksum_algorithm=util._checksum_algorithm,
+                content_encoding=content_encoding,
+                _hashed=hashed,
+            )
+            return
         await dm.update(
             _bucket_name=bucket_name,
             _upload_file_id=upload_id,
             _multipart={"Parts": []},
             _block=1,
             _mpu=await self._create_multipart(bucket_name, upload_id),
+            _frames=[],
+            _tail=None,
+            checksum_algorithm=util._checksum_algorithm,
+            content_encoding=content_encoding,
+            _hashed=hashed,
         )
 
-    @backoff.on_exception(backoff.expo, RETRIABLE_EXCEPTIONS, max_tries=3)
+    @backoff.on_exception(
+        backoff.expo,
+        RETRIABLE_EXCEPTIONS,
+        max_tries=3,
+        on_backoff=metrics.record_retry,
+    )
     async def _create_multipart(self, bucket_name, upload_id):
         util = get_utility(IS3BlobStore)
-        async with util.s3_client() as client:
+        async with util.s3_client(bucket_name=bucket_name) as client:
             return await client.create_multipart_upload(
-                Bucket=bucket_name, Key=upload_id
+                Bucket=bucket_name,
+                Key=upload_id,
+                **checksums.multipart_parameters(util._checksum_algorithm),
             )
 
+    @metrics.timed("append")
     async def append(self, dm, iterable, offset) -> int:
-        size = 0
+        if dm.get("_hashed") is not None:
+            iterable = self._iter_hashed(dm, iterable)
+        if dm.get("_mpu") is None and dm.get("_single_put") is not None:
+            return await self._append_buffered(dm, iterable, offset)
+        return await self._append_parts(dm, iterable)
+
+    async def _iter_hashed(self, dm, iterable) -> AsyncIterator[bytes]:
+        """
+        Hash `iterable`, in a thread while the previous chunk is stored,
+        into the digest of the upload. Uploads whose earlier requests were
+        handled by another process, or failed, are not deduplicated.
+        """
+        util = get_utility(IS3BlobStore)
+        upload_id = dm.get("_upload_file_id")
+        hasher, hashed = util._upload_digests.get(upload_id, (None, None))
+        if hasher is None or hashed != dm.get("_hashed"):
+            util._upload_digests.invalidate(upload_id)
+            await dm.update(_hashed=None)
+            async for chunk in iterable:
+                yield chunk
+            return
+        # only a complete append leaves the hasher usable
+        util._upload_digests.set(upload_id, (hasher, None))
+        hashing = None
         async for chunk in iterable:
-            size += len(chunk)
-            part = await self._upload_part(dm, chunk)
-            multipart = dm.get("_multipart")
-            multipart["Parts"].append(
-                {"PartNumber": dm.get("_block"), "ETag": part["ETag"]}
+            if hashing is not None:
+                await hashing
+            hashing = util._run_checksum(hasher.update, chunk)
+            hashed += len(chunk)
+            yield chunk
+        if hashing is not None:
+            await hashing
+        util._upload_digests.set(upload_id, (hasher, hashed))
+        await dm.update(_hashed=hashed)
+
+    async def _append_buffered(self, dm, iterable, offset) -> int:
+        """
+        Buffer uploads of up to `single_put_threshold` bytes to store them
+        with a single put_object. Larger uploads, and the first chunks of
+        uploads sent over several requests, become a multipart upload.
+        """
+        util = get_utility(IS3BlobStore)
+        chunks: List[bytes] = []
+        previous = 0
+        if dm.get("_single_put"):
+            # more data arrived for an upload of unknown size that looked
+            # complete: carry on from what was stored
+            stored = self._iter_object(
+                dm.get("_upload_file_id"), dm.get("_bucket_name")
             )
-            await dm.update(_multipart=multipart, _block=dm.get("_block") + 1)
+            if dm.get("content_encoding") is not None:
+                stored = self._iter_decoded(stored, dm.get("content_encoding"))
+            chunks.append(b"".join([data async for data in stored]))
+            previous = len(chunks[0])
+
+        buffered = previous
+        iterator = iterable.__aiter__()
+        async for chunk in iterator:
+            chunks.append(chunk)
+            buffered += len(chunk)
+            if buffered > util._single_put_threshold:
+                break
+        else:
+            declared_size = dm.get("size")
+            if declared_size is None:
+                complete = offset == previous
+            else:
+                complete = offset - previous + buffered >= declared_size
+            if complete:
+                await self._put_object(dm, await self._encode(dm, b"".join(chunks)))
+                await dm.update(_single_put=True)
+                return buffered - previous
+
+        await dm.update(
+            _mpu=await self._create_multipart(
+                dm.get("_bucket_name"), dm.get("_upload_file_id")
+            ),
+            _single_put=None,
+            _put_checksum=None,
+            _frames=[],
+            _tail=None,
+        )
+
+        async def replay():
+            for chunk in chunks:
+                yield chunk
+            async for chunk in iterator:
+                yield chunk
+
+        return await self._append_parts(dm, replay()) - previous
+
+    @backoff.on_exception(
+        backoff.expo,
+        RETRIABLE_EXCEPTIONS,
+        max_tries=3,
+        on_backoff=metrics.record_retry,
+    )
+    async def _put_object(self, dm, data):
+        util = get_utility(IS3BlobStore)
+        checksum = await self._checksum(dm, data)
+        async with util.s3_client(bucket_name=dm.get("_bucket_name")) as client:
+            result = await client.put_object(
+                Bucket=dm.get("_bucket_name"),
+                Key=dm.get("_upload_file_id"),
+                Body=data,
+                **checksums.request_parameters(dm.get("checksum_algorithm"), checksum),
+            )
+        await dm.update(_put_checksum={"Size": len(data), "Checksum": checksum})
+        return result
+
+    async def _encode(self, dm, data: bytes) -> bytes:
+        """
+        Compress the whole data of a single put, recording its frames
+        """
+        codec = dm.get("content_encoding")
+        if codec is None:
+            return data
+        util = get_utility(IS3BlobStore)
+        encoded, frames = await util._run_compression(
+            util._compression.compress_frames, codec, data
+        )
+        await dm.update(_frames=frames)
+        return encoded
+
+    async def _iter_encoded(self, dm, iterable) -> AsyncIterator[bytes]:
+        """
+        Compress `iterable` in independent frames, up to one per
+        compression thread at a time, recording the decompressed and
+        compressed size of each frame in `_frames`
+        """
+        util = get_utility(IS3BlobStore)
+        codec = dm.get("content_encoding")
+        frames = dm.get("_frames")
+        pending: Deque[Tuple[int, asyncio.Future]] = collections.deque()
+        try:
+            async for frame in _split_frames(iterable, util._compression.frame_size):
+                pending.append(
+                    (
+                        len(frame),
+                        util._run_compression(util._compression.compress, codec, frame),
+                    )
+                )
+                if len(pending) >= util._compression.threads:
+                    size, encoding = pending.popleft()
+                    encoded = await encoding
+                    frames.append([size, len(encoded)])
+                    yield encoded
+            while pending:
+                size, encoding = pending.popleft()
+                encoded = await encoding
+                frames.append([size, len(encoded)])
+                yield encoded
+        finally:
+            for _, encoding in pending:
+                encoding.cancel()
+        await dm.update(_frames=frames)
+
+    async def _checksum(self, dm, data) -> Optional[str]:
+        """
+        Checksum of a part or object with the algorithm of the upload,
+        computed in a thread
+        """
+        algorithm = dm.get("checksum_algorithm")
+        if algorithm is None:
+            return None
+        util = get_utility(IS3BlobStore)
+        return await util._run_checksum(checksums.checksum, algorithm, data)
+
+    async def _append_parts(self, dm, iterable) -> int:
+        util = get_utility(IS3BlobStore)
+        encoded = dm.get("content_encoding") is not None
+        if encoded:
+            # parts are made of compressed frames, the size appended is the
+            # size of the data before compression
+            previous = sum(frame[0] for frame in dm.get("_frames"))
+            iterable = self._iter_encoded(dm, iterable)
+        tail = dm.get("_tail")
+        if tail:
+            iterable = _chain(tail, iterable)
+        part_size = _get_part_size(dm.get("size"), util._upload_part_size)
+        parts = self._hold_last_part(
+            dm, _coalesce_parts(iterable, part_size, util._part_buffers), part_size
+        )
+        if util._upload_concurrency > 1:
+            size = await self._append_pipelined(dm, parts, util._upload_concurrency)
+        else:
+            size = 0
+            async for chunk in parts:
+                size += len(chunk)
+                await self._upload_next_part(dm, chunk)
+        if encoded:
+            return sum(frame[0] for frame in dm.get("_frames")) - previous
+        return size + len(dm.get("_tail") or b"") - len(tail or b"")
+
+    async def _hold_last_part(
+        self, dm, parts: AsyncIterator[Union[bytes, bytearray]], part_size: int
+    ) -> AsyncIterator[Union[bytes, bytearray]]:
+        """
+        Keep the last part of an append when it is smaller than a part, as
+        requests of uploads sent over several of them rarely end on a part
+        boundary and only the last part of an upload may be small. It goes
+        in front of the data of the next append, or is uploaded by `finish`.
+        """
+        async for part in parts:
+            if len(part) < part_size:
+                await dm.update(_tail=bytes(part))
+                return
+            yield part
+        await dm.update(_tail=None)
+
+    async def _upload_next_part(self, dm, data):
+        part = await self._upload_numbered_part(dm, data, dm.get("_block"))
+        multipart = dm.get("_multipart")
+        multipart["Parts"].append(part)
+        await dm.update(_multipart=multipart, _block=dm.get("_block") + 1)
+
+    async def _append_pipelined(self, dm, iterable, concurrency: int) -> int:
+        """
+        Upload parts with up to `concurrency` requests in flight.
+
+        Part numbers are assigned as parts are read, so parts are recorded
+        in order once all of them have been uploaded. No more than
+        `concurrency` parts are held in memory at any time.
+        """
+        size = 0
+        block = dm.get("_block")
+        parts: List[Dict[str, Any]] = []
+        pending: Set[asyncio.Future] = set()
+        try:
+            async for chunk in iterable:
+                size += len(chunk)
+                if len(pending) >= concurrency:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    parts.extend(task.result() for task in done)
+                pending.add(
+                    asyncio.ensure_future(self._upload_numbered_part(dm, chunk, block))
+                )
+                block += 1
+            if pending:
+                parts.extend(await asyncio.gather(*pending))
+                pending = set()
+        finally:
+            for task in pending:
+                task.cancel()
+
+        multipart = dm.get("_multipart")
+        multipart["Parts"].extend(sorted(parts, key=lambda part: part["PartNumber"]))
+        await dm.update(_multipart=multipart, _block=block)
         return size
 
-    @backoff.on_exception(backoff.expo, RETRIABLE_EXCEPTIONS, max_tries=3)
-    async def _upload_part(self, dm, data):
+    async def _upload_numbered_part(self, dm, data, part_number: int):
+        checksum = await self._checksum(dm, data)
+        part = await self._upload_part(
+            dm, data, part_number=part_number, checksum=checksum
+        )
+        # only reused once uploaded, a failed request may still reference it
+        get_utility(IS3BlobStore)._part_buffers.release(data)
+        return {
+            "PartNumber": part_number,
+            "ETag": part["ETag"],
+            "Size": len(data),
+            "Checksum": checksum,
+        }
+
+    @backoff.on_exception(
+        backoff.expo,
+        RETRIABLE_EXCEPTIONS,
+        max_tries=3,
+        on_backoff=metrics.record_retry,
+    )
+    async def _upload_part(
+        self,
+        dm,
+        data,
+        part_number: Optional[int] = None,
+        checksum: Optional[str] = None,
+    ):
         util = get_utility(IS3BlobStore)
-        async with util.s3_client() as client:
+        async with util.s3_client(bucket_name=dm.get("_bucket_name")) as client:
             return await client.upload_part(
                 Bucket=dm.get("_bucket_name"),
                 Key=dm.get("_upload_file_id"),
-                PartNumber=dm.get("_block"),
+                PartNumber=part_number or dm.get("_block"),
                 UploadId=dm.get("_mpu")["UploadId"],
                 Body=data,
+                **checksums.request_parameters(dm.get("checksum_algorithm"), checksum),
             )
 
+    @metrics.timed("finish")
     async def finish(self, dm):
         file = self.field.query(self.field.context or self.context, None)
         if _is_uploaded_file(file):
             # delete existing file
             if self.should_clean(file):
                 try:
-                    await self.delete_upload(file.uri)
+                    await self.delete_upload(
+                        file.uri, digest=getattr(file, "content_digest", None)
+                    )
                 except botocore.exceptions.ClientError:
                     log.error(
                         f"Referenced key {file.uri} could not be found", exc_info=True
@@ -221,33 +1202,134 @@ class S3FileStorageManager:
                     log.warn("Error deleting object", exc_info=True)
 
         if dm.get("_mpu") is not None:
+            if dm.get("_tail"):
+                await self._upload_next_part(dm, dm.get("_tail"))
             await self._complete_multipart_upload(dm)
-        await dm.update(
+            parts = dm.get("_multipart")["Parts"]
+            multipart = True
+        else:
+            if dm.get("_single_put") is False:
+                # nothing was appended, store an empty object
+                await self._put_object(dm, b"")
+            parts = [dm.get("_put_checksum") or {}]
+            multipart = False
+        util = get_utility(IS3BlobStore)
+        if util._memory_cache is not None:
+            util._memory_cache.invalidate(
+                dm.get("_bucket_name"), dm.get("_upload_file_id")
+            )
+        checksum = part_sizes = None
+        algorithm = dm.get("checksum_algorithm")
+        if algorithm is not None and all(part.get("Checksum") for part in parts):
+            part_checksums = [part["Checksum"] for part in parts]
+            checksum = (
+                checksums.combine(algorithm, part_checksums)
+                if multipart
+                else part_checksums[0]
+            )
+            part_sizes = [part["Size"] for part in parts]
+        frames = dm.get("_frames")
+        encoded = bool(frames) and dm.get("content_encoding") is not None
+        values = dict(
             uri=dm.get("_upload_file_id"),
+            checksum_algorithm=algorithm if checksum else None,
+            checksum=checksum,
+            part_sizes=part_sizes,
+            content_encoding=dm.get("content_encoding") if encoded else None,
+            encoded_size=sum(frame[1] for frame in frames) if encoded else None,
+            # ranges of files without a frame index are read from the start
+            encoded_frames=(
+                frames
+                if encoded
+                and (
+                    util._compression is None
+                    or len(frames) <= util._compression.max_frames
+                )
+                else None
+            ),
+            content_digest=None,
+        )
+        hasher, hashed = util._upload_digests.get(
+            dm.get("_upload_file_id"), (None, None)
+        )
+        util._upload_digests.invalidate(dm.get("_upload_file_id"))
+        if (
+            util._dedup_index is not None
+            and hasher is not None
+            and hashed == dm.get("_hashed")
+        ):
+            values = await self._deduplicate(dm, hasher.hexdigest(), values)
+        await dm.update(
+            **values,
             _multipart=None,
             _mpu=None,
             _block=None,
             _upload_file_id=None,
+            _single_put=None,
+            _put_checksum=None,
+            _frames=None,
+            _tail=None,
+            _hashed=None,
         )
 
-    @backoff.on_exception(backoff.expo, RETRIABLE_EXCEPTIONS, max_tries=3)
+    async def _deduplicate(self, dm, digest: str, values: Dict[str, Any]):
+        """
+        Reference the object already holding the data of `digest`, if any,
+        instead of the one just uploaded, which is deleted
+        """
+        util = get_utility(IS3BlobStore)
+        bucket = dm.get("_bucket_name")
+        uri = values["uri"]
+        metadata = {key: values[key] for key in dedup.METADATA}
+        try:
+            existing, existing_metadata = await util._dedup_index.acquire(
+                bucket, digest, uri, metadata
+            )
+            if existing != uri and not await self._object_exists(existing, bucket):
+                # deleted without going through the index
+                await util._dedup_index.forget(bucket, digest, existing)
+                existing, existing_metadata = await util._dedup_index.acquire(
+                    bucket, digest, uri, metadata
+                )
+        except Exception:
+            log.warning(f"Could not deduplicate {uri}", exc_info=True)
+            return values
+        if existing != uri:
+            await self.delete_upload(uri, bucket)
+        return dict(values, **existing_metadata, uri=existing, content_digest=digest)
+
+    @backoff.on_exception(
+        backoff.expo,
+        RETRIABLE_EXCEPTIONS,
+        max_tries=3,
+        on_backoff=metrics.record_retry,
+    )
     async def _complete_multipart_upload(self, dm):
         util = get_utility(IS3BlobStore)
         # if blocks is 0, it means the file is of zero length so we need to
         # trick it to finish a multiple part with no data.
         if dm.get("_block") == 1:
-            part = await self._upload_part(dm, b"")
-            multipart = dm.get("_multipart")
-            multipart["Parts"].append(
-                {"PartNumber": dm.get("_block"), "ETag": part["ETag"]}
-            )
-            await dm.update(_multipart=multipart, _block=dm.get("_block") + 1)
-        async with util.s3_client() as client:
+            await self._upload_next_part(dm, b"")
+        algorithm = dm.get("checksum_algorithm")
+        parts = [
+            {
+                "PartNumber": part["PartNumber"],
+                "ETag": part["ETag"],
+                # parts of uploads created with a ChecksumAlgorithm
+                **(
+                    checksums.request_parameters(algorithm, part.get("Checksum"))
+                    if checksums.multipart_parameters(algorithm)
+                    else {}
+                ),
+            }
+            for part in dm.get("_multipart")["Parts"]
+        ]
+        async with util.s3_client(bucket_name=dm.get("_bucket_name")) as client:
             await client.complete_multipart_upload(
                 Bucket=dm.get("_bucket_name"),
                 Key=dm.get("_upload_file_id"),
                 UploadId=dm.get("_mpu")["UploadId"],
-                MultipartUpload=dm.get("_multipart"),
+                MultipartUpload={"Parts": parts},
             )
 
     async def exists(self):
@@ -259,8 +1341,12 @@ class S3FileStorageManager:
         else:
             uri = file.uri
             bucket = await util.get_bucket_name()
+        return await self._object_exists(uri, bucket)
+
+    async def _object_exists(self, uri, bucket) -> bool:
+        util = get_utility(IS3BlobStore)
         try:
-            async with util.s3_client() as client:
+            async with util.s3_client(bucket_name=bucket) as client:
                 return await client.head_object(Bucket=bucket, Key=uri) is not None
         except botocore.exceptions.ClientError as ex:
             error_code = ex.response["Error"]["Code"]
@@ -269,6 +1355,7 @@ class S3FileStorageManager:
                 return False
             raise
 
+    @metrics.timed("copy")
     async def copy(self, to_storage_manager, to_dm):
         file = self.field.query(self.field.context or self.context, None)
         if not _is_uploaded_file(file):
@@ -278,13 +1365,22 @@ class S3FileStorageManager:
 
         util = get_utility(IS3BlobStore)
 
-        new_uri = generate_key(self.context)
-        bucket = await util.get_bucket_name()
-        async with util.s3_client() as client:
-            await client.copy_object(
-                CopySource={"Bucket": bucket, "Key": file.uri},
-                Bucket=bucket,
-                Key=new_uri,
+        encoding = getattr(file, "content_encoding", None)
+        digest = getattr(file, "content_digest", None)
+        if digest is not None and util._dedup_index is not None:
+            # copies of deduplicated files reference the same object
+            if not await util._dedup_index.reference(
+                await util.get_bucket_name(), digest, file.uri
+            ):
+                digest = None
+        if digest is not None:
+            new_uri = file.uri
+        else:
+            new_uri = generate_key(self.context)
+            await util.copy_blob(
+                file.uri,
+                new_uri,
+                size=file.size if encoding is None else file.encoded_size,
             )
         await to_dm.finish(
             values={
@@ -292,12 +1388,20 @@ class S3FileStorageManager:
                 "size": file.size,
                 "uri": new_uri,
                 "filename": file.filename or "unknown",
+                # checksums are of the data, whatever parts the copy has
+                "checksum_algorithm": getattr(file, "checksum_algorithm", None),
+                "checksum": getattr(file, "checksum", None),
+                "part_sizes": getattr(file, "part_sizes", None),
+                "content_encoding": encoding,
+                "encoded_size": getattr(file, "encoded_size", None),
+                "encoded_frames": getattr(file, "encoded_frames", None),
+                "content_digest": digest,
             }
         )
 
     async def delete(self):
         file = self.field.get(self.field.context or self.context)
-        await self.delete_upload(file.uri)
+        await self.delete_upload(file.uri, digest=getattr(file, "content_digest", None))
 
 
 @implementer(IBlobVacuum)
@@ -309,20 +1413,168 @@ class S3BlobStore:
         max_pool_connections = settings.get(
             "max_pool_connections", DEFAULT_MAX_POOL_CONNECTIONS
         )
+        # clients, each with its own connection pool, sharing the
+        # max_pool_connections between them
+        self._clients = max(1, settings.get("clients", DEFAULT_CLIENTS))
         self._opts = dict(
             aws_secret_access_key=self._aws_secret_key,
             aws_access_key_id=self._aws_access_key,
             endpoint_url=settings.get("endpoint_url"),
             use_ssl=settings.get("ssl", True),
             region_name=settings.get("region_name"),
-            config=Config(max_pool_connections=max_pool_connections),
+            config=AioConfig(
+                max_pool_connections=-(-max_pool_connections // self._clients),
+                connect_timeout=settings.get(
+                    "connect_timeout", DEFAULT_CONNECT_TIMEOUT
+                ),
+                read_timeout=settings.get("read_timeout", DEFAULT_READ_TIMEOUT),
+                # aiohttp connector options: keepalive_timeout,
+                # use_dns_cache, ttl_dns_cache, force_close...
+                connector_args=settings.get("connector_args"),
+            ),
         )
+        self._s3aioclients: List[Any] = []
+        self._client_requests: Dict[Any, int] = collections.Counter()
 
         self.exit_stack = contextlib.AsyncExitStack()
         self._s3aiosession = get_session()
-        self._s3_request_semaphore = asyncio.BoundedSemaphore(max_pool_connections)
+        # connections are shared between request priorities, keeping some
+        # for interactive requests and capping maintenance jobs
+        self._s3_request_limiter = PriorityLimiter(
+            max_pool_connections,
+            reserved=settings.get(
+                "reserved_connections", {INTERACTIVE: max_pool_connections // 4}
+            ),
+            limits=settings.get(
+                "max_connections", {MAINTENANCE: max(1, max_pool_connections // 2)}
+            ),
+        )
+
+        # parts in flight per upload, never more than the pool can serve
+        self._upload_concurrency = min(
+            settings.get("upload_concurrency", DEFAULT_UPLOAD_CONCURRENCY),
+            max_pool_connections,
+        )
+        self._upload_part_size = settings.get("upload_part_size", MIN_UPLOAD_SIZE)
+        # buffers parts are assembled in, reused between uploads
+        self._part_buffers = BufferPool(
+            settings.get("part_buffer_pool_size", DEFAULT_PART_BUFFER_POOL_SIZE)
+        )
+        # checksums sent with every part and stored on files, computed in
+        # threads so hashing does not hold the event loop
+        self._checksum_algorithm = settings.get("checksum_algorithm")
+        checksums.check_algorithm(self._checksum_algorithm)
+        self._verify_checksums = settings.get("verify_checksums", False)
+        self._checksum_executor = ThreadPoolExecutor(
+            settings.get("checksum_threads", DEFAULT_CHECKSUM_THREADS),
+            thread_name_prefix="s3-checksum",
+        )
+        # optional compression of uploads by content type, in threads
+        self._compression: Optional[compression.Compression] = None
+        self._compression_executor: Optional[ThreadPoolExecutor] = None
+        if settings.get("compression"):
+            self._compression = compression.Compression(**settings["compression"])
+            self._compression_executor = ThreadPoolExecutor(
+                self._compression.threads, thread_name_prefix="s3-compression"
+            )
+        # optional deduplication of uploads by digest, with the hashers of
+        # uploads in progress, which only the process handling every
+        # request of an upload can complete
+        self._dedup_index: Optional[dedup.DedupIndex] = None
+        self._upload_digests = TTLCache(0)
+        if settings.get("dedup"):
+            options = dict(settings["dedup"])
+            factory = resolve_dotted_name(options.pop("index", DEFAULT_DEDUP_INDEX))
+            self._upload_digests = TTLCache(
+                options.pop("upload_ttl", DEFAULT_DEDUP_UPLOAD_TTL),
+                options.pop("max_uploads", DEFAULT_DEDUP_MAX_UPLOADS),
+            )
+            self._dedup_index = factory(**options)
+        # uploads up to this size are stored with one put_object, 0 disables
+        self._single_put_threshold = min(
+            settings.get("single_put_threshold", 0), MAX_PUT_OBJECT_SIZE
+        )
+        # ranged GETs in flight per download, for objects above a range size
+        self._download_concurrency = min(
+            settings.get("download_concurrency", DEFAULT_DOWNLOAD_CONCURRENCY),
+            max_pool_connections,
+        )
+        self._download_range_size = settings.get(
+            "download_range_size", DEFAULT_DOWNLOAD_RANGE_SIZE
+        )
+        # times a broken download is resumed where it stopped
+        self._download_resume_attempts = settings.get(
+            "download_resume_attempts", DEFAULT_DOWNLOAD_RESUME_ATTEMPTS
+        )
+        self._copy_concurrency = settings.get(
+            "copy_concurrency", DEFAULT_COPY_CONCURRENCY
+        )
+        # sub-prefixes listed in parallel by iterate_bucket
+        self._list_concurrency = min(
+            settings.get("list_concurrency", DEFAULT_LIST_CONCURRENCY),
+            max_pool_connections,
+        )
+        # DeleteObjects calls in flight per delete_blobs
+        self._delete_concurrency = min(
+            settings.get("delete_concurrency", DEFAULT_DELETE_CONCURRENCY),
+            max_pool_connections,
+        )
+        # CopyObject cannot copy objects above 5 GB
+        self._multipart_copy_threshold = min(
+            settings.get("multipart_copy_threshold", DEFAULT_MULTIPART_COPY_THRESHOLD),
+            MAX_COPY_OBJECT_SIZE,
+        )
+        self._multipart_copy_part_size = settings.get(
+            "multipart_copy_part_size", DEFAULT_MULTIPART_COPY_PART_SIZE
+        )
+
+        # buckets known to exist, and in-flight checks for the others
+        self._cached_buckets = LRUSet(
+            settings.get("bucket_cache_size", DEFAULT_BUCKET_CACHE_SIZE)
+        )
+        self._bucket_checks = SingleFlight()
+
+        # requests to a bucket go to clients for the region it is in,
+        # created the first time a bucket of that region is used
+        self._region_routing = settings.get("bucket_region_routing", True)
+        self._bucket_regions = TTLCache(
+            settings.get("bucket_region_ttl", DEFAULT_BUCKET_REGION_TTL),
+            settings.get("bucket_cache_size", DEFAULT_BUCKET_CACHE_SIZE),
+        )
+        self._bucket_region_checks = SingleFlight()
+        self._regional_clients: Dict[str, List[Any]] = {}
+        self._regional_client_creations = SingleFlight()
+
+        # optional read-through cache of whole objects on local disk
+        self._disk_cache: Optional[DiskCache] = None
+        if settings.get("disk_cache"):
+            self._disk_cache = DiskCache(**settings["disk_cache"])
+
+        # concurrent reads of the same object share one download
+        self._coalesce_downloads = settings.get("coalesce_downloads", False)
+        self._coalesce_buffer_chunks = settings.get(
+            "coalesce_buffer_chunks", DEFAULT_COALESCE_BUFFER_CHUNKS
+        )
+        self._shared_downloads: Dict[Tuple, Broadcast] = {}
 
-        self._cached_buckets = []
+        # optional in memory cache of small objects
+        self._memory_cache: Optional[MemoryCache] = None
+        if settings.get("memory_cache"):
+            self._memory_cache = MemoryCache(**settings["memory_cache"])
+
+        # optional in memory cache of blocks of objects for read_range
+        self._range_cache: Optional[RangeCache] = None
+        if settings.get("range_cache"):
+            self._range_cache = RangeCache(**settings["range_cache"])
+
+        # results of check_bucket_accessibility for bucket overrides
+        self._bucket_accessible_ttl = settings.get(
+            "bucket_accessible_ttl", DEFAULT_BUCKET_ACCESSIBLE_TTL
+        )
+        self._bucket_inaccessible_ttl = settings.get(
+            "bucket_inaccessible_ttl", DEFAULT_BUCKET_INACCESSIBLE_TTL
+        )
+        self._bucket_accessibility = TTLCache(self._bucket_accessible_ttl)
 
         self._bucket_name = settings["bucket"]
 
@@ -331,13 +1583,116 @@ class S3BlobStore:
         )
         self._delimiter = settings.get("bucket_delimiter", None)
 
+    def _run_checksum(self, func: Callable, *args) -> asyncio.Future:
+        # hashlib and zlib release the GIL on large buffers, so several
+        # parts are hashed in parallel
+        return asyncio.get_running_loop().run_in_executor(
+            self._checksum_executor, func, *args
+        )
+
+    def _run_compression(self, func: Callable, *args) -> asyncio.Future:
+        return asyncio.get_running_loop().run_in_executor(
+            self._compression_executor, func, *args
+        )
+
     def _get_region_name(self) -> str:
         return self._opts["region_name"]
 
+    def _get_default_region(self) -> str:
+        # botocore talks to us-east-1 when no region is configured
+        return self._get_region_name() or "us-east-1"
+
     @contextlib.asynccontextmanager
-    async def s3_client(self):
-        async with self._s3_request_semaphore:
-            yield self._s3aioclient
+    async def s3_client(
+        self, priority: Optional[str] = None, bucket_name: Optional[str] = None
+    ):
+        """
+        Hold one of the pool connections while using the client.
+
+        `priority` defaults to the `request_priority` of the current task.
+        With a `bucket_name`, the client is one for the region of that
+        bucket.
+        """
+        clients = await self._get_clients(bucket_name)
+        priority = priority or request_priority.get()
+        start = time.time()
+        await self._s3_request_limiter.acquire(priority)
+        metrics.record_pool_wait(priority, time.time() - start)
+        # the least busy client, so no client gets more than its share of
+        # the connections
+        client = min(clients, key=self._client_requests.__getitem__)
+        self._client_requests[client] += 1
+        try:
+            yield metrics.instrument(client)
+        finally:
+            self._client_requests[client] -= 1
+            self._s3_request_limiter.release(priority)
+
+    async def _get_clients(self, bucket_name: Optional[str] = None) -> List[Any]:
+        default_clients = self._s3aioclients or [self._s3aioclient]
+        if bucket_name is None or not self._region_routing:
+            return default_clients
+        region = self._bucket_regions.get(bucket_name)
+        if region is None:
+            region = await self._bucket_region_checks.do(
+                bucket_name, self._discover_bucket_region, bucket_name
+            )
+        if region is None or region == self._get_default_region():
+            return default_clients
+        clients = self._regional_clients.get(region)
+        if clients is None:
+            clients = await self._regional_client_creations.do(
+                region, self._create_regional_clients, region
+            )
+        return clients
+
+    def _set_bucket_region(self, bucket_name: str, response: Dict[str, Any]):
+        """
+        Remember the region of a bucket from a `head_bucket` response or
+        error, which S3 sends even when the bucket is not accessible
+        """
+        region = response.get("BucketRegion") or response.get(
+            "ResponseMetadata", {}
+        ).get("HTTPHeaders", {}).get("x-amz-bucket-region")
+        if region:
+            self._bucket_regions.set(bucket_name, region)
+
+    async def _discover_bucket_region(self, bucket_name: str) -> Optional[str]:
+        try:
+            async with self.s3_client() as client:
+                res = await client.head_bucket(Bucket=bucket_name)
+        except botocore.exceptions.ClientError as e:
+            res = e.response
+        self._set_bucket_region(bucket_name, res)
+        region = self._bucket_regions.get(bucket_name)
+        if region is None and res.get("ResponseMetadata", {}).get("HTTPStatusCode") in (
+            200,
+            None,
+        ):
+            # not told, so it is where the request went
+            region = self._get_default_region()
+            self._bucket_regions.set(bucket_name, region)
+        elif region is None:
+            # denied without being told the region: use the default one
+            # for a while rather than asking again on every request
+            region = self._get_default_region()
+            self._bucket_regions.set(
+                bucket_name, region, ttl=self._bucket_inaccessible_ttl
+            )
+        return region
+
+    async def _create_regional_clients(self, region: str) -> List[Any]:
+        log.info(f"Creating S3 clients for region {region}")
+        clients = [
+            await self.exit_stack.enter_async_context(
+                self._s3aiosession.create_client(
+                    "s3", **{**self._opts, "region_name": region}
+                )
+            )
+            for _ in range(self._clients)
+        ]
+        self._regional_clients[region] = clients
+        return clients
 
     async def _get_or_create_bucket(self, container, bucket_name):
         missing = False
@@ -346,7 +1701,11 @@ class S3BlobStore:
                 res = await client.head_bucket(Bucket=bucket_name)
                 if res["ResponseMetadata"]["HTTPStatusCode"] == 404:
                     missing = True
+                else:
+                    self._set_bucket_region(bucket_name, res)
         except botocore.exceptions.ClientError as e:
+            # redirects and denials carry the region of the bucket too
+            self._set_bucket_region(bucket_name, e.response)
             error_code = int(e.response["Error"]["Code"])
             if error_code == 404:
                 missing = True
@@ -354,6 +1713,7 @@ class S3BlobStore:
         if missing:
             async with self.s3_client() as client:
                 await client.create_bucket(**self._get_bucket_kargs(bucket_name))
+            self._bucket_regions.set(bucket_name, self._get_default_region())
 
     async def get_bucket_name(self):
         container = task_vars.container.get()
@@ -361,7 +1721,7 @@ class S3BlobStore:
 
         if s3_bucket_override:
 
-            if not await self.check_bucket_accessibility(s3_bucket_override):
+            if not await self._is_bucket_accessible(s3_bucket_override):
                 log.error(
                     f"S3 bucket override '{s3_bucket_override}' for container '{container.id}' is not accessible."
                 )
@@ -388,36 +1748,176 @@ class S3BlobStore:
         if bucket_name in self._cached_buckets:
             return bucket_name
 
-        await self._get_or_create_bucket(container, bucket_name)
+        await self._bucket_checks.do(
+            bucket_name, self._get_or_create_bucket, container, bucket_name
+        )
 
-        self._cached_buckets.append(bucket_name)
+        self._cached_buckets.add(bucket_name)
         return bucket_name
 
+    async def _is_bucket_accessible(self, bucket_name: str) -> bool:
+        accessible = self._bucket_accessibility.get(bucket_name)
+        if accessible is None:
+            accessible = await self.check_bucket_accessibility(bucket_name)
+            self._bucket_accessibility.set(
+                bucket_name,
+                accessible,
+                ttl=(
+                    self._bucket_accessible_ttl
+                    if accessible
+                    else self._bucket_inaccessible_ttl
+                ),
+            )
+        return accessible
+
+    def invalidate_bucket_accessibility(self, bucket_name: Optional[str] = None):
+        """
+        Forget cached accessibility checks for `bucket_name`, or for every
+        bucket when no name is given
+        """
+        self._bucket_accessibility.invalidate(bucket_name)
+
     async def initialize(self, app=None):
         # No asyncio loop to run
         self.app = app
-        self._s3aioclient = await self.exit_stack.enter_async_context(
-            self._s3aiosession.create_client("s3", **self._opts)
-        )
+        self._s3aioclients = [
+            await self.exit_stack.enter_async_context(
+                self._s3aiosession.create_client("s3", **self._opts)
+            )
+            for _ in range(self._clients)
+        ]
+        self._s3aioclient = self._s3aioclients[0]
+        if self._disk_cache is not None:
+            await self._disk_cache.initialize()
+        if self._dedup_index is not None:
+            await self._dedup_index.initialize()
 
     async def finalize(self, app=None):
-        await self._s3aioclient.close()
+        for client in self._s3aioclients or [self._s3aioclient]:
+            await client.close()
+        for clients in self._regional_clients.values():
+            for client in clients:
+                await client.close()
+        self._regional_clients = {}
         await self.exit_stack.aclose()
+        self._checksum_executor.shutdown(wait=False)
+        if self._compression_executor is not None:
+            self._compression_executor.shutdown(wait=False)
+        if self._dedup_index is not None:
+            await self._dedup_index.finalize()
+
+    async def iterate_bucket(
+        self, concurrency: Optional[int] = None, start_after: Optional[str] = None
+    ):
+        """
+        Iterate over the objects of the container, in key order, optionally
+        only those after the `start_after` key.
 
-    async def iterate_bucket(self):
+        With a `concurrency` (by default `list_concurrency`) above 1, the
+        sub-prefixes of the container are listed in parallel.
+        """
         container = task_vars.container.get()
+        assert container is not None, "iterate_bucket needs a container"
         bucket_name = await self.get_bucket_name()
-        async with self.s3_client() as client:
-            result = await client.list_objects(
-                Bucket=bucket_name, Prefix=container.id + "/"
-            )
-        async with self.s3_client() as client:
-            paginator = client.get_paginator("list_objects")
-            async for result in paginator.paginate(
-                Bucket=bucket_name, Prefix=container.id + "/"
+        prefix = f"{container.id}/"
+        kwargs = {"StartAfter": start_after} if start_after else {}
+        concurrency = concurrency or self._list_concurrency
+        if concurrency > 1:
+            items = self._iterate_sharded(bucket_name, prefix, concurrency, **kwargs)
+        else:
+            items = self._iterate_prefix(bucket_name, prefix, **kwargs)
+        async for item in items:
+            yield item
+
+    async def _iterate_prefix(self, bucket_name: str, prefix: str, **kwargs):
+        async for page in self._list_pages(bucket_name, prefix, **kwargs):
+            for item in page.get("Contents", []):
+                yield item
+
+    async def _iterate_sharded(
+        self, bucket_name: str, prefix: str, concurrency: int, **kwargs
+    ):
+        """
+        List every sub-prefix found under `prefix` as a separate shard,
+        with up to `concurrency` shards being listed ahead of the one
+        being consumed.
+        """
+        shards: Deque[Tuple[asyncio.Queue, Optional[asyncio.Future]]] = (
+            collections.deque()
+        )
+        try:
+            async for page in self._list_pages(
+                bucket_name, prefix, Delimiter="/", **kwargs
             ):
-                for item in result.get("Contents", []):
+                entries = page.get("Contents", []) + page.get("CommonPrefixes", [])
+                entries.sort(key=lambda entry: entry.get("Key") or entry["Prefix"])
+                for entry in entries:
+                    if "Key" in entry:
+                        # objects directly under the prefix are shards of one
+                        queue: asyncio.Queue = asyncio.Queue()
+                        queue.put_nowait([entry])
+                        queue.put_nowait(None)
+                        shards.append((queue, None))
+                    else:
+                        queue = asyncio.Queue(LIST_SHARD_BUFFER_PAGES)
+                        task = asyncio.ensure_future(
+                            self._list_shard(
+                                queue, bucket_name, entry["Prefix"], **kwargs
+                            )
+                        )
+                        shards.append((queue, task))
+                    while len(shards) > concurrency:
+                        queue, _ = shards.popleft()
+                        async for item in self._drain_shard(queue):
+                            yield item
+            while shards:
+                queue, _ = shards.popleft()
+                async for item in self._drain_shard(queue):
                     yield item
+        finally:
+            for _, listing in shards:
+                if listing is not None:
+                    listing.cancel()
+
+    async def _list_shard(
+        self, queue: asyncio.Queue, bucket_name: str, prefix: str, **kwargs
+    ):
+        try:
+            async for page in self._list_pages(bucket_name, prefix, **kwargs):
+                await queue.put(page.get("Contents", []))
+        except Exception as ex:
+            await queue.put(ex)
+        else:
+            await queue.put(None)
+
+    async def _drain_shard(self, queue: asyncio.Queue):
+        while True:
+            items = await queue.get()
+            if items is None:
+                return
+            if isinstance(items, Exception):
+                raise items
+            for item in items:
+                yield item
+
+    async def _list_pages(self, bucket_name: str, prefix: str, **kwargs):
+        args = {"Bucket": bucket_name, "Prefix": prefix, **kwargs}
+        while True:
+            page = await self._list_objects_page(args)
+            yield page
+            if not page.get("IsTruncated"):
+                break
+            args["ContinuationToken"] = page["NextContinuationToken"]
+
+    @backoff.on_exception(
+        backoff.expo,
+        RETRIABLE_EXCEPTIONS,
+        max_tries=3,
+        on_backoff=metrics.record_retry,
+    )
+    async def _list_objects_page(self, args: Dict[str, Any]):
+        async with self.s3_client(MAINTENANCE, args["Bucket"]) as client:
+            return await client.list_objects_v2(**args)
 
     def _get_bucket_kargs(self, bucket_name: str):
         bucket_kwargs: Dict[str, Any] = {"Bucket": bucket_name}
@@ -430,7 +1930,7 @@ class S3BlobStore:
     async def iterate_bucket_page(self, page_token=None, prefix=None, max_keys=1000):
         container = task_vars.container.get()
         bucket_name = await self.get_bucket_name()
-        async with self.s3_client() as client:
+        async with self.s3_client(MAINTENANCE, bucket_name) as client:
             args = {
                 "Bucket": bucket_name,
                 "Prefix": prefix or container.id + "/",
@@ -449,7 +1949,7 @@ class S3BlobStore:
         """
         container = task_vars.container.get()
         bucket_name = await self.get_bucket_name()
-        async with self.s3_client() as client:
+        async with self.s3_client(MAINTENANCE, bucket_name) as client:
             args = {
                 "Bucket": bucket_name,
                 "Prefix": prefix or container.id + "/",  # type: ignore
@@ -480,6 +1980,7 @@ class S3BlobStore:
         key: str,
         expiration: timedelta = timedelta(minutes=30),
         credentials=None,
+        content_encoding: Optional[str] = None,
     ) -> str:
         """
         Generate a time-limited presigned S3 GET URL for ``key``.
@@ -487,14 +1988,20 @@ class S3BlobStore:
         Mirrors the GCS blob store interface. ``credentials`` is accepted for
         interface parity with the GCS store but is ignored: S3 presigned URLs
         are signed with the store's configured client credentials.
+
+        Pass the ``content_encoding`` of compressed files to have it sent
+        as the ``Content-Encoding`` of the download.
         """
         bucket_name = await self.get_bucket_name()
         expires_in = int(expiration.total_seconds())
+        params = {"Bucket": bucket_name, "Key": key}
+        if content_encoding is not None:
+            params["ResponseContentEncoding"] = content_encoding
         try:
-            async with self.s3_client() as client:
+            async with self.s3_client(bucket_name=bucket_name) as client:
                 return await client.generate_presigned_url(
                     "get_object",
-                    Params={"Bucket": bucket_name, "Key": key},
+                    Params=params,
                     ExpiresIn=expires_in,
                 )
         except (
@@ -509,37 +2016,241 @@ class S3BlobStore:
             raise S3Exception(f"Could not generate signed URL for '{key}': {exc}")
 
     async def delete_blobs(
-        self, keys: List[str], bucket_name: Optional[str] = None
+        self, keys: Iterable[str], bucket_name: Optional[str] = None
     ) -> Tuple[List[str], List[str]]:
         """
-        Deletes a batch of files.  Returns successful and failed keys.
+        Deletes files in batches of up to 1000 keys, running up to
+        `delete_concurrency` batches at once.  Returns successful and failed
+        keys.
         """
 
         if not bucket_name:
             bucket_name = await self.get_bucket_name()
 
-        async with self.s3_client() as client:
-            args = {
-                "Bucket": bucket_name,
-                "Delete": {"Objects": [{"Key": key} for key in keys]},
-            }
+        success_keys: List[str] = []
+        failed_keys: List[str] = []
+        pending: Set[asyncio.Future] = set()
+
+        def collect(done):
+            for task in done:
+                success, failed = task.result()
+                success_keys.extend(success)
+                failed_keys.extend(failed)
+
+        keys = iter(keys)
+        try:
+            while True:
+                batch = list(itertools.islice(keys, MAX_DELETE_OBJECTS_KEYS))
+                if not batch:
+                    break
+                if len(pending) >= self._delete_concurrency:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    collect(done)
+                pending.add(
+                    asyncio.ensure_future(self._delete_batch(bucket_name, batch))
+                )
+            if pending:
+                done, pending = await asyncio.wait(pending)
+                collect(done)
+        finally:
+            for task in pending:
+                task.cancel()
 
-            response = await client.delete_objects(**args)
-            success_blobs = response.get("Deleted", [])
-            success_keys = [o["Key"] for o in success_blobs]
-            failed_blobs = response.get("Errors", [])
-            failed_keys = [o["Key"] for o in failed_blobs]
+        return success_keys, failed_keys
 
-            return success_keys, failed_keys
+    async def _delete_batch(
+        self, bucket_name: str, keys: List[str]
+    ) -> Tuple[List[str], List[str]]:
+        """
+        Delete up to 1000 keys, retrying the ones S3 reports as throttled
+        """
+        success_keys: List[str] = []
+        failed_keys: List[str] = []
+        for attempt in range(MAX_RETRIES):
+            if attempt:
+                metrics.record_retry({"target": self._delete_objects})
+                await asyncio.sleep(
+                    backoff.full_jitter(DELETE_RETRY_DELAY * 2 ** (attempt - 1))
+                )
+            try:
+                response = await self._delete_objects(bucket_name, keys)
+            except RETRIABLE_EXCEPTIONS as ex:
+                log.warning(f"Could not delete {len(keys)} blobs: {ex}")
+                break
+            success_keys.extend(o["Key"] for o in response.get("Deleted", []))
+            retry_keys = []
+            for error in response.get("Errors", []):
+                if error.get("Code") in RETRIABLE_DELETE_ERRORS:
+                    retry_keys.append(error["Key"])
+                else:
+                    failed_keys.append(error["Key"])
+            keys = retry_keys
+            if not keys:
+                break
+        failed_keys.extend(keys)
+        return success_keys, failed_keys
+
+    @backoff.on_exception(
+        backoff.expo,
+        RETRIABLE_EXCEPTIONS,
+        max_tries=3,
+        on_backoff=metrics.record_retry,
+    )
+    async def _delete_objects(self, bucket_name: str, keys: List[str]):
+        async with self.s3_client(MAINTENANCE, bucket_name) as client:
+            return await client.delete_objects(
+                Bucket=bucket_name,
+                Delete={"Objects": [{"Key": key} for key in keys]},
+            )
+
+    async def vacuum(
+        self,
+        referenced: Union[Iterable[str], AsyncIterable[str]],
+        path: str,
+        presorted: bool = False,
+        **kwargs,
+    ) -> VacuumResult:
+        """
+        Delete the objects of the container missing from `referenced`.
+        See `guillotina_s3storage.vacuum.BlobVacuum` for the options.
+        """
+        return await BlobVacuum(self, path, **kwargs).run(referenced, presorted)
+
+    async def copy_blob(
+        self,
+        source_key: str,
+        dest_key: str,
+        bucket_name: Optional[str] = None,
+        size: Optional[int] = None,
+    ):
+        """
+        Server-side copy of an object within the bucket.
+
+        Objects of `multipart_copy_threshold` bytes or more are copied as
+        concurrent `UploadPartCopy` parts, which also lifts the 5 GB limit
+        of `CopyObject`.
+        """
+        if not bucket_name:
+            bucket_name = await self.get_bucket_name()
+        if size is None:
+            async with self.s3_client(bucket_name=bucket_name) as client:
+                result = await client.head_object(Bucket=bucket_name, Key=source_key)
+            size = result["ContentLength"]
+
+        if size < self._multipart_copy_threshold:
+            async with self.s3_client(bucket_name=bucket_name) as client:
+                await client.copy_object(
+                    CopySource={"Bucket": bucket_name, "Key": source_key},
+                    Bucket=bucket_name,
+                    Key=dest_key,
+                )
+        else:
+            await self._multipart_copy(source_key, dest_key, bucket_name, size)
+
+    async def _multipart_copy(
+        self, source_key: str, dest_key: str, bucket_name: str, size: int
+    ):
+        part_size = max(self._multipart_copy_part_size, -(-size // MAX_MULTIPART_PARTS))
+        async with self.s3_client(bucket_name=bucket_name) as client:
+            mpu = await client.create_multipart_upload(Bucket=bucket_name, Key=dest_key)
+        try:
+            results = await _gather_bounded(
+                (
+                    self._upload_part_copy(
+                        {"Bucket": bucket_name, "Key": source_key},
+                        bucket_name,
+                        dest_key,
+                        mpu["UploadId"],
+                        part_number,
+                        start,
+                        min(start + part_size, size),
+                    )
+                    for part_number, start in enumerate(range(0, size, part_size), 1)
+                ),
+                self._copy_concurrency,
+            )
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+            async with self.s3_client(bucket_name=bucket_name) as client:
+                await client.complete_multipart_upload(
+                    Bucket=bucket_name,
+                    Key=dest_key,
+                    UploadId=mpu["UploadId"],
+                    MultipartUpload={"Parts": results},
+                )
+        except Exception:
+            async with self.s3_client(bucket_name=bucket_name) as client:
+                await client.abort_multipart_upload(
+                    Bucket=bucket_name, Key=dest_key, UploadId=mpu["UploadId"]
+                )
+            raise
+
+    @backoff.on_exception(
+        backoff.expo,
+        RETRIABLE_EXCEPTIONS,
+        max_tries=3,
+        on_backoff=metrics.record_retry,
+    )
+    async def _upload_part_copy(
+        self,
+        copy_source: Dict[str, str],
+        bucket_name: str,
+        dest_key: str,
+        upload_id: str,
+        part_number: int,
+        start: int,
+        end: int,
+    ):
+        async with self.s3_client(bucket_name=bucket_name) as client:
+            result = await client.upload_part_copy(
+                Bucket=bucket_name,
+                Key=dest_key,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                CopySource=copy_source,
+                CopySourceRange=f"bytes={start}-{end - 1}",
+            )
+        return {"PartNumber": part_number, "ETag": result["CopyPartResult"]["ETag"]}
+
+    async def copy_blobs(
+        self, keys: List[Tuple[str, str]], bucket_name: Optional[str] = None
+    ) -> Tuple[List[str], List[str]]:
+        """
+        Copies a batch of (source, destination) keys concurrently.
+        Returns successful and failed source keys.
+        """
+        if not bucket_name:
+            bucket_name = await self.get_bucket_name()
+
+        token = request_priority.set(BACKGROUND)
+        try:
+            results = await _gather_bounded(
+                (self.copy_blob(source, dest, bucket_name) for source, dest in keys),
+                self._copy_concurrency,
+            )
+        finally:
+            request_priority.reset(token)
+        success_keys = []
+        failed_keys = []
+        for (source, dest), result in zip(keys, results):
+            if isinstance(result, Exception):
+                log.warning(f"Could not copy {source} to {dest}: {result}")
+                failed_keys.append(source)
+            else:
+                success_keys.append(source)
+        return success_keys, failed_keys
 
     async def delete_bucket(self, bucket_name: Optional[str] = None):
         """
         Delete the given bucket
         """
-        async with self.s3_client() as client:
-            if not bucket_name:
-                bucket_name = await self.get_bucket_name()
+        if not bucket_name:
+            bucket_name = await self.get_bucket_name()
 
+        async with self.s3_client(MAINTENANCE, bucket_name) as client:
             args = {
                 "Bucket": bucket_name,
             }
@@ -548,6 +2259,8 @@ class S3BlobStore:
 
             if response["ResponseMetadata"]["HTTPStatusCode"] != 204:
                 raise DeleteStorageException()
+        # it could be created again in another region
+        self._bucket_regions.invalidate(bucket_name)
 
     async def check_bucket_accessibility(self, bucket_name: str) -> bool:
         """
@@ -555,9 +2268,11 @@ class S3BlobStore:
         """
         try:
             async with self.s3_client() as client:
-                await client.head_bucket(Bucket=bucket_name)
+                res = await client.head_bucket(Bucket=bucket_name)
+            self._set_bucket_region(bucket_name, res)
             return True
         except botocore.exceptions.ClientError as e:
+            self._set_bucket_region(bucket_name, e.response)
             error_code = int(e.response["Error"]["Code"])
             if error_code == 404:
                 return False
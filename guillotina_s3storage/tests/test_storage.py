@@ -1,10 +1,15 @@
 import asyncio
 import base64
+import gzip
+import importlib.util
+import json
 import random
+import sys
 from datetime import datetime
 from datetime import timedelta
 from datetime import timezone
 from hashlib import md5
+from hashlib import sha256
 from unittest.mock import AsyncMock
 from urllib.parse import parse_qs
 from urllib.parse import urlparse
@@ -13,25 +18,50 @@ import pytest_asyncio
 import aiohttp
 import backoff
 import botocore.exceptions
+import prometheus_client
 import pytest
+from guillotina import app_settings
 from guillotina import task_vars
 from guillotina.component import get_utility
+from guillotina.component import provide_utility
 from guillotina.content import Container
 from guillotina.exceptions import UnRetryableRequestError
 from guillotina.files import MAX_REQUEST_CACHE_SIZE
 from guillotina.files import FileManager
 from guillotina.files.adapter import DBDataManager
 from guillotina.files.utils import generate_key
+from guillotina.response import HTTPPreconditionFailed
 from guillotina.tests.utils import create_content
 from guillotina.tests.utils import login
 from zope.interface import Interface
 
+from guillotina_s3storage import benchmark
+from guillotina_s3storage import checksums
+from guillotina_s3storage.cache import DiskCache
+from guillotina_s3storage.compression import Compression
+from guillotina_s3storage.cache import LRUSet
+from guillotina_s3storage.cache import MemoryCache
+from guillotina_s3storage.cache import RangeCache
+from guillotina_s3storage.cache import TTLCache
+from guillotina_s3storage.dedup import SQLiteIndex
 from guillotina_s3storage.interfaces import IS3BlobStore
+from guillotina_s3storage.local import LocalBlobStore
 from guillotina_s3storage.storage import CHUNK_SIZE
 from guillotina_s3storage.storage import DEFAULT_MAX_POOL_CONNECTIONS
+from guillotina_s3storage.storage import MAX_MULTIPART_PARTS
+from guillotina_s3storage.storage import MIN_UPLOAD_SIZE
 from guillotina_s3storage.storage import RETRIABLE_EXCEPTIONS
+from guillotina_s3storage.storage import S3BlobStore
+from guillotina_s3storage.storage import S3Exception
 from guillotina_s3storage.storage import S3FileField
 from guillotina_s3storage.storage import S3FileStorageManager
+from guillotina_s3storage.storage import _get_part_size
+from guillotina_s3storage.utils import BACKGROUND
+from guillotina_s3storage.utils import Broadcast
+from guillotina_s3storage.utils import BufferPool
+from guillotina_s3storage.utils import INTERACTIVE
+from guillotina_s3storage.utils import MAINTENANCE
+from guillotina_s3storage.utils import PriorityLimiter
 
 _test_gif = base64.b64decode(
     "R0lGODlhPQBEAPeoAJosM//AwO/AwHVYZ/z595kzAP/s7P+goOXMv8+fhw/v739/f+8PD98fH/8mJl+fn/9ZWb8/PzWlwv///6wWGbImAPgTEMImIN9gUFCEm/gDALULDN8PAD6atYdCTX9gUNKlj8wZAKUsAOzZz+UMAOsJAP/Z2ccMDA8PD/95eX5NWvsJCOVNQPtfX/8zM8+QePLl38MGBr8JCP+zs9myn/8GBqwpAP/GxgwJCPny78lzYLgjAJ8vAP9fX/+MjMUcAN8zM/9wcM8ZGcATEL+QePdZWf/29uc/P9cmJu9MTDImIN+/r7+/vz8/P8VNQGNugV8AAF9fX8swMNgTAFlDOICAgPNSUnNWSMQ5MBAQEJE3QPIGAM9AQMqGcG9vb6MhJsEdGM8vLx8fH98AANIWAMuQeL8fABkTEPPQ0OM5OSYdGFl5jo+Pj/+pqcsTE78wMFNGQLYmID4dGPvd3UBAQJmTkP+8vH9QUK+vr8ZWSHpzcJMmILdwcLOGcHRQUHxwcK9PT9DQ0O/v70w5MLypoG8wKOuwsP/g4P/Q0IcwKEswKMl8aJ9fX2xjdOtGRs/Pz+Dg4GImIP8gIH0sKEAwKKmTiKZ8aB/f39Wsl+LFt8dgUE9PT5x5aHBwcP+AgP+WltdgYMyZfyywz78AAAAAAAD///8AAP9mZv///wAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAACH5BAEAAKgALAAAAAA9AEQAAAj/AFEJHEiwoMGDCBMqXMiwocAbBww4nEhxoYkUpzJGrMixogkfGUNqlNixJEIDB0SqHGmyJSojM1bKZOmyop0gM3Oe2liTISKMOoPy7GnwY9CjIYcSRYm0aVKSLmE6nfq05QycVLPuhDrxBlCtYJUqNAq2bNWEBj6ZXRuyxZyDRtqwnXvkhACDV+euTeJm1Ki7A73qNWtFiF+/gA95Gly2CJLDhwEHMOUAAuOpLYDEgBxZ4GRTlC1fDnpkM+fOqD6DDj1aZpITp0dtGCDhr+fVuCu3zlg49ijaokTZTo27uG7Gjn2P+hI8+PDPERoUB318bWbfAJ5sUNFcuGRTYUqV/3ogfXp1rWlMc6awJjiAAd2fm4ogXjz56aypOoIde4OE5u/F9x199dlXnnGiHZWEYbGpsAEA3QXYnHwEFliKAgswgJ8LPeiUXGwedCAKABACCN+EA1pYIIYaFlcDhytd51sGAJbo3onOpajiihlO92KHGaUXGwWjUBChjSPiWJuOO/LYIm4v1tXfE6J4gCSJEZ7YgRYUNrkji9P55sF/ogxw5ZkSqIDaZBV6aSGYq/lGZplndkckZ98xoICbTcIJGQAZcNmdmUc210hs35nCyJ58fgmIKX5RQGOZowxaZwYA+JaoKQwswGijBV4C6SiTUmpphMspJx9unX4KaimjDv9aaXOEBteBqmuuxgEHoLX6Kqx+yXqqBANsgCtit4FWQAEkrNbpq7HSOmtwag5w57GrmlJBASEU18ADjUYb3ADTinIttsgSB1oJFfA63bduimuqKB1keqwUhoCSK374wbujvOSu4QG6UvxBRydcpKsav++Ca6G8A6Pr1x2kVMyHwsVxUALDq/krnrhPSOzXG1lUTIoffqGR7Goi2MAxbv6O2kEG56I7CSlRsEFKFVyovDJoIRTg7sugNRDGqCJzJgcKE0ywc0ELm6KBCCJo8DIPFeCWNGcyqNFE06ToAfV0HBRgxsvLThHn1oddQMrXj5DyAQgjEHSAJMWZwS3HPxT/QMbabI/iBCliMLEJKX2EEkomBAUCxRi42VDADxyTYDVogV+wSChqmKxEKCDAYFDFj4OmwbY7bDGdBhtrnTQYOigeChUmc1K3QTnAUfEgGFgAWt88hKA6aCRIXhxnQ1yg3BCayK44EWdkUQcBByEQChFXfCB776aQsG0BIlQgQgE8qO26X1h8cEUep8ngRBnOy74E9QgRgEAC8SvOfQkh7FDBDmS43PmGoIiKUUEGkMEC/PJHgxw0xH74yx/3XnaYRJgMB8obxQW6kL9QYEJ0FIFgByfIL7/IQAlvQwEpnAC7DtLNJCKUoO/w45c44GwCXiAFB/OXAATQryUxdN4LfFiwgjCNYg+kYMIEFkCKDs6PKAIJouyGWMS1FSKJOMRB/BoIxYJIUXFUxNwoIkEKPAgCBZSQHQ1A2EWDfDEUVLyADj5AChSIQW6gu10bE/JG2VnCZGfo4R4d0sdQoBAHhPjhIB94v/wRoRKQWGRHgrhGSQJxCS+0pCZbEhAAOw=="  # noqa
@@ -77,6 +107,28 @@ class FakeContentReader:
         self._pointer = pos
 
 
+class BrokenBody:
+    """
+    Body whose connection breaks after `size` bytes
+    """
+
+    def __init__(self, body, size):
+        self._body = body
+        self._size = size
+        self.content = self
+
+    async def __aenter__(self):
+        self._stream = await self._body.__aenter__()
+        return self
+
+    async def __aexit__(self, *args):
+        await self._body.__aexit__(*args)
+
+    async def iter_chunked(self, size):
+        yield await self._stream.content.readexactly(self._size)
+        raise aiohttp.ClientPayloadError("Response payload is not completed")
+
+
 @pytest_asyncio.fixture
 def reader():
     yield FakeContentReader()
@@ -436,6 +488,84 @@ async def test_copy(upload_request):
     assert len(items) == 2
 
 
+async def test_copy_multipart(util, upload_request, monkeypatch):
+    monkeypatch.setattr(util, "_multipart_copy_threshold", CHUNK_SIZE)
+    monkeypatch.setattr(util, "_multipart_copy_part_size", CHUNK_SIZE)
+    ob = create_content()
+    ob.file = None
+    mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+
+    file_data = random.randbytes(CHUNK_SIZE * 2 + 12345)
+
+    async def generator():
+        yield file_data
+
+    await mng.save_file(generator, content_type="application/data")
+
+    new_ob = create_content()
+    new_ob.file = None
+    gmng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+    new_gmng = S3FileStorageManager(
+        new_ob, upload_request, IContent["file"].bind(new_ob)
+    )
+    new_dm = DBDataManager(new_gmng)
+    await new_dm.load()
+    await gmng.copy(new_gmng, new_dm)
+
+    assert new_ob.file.uri != ob.file.uri
+    data = b""
+    async for chunk in new_gmng.iter_data():
+        data += chunk
+    assert data == file_data
+
+
+async def test_copy_blobs(util, upload_request):
+    bucket_name = await util.get_bucket_name()
+    async with util.s3_client() as client:
+        for idx in range(3):
+            await client.put_object(
+                Bucket=bucket_name, Key=f"test-container/{idx}", Body=b"x" * idx
+            )
+
+    success, failed = await util.copy_blobs(
+        [(f"test-container/{idx}", f"test-container/copy-{idx}") for idx in range(4)]
+    )
+    assert sorted(success) == [f"test-container/{idx}" for idx in range(3)]
+    assert failed == ["test-container/3"]
+    assert len(await get_all_objects()) == 6
+
+
+async def test_delete_blobs_in_batches(util, monkeypatch):
+    bucket_name = await util.get_bucket_name()
+    keys = [f"test-container/{idx}" for idx in range(2500)]
+    async with util.s3_client() as client:
+        for key in keys[:10]:
+            await client.put_object(Bucket=bucket_name, Key=key, Body=b"x")
+
+    batches = []
+    throttled = {keys[5]}
+    delete_objects = S3BlobStore._delete_objects
+
+    async def _delete_objects(self, bucket_name, batch):
+        batches.append(len(batch))
+        response = await delete_objects(
+            self, bucket_name, [key for key in batch if key not in throttled]
+        )
+        response["Errors"] = [
+            {"Key": key, "Code": "SlowDown"} for key in batch if key in throttled
+        ]
+        throttled.clear()
+        return response
+
+    monkeypatch.setattr(S3BlobStore, "_delete_objects", _delete_objects)
+    monkeypatch.setattr("guillotina_s3storage.storage.DELETE_RETRY_DELAY", 0)
+    success, failed = await util.delete_blobs(iter(keys))
+    assert sorted(batches) == [1, 500, 1000, 1000]
+    assert sorted(success) == sorted(keys)
+    assert failed == []
+    assert len(await get_all_objects()) == 0
+
+
 @pytest.mark.usefixtures("util")
 async def test_iterate_storage(util, upload_request, reader):
     upload_request.headers.update(
@@ -472,6 +602,59 @@ async def test_iterate_storage(util, upload_request, reader):
     assert len(result2["Contents"]) + len(result["Contents"]) == 19
 
 
+async def test_iterate_bucket_in_parallel(util):
+    bucket_name = await util.get_bucket_name()
+    keys = [f"test-container/{idx % 7}/{idx}" for idx in range(50)]
+    keys.append("test-container/blob")
+    async with util.s3_client() as client:
+        for key in keys:
+            await client.put_object(Bucket=bucket_name, Key=key, Body=b"x")
+
+    listed = [item["Key"] async for item in util.iterate_bucket(concurrency=3)]
+    assert listed == sorted(keys)
+    assert listed == [item["Key"] async for item in util.iterate_bucket()]
+
+
+async def test_vacuum(util, tmp_path):
+    bucket_name = await util.get_bucket_name()
+    keys = [f"test-container/{idx % 3}/{idx:02}" for idx in range(20)]
+    async with util.s3_client() as client:
+        for key in keys:
+            await client.put_object(Bucket=bucket_name, Key=key, Body=b"x")
+
+    referenced = keys[::2]
+    random.shuffle(referenced)
+    result = await util.vacuum(
+        referenced, str(tmp_path), run_size=3, batch_size=2, min_age=timedelta(0)
+    )
+    assert (result.listed, result.deleted, result.failed) == (20, 10, 0)
+    assert sorted(item["Key"] for item in await get_all_objects()) == sorted(referenced)
+    assert list(tmp_path.iterdir()) == []
+
+    # resumes after the key of an interrupted run's checkpoint
+    async with util.s3_client() as client:
+        for key in keys:
+            await client.put_object(Bucket=bucket_name, Key=key, Body=b"x")
+    ordered = sorted(keys)
+    (tmp_path / "checkpoint.json").write_text(
+        json.dumps(
+            {
+                "bucket": bucket_name,
+                "prefix": "test-container/",
+                "start_after": ordered[9],
+            }
+        )
+    )
+    checkpoint = (tmp_path / "checkpoint.json").read_text()
+    # dry runs list everything and keep the checkpoint
+    result = await util.vacuum([], str(tmp_path), min_age=timedelta(0), dry_run=True)
+    assert (result.listed, result.orphans, result.deleted) == (20, 20, 0)
+    assert (tmp_path / "checkpoint.json").read_text() == checkpoint
+    result = await util.vacuum([], str(tmp_path), min_age=timedelta(0))
+    assert result.deleted == 10
+    assert sorted(item["Key"] for item in await get_all_objects()) == ordered[:10]
+
+
 @pytest.mark.usefixtures("util")
 @pytest.mark.asyncio
 async def test_download(upload_request, reader, util):
@@ -651,6 +834,394 @@ async def test_save_file_multipart(upload_request):
     assert len(items) == 1
 
 
+async def test_save_file_multipart_concurrent(util, upload_request, monkeypatch):
+    monkeypatch.setattr(util, "_upload_concurrency", 3)
+    ob = create_content()
+    ob.file = None
+    mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+
+    async def generator():
+        for char in b"ABCD":
+            yield CHUNK_SIZE * bytes([char])
+
+    await mng.save_file(generator, content_type="application/data")
+    assert ob.file.size == CHUNK_SIZE * 4
+
+    s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+    data = b""
+    async for chunk in s3mng.iter_data():
+        data += chunk
+    assert data == b"".join(CHUNK_SIZE * bytes([char]) for char in b"ABCD")
+
+
+async def test_iter_data_resumes_broken_download(util, upload_request, monkeypatch):
+    calls = []
+    download = S3FileStorageManager._download
+
+    async def _download(self, uri, bucket=None, **kwargs):
+        calls.append(kwargs)
+        downloader = await download(self, uri, bucket, **kwargs)
+        if len(calls) < 3:
+            downloader["Body"] = BrokenBody(downloader["Body"], 1000)
+        return downloader
+
+    monkeypatch.setattr(S3FileStorageManager, "_download", _download)
+
+    ob = create_content()
+    ob.file = None
+    mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+    file_data = random.randbytes(12345)
+
+    async def generator():
+        yield file_data
+
+    await mng.save_file(generator, content_type="application/data")
+
+    s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+    data = b""
+    async for chunk in s3mng.iter_data(Range="bytes=100-9999"):
+        data += chunk
+    assert data == file_data[100:10000]
+    assert [call["Range"] for call in calls] == [
+        "bytes=100-9999",
+        "bytes=1100-9999",
+        "bytes=2100-9999",
+    ]
+    assert calls[1]["IfMatch"] == calls[2]["IfMatch"]
+
+    calls.clear()
+    monkeypatch.setattr(util, "_download_resume_attempts", 1)
+    with pytest.raises(aiohttp.ClientPayloadError):
+        async for chunk in s3mng.iter_data():
+            pass
+
+
+async def test_iter_data_concurrent_ranges(util, upload_request, monkeypatch):
+    monkeypatch.setattr(util, "_download_concurrency", 3)
+    monkeypatch.setattr(util, "_download_range_size", 1024 * 1024)
+    ob = create_content()
+    ob.file = None
+    mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+
+    file_data = random.randbytes(CHUNK_SIZE + 12345)
+
+    async def generator():
+        yield file_data
+
+    await mng.save_file(generator, content_type="application/data")
+
+    s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+    data = b""
+    async for chunk in s3mng.iter_data():
+        assert len(chunk) <= 1024 * 1024
+        data += chunk
+    assert data == file_data
+
+
+async def test_save_file_coalesces_small_chunks(util, upload_request, monkeypatch):
+    part_sizes = []
+    upload_part = S3FileStorageManager._upload_part
+
+    async def _upload_part(self, dm, data, **kwargs):
+        part_sizes.append(len(data))
+        return await upload_part(self, dm, data, **kwargs)
+
+    monkeypatch.setattr(S3FileStorageManager, "_upload_part", _upload_part)
+
+    ob = create_content()
+    ob.file = None
+    mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+
+    async def generator():
+        for _ in range(12):
+            yield 1024 * 1024 * b"x"
+
+    await mng.save_file(generator, content_type="application/data")
+    assert ob.file.size == 12 * 1024 * 1024
+    assert part_sizes == [MIN_UPLOAD_SIZE, MIN_UPLOAD_SIZE, 2 * 1024 * 1024]
+
+
+async def test_save_file_reuses_part_buffers(util, upload_request, monkeypatch):
+    parts = []
+    upload_part = S3FileStorageManager._upload_part
+
+    async def _upload_part(self, dm, data, **kwargs):
+        parts.append((id(data), type(data)))
+        return await upload_part(self, dm, data, **kwargs)
+
+    monkeypatch.setattr(S3FileStorageManager, "_upload_part", _upload_part)
+    monkeypatch.setattr(util, "_part_buffers", BufferPool(4 * MIN_UPLOAD_SIZE))
+
+    ob = create_content()
+    ob.file = None
+    mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+    file_data = random.randbytes(3 * MIN_UPLOAD_SIZE + 12345)
+
+    async def generator():
+        for offset in range(0, len(file_data), 1000000):
+            yield file_data[offset : offset + 1000000]
+
+    await mng.save_file(generator, content_type="application/data")
+    assert parts[0] == parts[1] == parts[2]
+    assert issubclass(parts[0][1], bytearray)
+    assert len(parts) == 4
+    assert util._part_buffers.idle == MIN_UPLOAD_SIZE
+
+    s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+    data = b""
+    async for chunk in s3mng.iter_data():
+        data += chunk
+    assert data == file_data
+
+
+def test_buffer_pool_keeps_only_its_buffers():
+    pool = BufferPool(4 * MIN_UPLOAD_SIZE)
+    # chunks of callers pass through as parts, they may still be in use
+    pool.release(bytearray(MIN_UPLOAD_SIZE))
+    assert pool.idle == 0
+    buffer = pool.acquire(MIN_UPLOAD_SIZE)
+    pool.release(buffer)
+    assert pool.idle == MIN_UPLOAD_SIZE
+    assert pool.acquire(MIN_UPLOAD_SIZE) is buffer
+
+
+def test_part_size_fits_part_limit():
+    assert _get_part_size(None, MIN_UPLOAD_SIZE) == MIN_UPLOAD_SIZE
+    assert _get_part_size(1024 * 1024, 1024) == MIN_UPLOAD_SIZE
+    terabyte = 1024**4
+    part_size = _get_part_size(terabyte, MIN_UPLOAD_SIZE)
+    assert part_size % (1024 * 1024) == 0
+    assert part_size * MAX_MULTIPART_PARTS >= terabyte
+
+
+async def test_save_file_single_put(util, upload_request, monkeypatch):
+    monkeypatch.setattr(util, "_single_put_threshold", CHUNK_SIZE)
+    multipart_uploads = []
+    create_multipart = S3FileStorageManager._create_multipart
+
+    async def _create_multipart(self, bucket_name, upload_id):
+        multipart_uploads.append(upload_id)
+        return await create_multipart(self, bucket_name, upload_id)
+
+    monkeypatch.setattr(S3FileStorageManager, "_create_multipart", _create_multipart)
+
+    for size in (0, 5000, CHUNK_SIZE * 2):
+        ob = create_content()
+        ob.file = None
+        mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+
+        async def generator():
+            if size:
+                yield size * b"x"
+
+        await mng.save_file(generator, content_type="application/data")
+        assert ob.file.size == size
+
+        s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+        data = b""
+        async for chunk in s3mng.iter_data():
+            data += chunk
+        assert data == size * b"x"
+
+    # only the upload above the threshold used a multipart upload
+    assert len(multipart_uploads) == 1
+    assert len(await get_all_objects()) == 3
+
+
+async def test_save_file_with_checksums(util, upload_request, monkeypatch):
+    monkeypatch.setattr(util, "_checksum_algorithm", "crc32")
+    monkeypatch.setattr(util, "_verify_checksums", True)
+    ob = create_content()
+    ob.file = None
+    mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+    file_data = random.randbytes(CHUNK_SIZE + 12345)
+
+    async def generator():
+        yield file_data
+
+    await mng.save_file(generator, content_type="application/data")
+    assert ob.file.checksum_algorithm == "crc32"
+    assert ob.file.part_sizes == [CHUNK_SIZE, 12345]
+    assert ob.file.checksum == checksums.combine(
+        "crc32",
+        [
+            checksums.checksum("crc32", file_data[:CHUNK_SIZE]),
+            checksums.checksum("crc32", file_data[CHUNK_SIZE:]),
+        ],
+    )
+
+    s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+    data = b""
+    async for chunk in s3mng.iter_data():
+        data += chunk
+    assert data == file_data
+
+    # the object changed behind our back
+    bucket = await util.get_bucket_name()
+    async with util.s3_client() as client:
+        await client.put_object(
+            Bucket=bucket, Key=ob.file.uri, Body=file_data[:-1] + b"x"
+        )
+    with pytest.raises(S3Exception):
+        async for chunk in s3mng.iter_data():
+            pass
+
+
+async def test_save_file_compressed(util, upload_request, monkeypatch):
+    monkeypatch.setattr(
+        util,
+        "_compression",
+        Compression({"text/*": "gzip"}, frame_size=1024 * 1024),
+    )
+    ob = create_content()
+    ob.file = None
+    mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+    file_data = b"".join(
+        random.choice([b"foo,", b"bar,", b"baz\n"]) for _ in range(CHUNK_SIZE // 2)
+    )
+
+    async def generator():
+        yield file_data
+
+    await mng.save_file(generator, content_type="text/csv")
+    assert ob.file.size == len(file_data)
+    assert ob.file.content_encoding == "gzip"
+    assert ob.file.encoded_size < len(file_data) / 2
+    assert len(ob.file.encoded_frames) == -(-len(file_data) // (1024 * 1024))
+
+    s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+    data = b""
+    async for chunk in s3mng.iter_data():
+        data += chunk
+    assert data == file_data
+
+    data = b""
+    async for chunk in s3mng.read_range(1000000, 3000000):
+        data += chunk
+    assert data == file_data[1000000:3000000]
+
+    # clients accepting gzip get the stored data
+    data = b""
+    async for chunk in s3mng.iter_data(accept_encoding="gzip, deflate"):
+        data += chunk
+    assert len(data) == ob.file.encoded_size
+    assert gzip.decompress(data) == file_data
+
+
+async def test_upload_in_several_small_appends(util, upload_request):
+    ob = create_content()
+    ob.file = None
+    s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+    dm = DBDataManager(s3mng)
+    await dm.load()
+    await dm.start()
+    await s3mng.start(dm)
+    # requests that do not end on a part boundary
+    file_data = random.randbytes(3 * CHUNK_SIZE + 7)
+    request_size = 2 * 1024 * 1024 + 3
+    for offset in range(0, len(file_data), request_size):
+        chunk = file_data[offset : offset + request_size]
+
+        async def generator():
+            yield chunk
+
+        assert await s3mng.append(dm, generator(), offset) == len(chunk)
+        assert all(part["Size"] >= CHUNK_SIZE for part in dm.get("_multipart")["Parts"])
+    await s3mng.finish(dm)
+    await dm.finish()
+
+    data = b""
+    async for chunk in s3mng.iter_data():
+        data += chunk
+    assert data == file_data
+
+
+async def test_upload_compressed_in_several_appends(util, upload_request, monkeypatch):
+    monkeypatch.setattr(util, "_compression", Compression({"text/*": "gzip"}))
+    ob = create_content()
+    ob.file = None
+    s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+    dm = DBDataManager(s3mng)
+    await dm.load()
+    await dm.start()
+    await dm.update(content_type="text/plain")
+    await s3mng.start(dm)
+    # every chunk compresses below the minimum part size
+    file_data = base64.b64encode(random.randbytes(3 * CHUNK_SIZE))
+    for offset in range(0, len(file_data), CHUNK_SIZE):
+        chunk = file_data[offset : offset + CHUNK_SIZE]
+
+        async def generator():
+            yield chunk
+
+        assert await s3mng.append(dm, generator(), offset) == len(chunk)
+    await s3mng.finish(dm)
+    await dm.finish()
+    assert ob.file.content_encoding == "gzip"
+
+    data = b""
+    async for chunk in s3mng.iter_data():
+        data += chunk
+    assert data == file_data
+
+
+async def test_save_file_deduplicated(util, upload_request, monkeypatch, tmp_path):
+    index = SQLiteIndex(str(tmp_path / "dedup.db"))
+    await index.initialize()
+    monkeypatch.setattr(util, "_dedup_index", index)
+    monkeypatch.setattr(util, "_upload_digests", TTLCache(60))
+    file_data = b"x" * (CHUNK_SIZE + 1)
+
+    async def generator():
+        yield file_data
+
+    obs = []
+    for _ in range(2):
+        ob = create_content()
+        ob.file = None
+        mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+        await mng.save_file(generator, content_type="text/plain")
+        obs.append(ob)
+    assert obs[0].file.uri == obs[1].file.uri
+    assert obs[0].file.content_digest == sha256(file_data).hexdigest()
+    assert len(await get_all_objects()) == 1
+
+    # copies reference the same object
+    gmng = S3FileStorageManager(obs[0], upload_request, IContent["file"].bind(obs[0]))
+    new_ob = create_content()
+    new_ob.file = None
+    new_gmng = S3FileStorageManager(
+        new_ob, upload_request, IContent["file"].bind(new_ob)
+    )
+    new_dm = DBDataManager(new_gmng)
+    await new_dm.load()
+    await gmng.copy(new_gmng, new_dm)
+    assert new_ob.file.uri == obs[0].file.uri
+    assert len(await get_all_objects()) == 1
+
+    # references are released once the transaction commits, so requests
+    # that are retried release them once
+    hooks = []
+    monkeypatch.setattr(
+        task_vars.txn.get(),
+        "add_after_commit_hook",
+        lambda hook, *args: hooks.append((hook, args)),
+        raising=False,
+    )
+    for ob in obs + [new_ob]:
+        assert len(await get_all_objects()) == 1
+        s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+        await s3mng.delete()
+        hooks.clear()
+        await s3mng.delete()
+        for hook, args in hooks:
+            await hook(True, *args)
+        hooks.clear()
+    # the object is deleted with its last reference
+    assert len(await get_all_objects()) == 0
+    await index.finalize()
+
+
 @pytest.mark.usefixtures("util")
 async def test_save_same_chunk_multiple_times(util, upload_request):
     upload_file_id = "foobar124"
@@ -833,6 +1404,113 @@ async def test_read_range(upload_request):
         assert chunk == _test_gif[100:200]
 
 
+async def test_iter_data_coalesced(util, upload_request, monkeypatch):
+    monkeypatch.setattr(util, "_coalesce_downloads", True)
+    monkeypatch.setattr(util, "_coalesce_buffer_chunks", 2)
+    monkeypatch.setattr("guillotina_s3storage.storage.CHUNK_SIZE", 100)
+
+    ob = create_content()
+    ob.file = None
+    mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+
+    async def generator():
+        yield _test_gif
+
+    await mng.save_file(generator, content_type="image/gif")
+
+    ranges = []
+    download = S3FileStorageManager._download
+
+    async def _download(self, uri, bucket=None, **kwargs):
+        ranges.append(kwargs.get("Range"))
+        return await download(self, uri, bucket, **kwargs)
+
+    monkeypatch.setattr(S3FileStorageManager, "_download", _download)
+
+    async def read(slow=False):
+        s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+        data = b""
+        async for chunk in s3mng.iter_data():
+            data += chunk
+            if slow:
+                await asyncio.sleep(0.1)
+        return data
+
+    results = await asyncio.gather(*(read() for _ in range(10)), read(slow=True))
+    assert results == [_test_gif] * 11
+    # the slow reader fell behind and read the rest on its own
+    assert len(ranges) == 2
+    assert ranges[0] is None
+    assert util._shared_downloads == {}
+
+
+async def test_iter_data_memory_cache(util, upload_request, monkeypatch):
+    memory_cache = MemoryCache(max_size=1024 * 1024, max_object_size=len(_test_gif))
+    monkeypatch.setattr(util, "_memory_cache", memory_cache)
+
+    ob = create_content()
+    ob.file = None
+    mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+
+    async def generator():
+        yield _test_gif
+
+    await mng.save_file(generator, content_type="image/gif")
+    s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+
+    for _ in range(3):
+        data = b""
+        async for chunk in s3mng.iter_data():
+            data += chunk
+        assert data == _test_gif
+    assert (memory_cache.hits, memory_cache.misses) == (2, 1)
+    assert memory_cache.objects.size == len(_test_gif)
+
+    await s3mng.delete_upload(ob.file.uri)
+    assert len(memory_cache.objects) == 0
+
+
+async def test_read_range_cache(util, upload_request, monkeypatch):
+    range_cache = RangeCache(max_size=1024, block_size=64)
+    monkeypatch.setattr(util, "_range_cache", range_cache)
+
+    ob = create_content()
+    ob.file = None
+    mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+
+    async def generator():
+        yield _test_gif
+
+    await mng.save_file(generator, content_type="image/gif")
+    s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+
+    ranges = []
+    download = S3FileStorageManager._download
+
+    async def _download(self, uri, bucket=None, **kwargs):
+        ranges.append(kwargs.get("Range"))
+        return await download(self, uri, bucket, **kwargs)
+
+    monkeypatch.setattr(S3FileStorageManager, "_download", _download)
+
+    async def read_range(start, end):
+        data = b""
+        async for chunk in s3mng.read_range(start, end):
+            data += chunk
+        await asyncio.gather(*range_cache.read_aheads)
+        return data
+
+    assert await read_range(10, 100) == _test_gif[10:100]
+    # blocks 0 and 1, and block 2 read ahead
+    assert sorted(ranges) == ["bytes=0-63", "bytes=128-191", "bytes=64-127"]
+    assert await read_range(60, 190) == _test_gif[60:190]
+    assert len(ranges) == 4
+    assert range_cache.blocks.size == 4 * 64
+
+    await s3mng.delete_upload(ob.file.uri)
+    assert range_cache.get_block(await util.get_bucket_name(), ob.file.uri, 0) is None
+
+
 async def test_custom_bucket_name(util):
     # No dots in the name, delimiter is -
     bucket_name = await util.get_bucket_name()
@@ -904,3 +1582,317 @@ async def test_bucket_name_override(dummy_request):
         bucket_name = await util.get_bucket_name()
 
         assert bucket_name == "my-override-bucket"
+
+
+@pytest.mark.usefixtures("util")
+async def test_bucket_override_accessibility_is_cached(dummy_request, monkeypatch):
+    util = get_utility(IS3BlobStore)
+    login()
+    container = create_content(Container, id="test-container")
+    task_vars.container.set(container)
+    container.bucket_override = "my-cached-override-bucket"
+
+    check = AsyncMock(return_value=True)
+    monkeypatch.setattr(util, "check_bucket_accessibility", check)
+    util.invalidate_bucket_accessibility()
+
+    with dummy_request:
+        assert await util.get_bucket_name() == "my-cached-override-bucket"
+        assert await util.get_bucket_name() == "my-cached-override-bucket"
+        assert check.await_count == 1
+
+        util.invalidate_bucket_accessibility("my-cached-override-bucket")
+        check.return_value = False
+        for _ in range(2):
+            with pytest.raises(HTTPPreconditionFailed):
+                await util.get_bucket_name()
+        assert check.await_count == 2
+
+    util.invalidate_bucket_accessibility()
+
+
+async def test_get_bucket_name_checks_bucket_once(util, monkeypatch):
+    bucket_name = await util.get_bucket_name()
+    util._cached_buckets.discard(bucket_name)
+
+    get_or_create = AsyncMock(wraps=util._get_or_create_bucket)
+    monkeypatch.setattr(util, "_get_or_create_bucket", get_or_create)
+
+    names = await asyncio.gather(*[util.get_bucket_name() for _ in range(10)])
+    assert set(names) == {bucket_name}
+    assert get_or_create.await_count == 1
+    assert bucket_name in util._cached_buckets
+
+
+def test_bucket_cache_is_bounded():
+    cached = LRUSet(2)
+    cached.add("a")
+    cached.add("b")
+    assert "a" in cached
+    cached.add("c")
+    assert len(cached) == 2
+    assert "a" in cached
+    assert "b" not in cached
+
+
+async def test_iter_data_disk_cache(util, upload_request, monkeypatch, tmp_path):
+    disk_cache = DiskCache(path=str(tmp_path))
+    await disk_cache.initialize()
+    monkeypatch.setattr(util, "_disk_cache", disk_cache)
+
+    ob = create_content()
+    ob.file = None
+    mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+
+    async def generator():
+        yield _test_gif
+
+    await mng.save_file(generator, content_type="image/gif")
+    s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+
+    data = b""
+    async for chunk in s3mng.iter_data():
+        data += chunk
+    assert data == _test_gif
+    assert disk_cache.size == len(_test_gif)
+
+    # remove the object behind the cache's back, reads are served locally
+    async with util.s3_client() as client:
+        await client.delete_object(Bucket=await util.get_bucket_name(), Key=ob.file.uri)
+
+    data = b""
+    async for chunk in s3mng.iter_data():
+        data += chunk
+    assert data == _test_gif
+
+    async for chunk in s3mng.read_range(100, 200):
+        assert chunk == _test_gif[100:200]
+
+    await s3mng.delete_upload(ob.file.uri)
+    assert disk_cache.size == 0
+
+
+async def test_s3_calls_are_instrumented(util):
+    def sample(name, **labels):
+        return prometheus_client.REGISTRY.get_sample_value(name, labels) or 0
+
+    calls = sample("guillotina_s3storage_ops_total", type="put_object", error="none")
+    sent = sample("guillotina_s3storage_bytes_total", direction="sent")
+    errors = sample("guillotina_s3storage_errors_total", type="head_object", code="404")
+
+    bucket_name = await util.get_bucket_name()
+    async with util.s3_client() as client:
+        await client.put_object(
+            Bucket=bucket_name, Key="test-container/metrics", Body=b"x" * 10
+        )
+        with pytest.raises(botocore.exceptions.ClientError):
+            await client.head_object(Bucket=bucket_name, Key="test-container/missing")
+
+    assert (
+        sample("guillotina_s3storage_ops_total", type="put_object", error="none")
+        == calls + 1
+    )
+    assert sample("guillotina_s3storage_bytes_total", direction="sent") == sent + 10
+    assert (
+        sample("guillotina_s3storage_errors_total", type="head_object", code="404")
+        == errors + 1
+    )
+
+
+async def test_metrics_without_prometheus(monkeypatch):
+    # a fresh copy of the module, as installed without prometheus_client
+    monkeypatch.setitem(sys.modules, "prometheus_client", None)
+    spec = importlib.util.find_spec("guillotina_s3storage.metrics")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    @module.timed("start")
+    async def start():
+        return "started"
+
+    assert await start() == "started"
+    with module.watch("put_object"):
+        pass
+
+
+async def test_broadcast_stops_reading_without_subscribers():
+    read = []
+
+    async def items():
+        for item in range(100):
+            read.append(item)
+            yield item
+
+    broadcast = Broadcast(items(), 2)
+    subscription = broadcast.subscribe()
+    await broadcast._task
+    assert subscription.dropped
+    assert read == [0, 1, 2]
+    assert not broadcast.joinable
+
+
+async def test_priority_limiter_keeps_reserved_slots():
+    limiter = PriorityLimiter(3, reserved={INTERACTIVE: 1}, limits={MAINTENANCE: 1})
+
+    await limiter.acquire(MAINTENANCE)
+    await limiter.acquire(BACKGROUND)
+    # the last slot is reserved for interactive requests
+    background = asyncio.ensure_future(limiter.acquire(BACKGROUND))
+    maintenance = asyncio.ensure_future(limiter.acquire(MAINTENANCE))
+    await asyncio.sleep(0)
+    assert not background.done()
+    assert not maintenance.done()
+
+    await limiter.acquire(INTERACTIVE)
+    limiter.release(INTERACTIVE)
+
+    # maintenance is at its limit, so the freed slot goes to background
+    limiter.release(MAINTENANCE)
+    await asyncio.wait_for(background, 1)
+    assert not maintenance.done()
+    maintenance.cancel()
+
+
+async def test_s3_client_priority(util):
+    async with util.s3_client(MAINTENANCE) as client:
+        assert util._s3_request_limiter.in_use(MAINTENANCE) == 1
+        assert await client.head_bucket(Bucket=await util.get_bucket_name())
+    assert util._s3_request_limiter.in_use(MAINTENANCE) == 0
+
+
+async def test_multiple_clients(util):
+    store = S3BlobStore(
+        {
+            **app_settings["load_utilities"]["s3"]["settings"],
+            "clients": 3,
+            "read_timeout": 30,
+            "connector_args": {"use_dns_cache": True, "ttl_dns_cache": 60},
+        }
+    )
+    await store.initialize()
+    try:
+        assert len(store._s3aioclients) == 3
+        config = store._s3aioclients[0]._client_config
+        assert config.max_pool_connections == DEFAULT_MAX_POOL_CONNECTIONS // 3
+        assert config.read_timeout == 30
+        assert config.connector_args["ttl_dns_cache"] == 60
+
+        bucket_name = await util.get_bucket_name()
+        async with store.s3_client() as first, store.s3_client() as second:
+            assert first._client is not second._client
+            assert await first.head_bucket(Bucket=bucket_name)
+            assert await second.head_bucket(Bucket=bucket_name)
+        assert not any(store._client_requests.values())
+    finally:
+        await store.finalize()
+
+
+async def test_bucket_region_routing(util):
+    bucket_name = f"other-region-{random.randint(0, 999999)}"
+    regional_client = (await util._create_regional_clients("us-west-2"))[0]
+    await regional_client.create_bucket(
+        Bucket=bucket_name,
+        CreateBucketConfiguration={"LocationConstraint": "us-west-2"},
+    )
+    try:
+        async with util.s3_client(bucket_name=bucket_name) as client:
+            assert client.meta.region_name == "us-west-2"
+            await client.put_object(Bucket=bucket_name, Key="foo", Body=b"bar")
+        assert util._bucket_regions.get(bucket_name) == "us-west-2"
+
+        async with util.s3_client(bucket_name=await util.get_bucket_name()) as client:
+            assert client.meta.region_name == util._get_region_name()
+    finally:
+        await regional_client.delete_object(Bucket=bucket_name, Key="foo")
+        await regional_client.delete_bucket(Bucket=bucket_name)
+
+
+async def test_bucket_region_denied_is_cached(util, monkeypatch):
+    calls = []
+
+    async def head_bucket(Bucket):
+        calls.append(Bucket)
+        raise botocore.exceptions.ClientError(
+            {
+                "Error": {"Code": "403", "Message": "Forbidden"},
+                "ResponseMetadata": {"HTTPStatusCode": 403, "HTTPHeaders": {}},
+            },
+            "HeadBucket",
+        )
+
+    for client in util._s3aioclients:
+        monkeypatch.setattr(client, "head_bucket", head_bucket)
+    for _ in range(3):
+        async with util.s3_client(bucket_name="denied-bucket") as client:
+            assert client.meta.region_name == util._get_region_name()
+    assert calls == ["denied-bucket"]
+
+
+async def test_benchmark(util):
+    args = benchmark.get_parser().parse_args(
+        [
+            "--file-sizes=1",
+            "--part-sizes=5",
+            "--concurrency=1,2",
+            "--list-objects=20",
+            "--repeat=1",
+            "--latency=0",
+        ]
+    )
+    token = task_vars.container.set(task_vars.container.get())
+    try:
+        results = await benchmark.run(args)
+    finally:
+        task_vars.container.reset(token)
+        provide_utility(util, IS3BlobStore)
+
+    benchmarks = [result["benchmark"] for result in results["results"]]
+    assert benchmarks.count("upload") == 2
+    assert benchmarks.count("download") == 2
+    assert benchmarks.count("get_bucket_name") == 2
+    assert benchmarks.count("listing") == 2
+    assert benchmark.compare(results, results, 0.2) == []
+
+
+async def test_local_blob_store(util, upload_request, tmp_path):
+    store = LocalBlobStore({"bucket": "testbucket", "path": str(tmp_path)})
+    await store.initialize()
+    provide_utility(store, IS3BlobStore)
+    try:
+        ob = create_content()
+        ob.file = None
+        mng = FileManager(ob, upload_request, IContent["file"].bind(ob))
+
+        async def generator():
+            for _ in range(3):
+                yield b"x" * MIN_UPLOAD_SIZE
+            yield _test_gif
+
+        await mng.save_file(generator, content_type="image/gif")
+        s3mng = S3FileStorageManager(ob, upload_request, IContent["file"].bind(ob))
+        data = b""
+        async for chunk in s3mng.iter_data():
+            data += chunk
+        assert data == b"x" * MIN_UPLOAD_SIZE * 3 + _test_gif
+        assert ob.file.size == len(data)
+
+        data = b""
+        offset = MIN_UPLOAD_SIZE * 3
+        async for chunk in s3mng.read_range(offset - 100, offset + 100):
+            data += chunk
+        assert data == b"x" * 100 + _test_gif[:100]
+
+        bucket_name = await store.get_bucket_name()
+        with open(store.object_path(bucket_name, ob.file.uri), "rb") as fi:
+            assert fi.read(3) == b"xxx"
+
+        await store.copy_blob(ob.file.uri, "test-container/copy")
+        assert [item["Key"] async for item in store.iterate_bucket()] == sorted(
+            [ob.file.uri, "test-container/copy"]
+        )
+        success, failed = await store.delete_blobs([ob.file.uri, "test-container/copy"])
+        assert len(success) == 2
+        assert [item async for item in store.iterate_bucket()] == []
+    finally:
+        await store.finalize()
+        provide_utility(util, IS3BlobStore)
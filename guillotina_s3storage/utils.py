@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import collections
+from contextvars import ContextVar
+from typing import Any
+from typing import AsyncIterator
+from typing import Awaitable
+from typing import Callable
+from typing import Deque
+from typing import Dict
+from typing import Hashable
+from typing import List
+from typing import Optional
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time. Callers asking for a key that
+    is already in flight wait for that call and share its result.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._calls
+
+    async def do(
+        self, key: Hashable, func: Callable[..., Awaitable[Any]], *args, **kwargs
+    ) -> Any:
+        future = self._calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func(*args, **kwargs))
+            self._calls[key] = future
+            future.add_done_callback(lambda done: self._forget(key, done))
+        # a cancelled caller must not cancel the call other callers wait on
+        return await asyncio.shield(future)
+
+    def _forget(self, key: Hashable, future: asyncio.Future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+
+
+class Subscription:
+    """
+    Items published to one subscriber of a `Broadcast`. A subscriber that
+    falls `buffer_size` items behind is `dropped` and stops receiving them.
+    """
+
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.dropped = False
+
+    async def get(self) -> Any:
+        """
+        Next item, `Broadcast.DONE` at the end, or None once dropped and
+        every received item was consumed
+        """
+        if self.dropped and self.queue.empty():
+            return None
+        item = await self.queue.get()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+
+class Broadcast:
+    """
+    Fans the items of `iterable` out to every subscriber, reading it once.
+
+    Subscribers can only join before the first item is published. Slow
+    subscribers never hold the others back; they are dropped instead.
+    """
+
+    DONE = object()
+
+    def __init__(self, iterable: AsyncIterator[Any], buffer_size: int):
+        self._iterable = iterable
+        self._buffer_size = max(1, buffer_size)
+        self._subscriptions: List[Subscription] = []
+        self._task: Optional[asyncio.Future] = None
+        self._closed = False
+        self.started = False
+
+    @property
+    def joinable(self) -> bool:
+        return not (self.started or self._closed)
+
+    def subscribe(self) -> Subscription:
+        subscription = Subscription()
+        self._subscriptions.append(subscription)
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        if subscription in self._subscriptions:
+            self._subscriptions.remove(subscription)
+        if not self._subscriptions and self._task is not None:
+            # nobody is listening anymore
+            self._closed = True
+            self._task.cancel()
+
+    async def _run(self):
+        try:
+            async for item in self._iterable:
+                self.started = True
+                for subscription in list(self._subscriptions):
+                    if subscription.queue.qsize() >= self._buffer_size:
+                        subscription.dropped = True
+                        self._subscriptions.remove(subscription)
+                    else:
+                        subscription.queue.put_nowait(item)
+                if not self._subscriptions:
+                    # every subscriber was dropped, nobody is listening
+                    break
+                # let subscribers catch up before reading on
+                await asyncio.sleep(0)
+        except Exception as ex:
+            for subscription in self._subscriptions:
+                subscription.queue.put_nowait(ex)
+        else:
+            for subscription in self._subscriptions:
+                subscription.queue.put_nowait(self.DONE)
+        finally:
+            self._closed = True
+            aclose = getattr(self._iterable, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+MAINTENANCE = "maintenance"
+# highest priority first
+PRIORITIES = (INTERACTIVE, BACKGROUND, MAINTENANCE)
+
+# priority of the S3 requests made by the current task
+request_priority: ContextVar[str] = ContextVar(
+    "s3_request_priority", default=INTERACTIVE
+)
+
+
+class PriorityLimiter:
+    """
+    Limits the number of concurrent holders, like a semaphore, sharing the
+    slots between priority classes.
+
+    `reserved` slots of a class can only be taken by that class or higher
+    priority ones, and a class never holds more than its `limits` slots.
+    Freed slots go to waiters of the highest priority first.
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        reserved: Optional[Dict[str, int]] = None,
+        limits: Optional[Dict[str, int]] = None,
+    ):
+        reserved = reserved or {}
+        limits = limits or {}
+        self._capacity = capacity
+        self._reserved = {name: reserved.get(name, 0) for name in PRIORITIES}
+        self._limits = {name: limits.get(name, capacity) for name in PRIORITIES}
+        self._in_use = {name: 0 for name in PRIORITIES}
+        self._waiters: Dict[str, Deque[asyncio.Future]] = {
+            name: collections.deque() for name in PRIORITIES
+        }
+
+    def in_use(self, priority: str) -> int:
+        return self._in_use[priority]
+
+    def _can_acquire(self, priority: str) -> bool:
+        if self._in_use[priority] >= self._limits[priority]:
+            return False
+        free = self._capacity - sum(self._in_use.values())
+        held_back = 0
+        for name in PRIORITIES:
+            if name == priority:
+                break
+            held_back += max(0, self._reserved[name] - self._in_use[name])
+        return free > held_back
+
+    async def acquire(self, priority: str = INTERACTIVE):
+        if priority not in self._in_use:
+            raise ValueError(f"Unknown priority {priority}")
+        if not self._waiters[priority] and self._can_acquire(priority):
+            self._in_use[priority] += 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[priority].append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was handed over as we got cancelled
+                self.release(priority)
+            elif waiter in self._waiters[priority]:
+                self._waiters[priority].remove(waiter)
+            raise
+
+    def release(self, priority: str = INTERACTIVE):
+        self._in_use[priority] -= 1
+        self._wake_up()
+
+    def _wake_up(self):
+        for priority in PRIORITIES:
+            waiters = self._waiters[priority]
+            while waiters and self._can_acquire(priority):
+                waiter = waiters.popleft()
+                if waiter.done():
+                    continue
+                self._in_use[priority] += 1
+                waiter.set_result(None)
+
+
+class _PooledBuffer(bytearray):
+    """
+    Buffer created by a `BufferPool`, telling it apart from the buffers of
+    callers that must never be reused
+    """
+
+
+class BufferPool:
+    """
+    Reusable `bytearray` buffers, keeping up to `max_size` bytes of idle
+    buffers around instead of allocating new ones for every use.
+    """
+
+    def __init__(self, max_size: int):
+        self._max_size = max_size
+        self._idle = 0
+        self._free: Dict[int, List[bytearray]] = {}
+
+    @property
+    def idle(self) -> int:
+        return self._idle
+
+    def acquire(self, size: int) -> bytearray:
+        free = self._free.setdefault(size, [])
+        if free:
+            self._idle -= size
+            return free.pop()
+        return _PooledBuffer(size)
+
+    def release(self, buffer: Any):
+        """
+        Give back a buffer from `acquire`. Anything else, like a buffer that
+        was resized since or one a caller may still be using, is left to the
+        garbage collector.
+        """
+        size = len(buffer)
+        if (
+            type(buffer) is not _PooledBuffer
+            or size not in self._free
+            or self._idle + size > self._max_size
+        ):
+            return
+        self._free[size].append(buffer)
+        self._idle += size
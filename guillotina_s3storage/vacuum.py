@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import contextlib
+import heapq
+import json
+import logging
+import os
+import uuid
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from typing import Any
+from typing import AsyncIterable
+from typing import AsyncIterator
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Union
+
+from guillotina import task_vars
+
+log = logging.getLogger("guillotina_s3storage")
+
+# referenced keys sorted in memory before spilling a run to disk
+DEFAULT_RUN_SIZE = 100000
+# orphans collected before deleting them and saving a checkpoint
+DEFAULT_DELETE_BATCH_SIZE = 10000
+# objects modified more recently may belong to uploads not referenced yet
+DEFAULT_MIN_AGE = timedelta(hours=1)
+
+CHECKPOINT_NAME = "checkpoint.json"
+
+
+class VacuumResult:
+    def __init__(self):
+        self.listed = 0
+        self.orphans = 0
+        self.deleted = 0
+        self.failed = 0
+
+    def __repr__(self):
+        return (
+            f"<VacuumResult listed={self.listed} orphans={self.orphans} "
+            f"deleted={self.deleted} failed={self.failed}>"
+        )
+
+
+async def _aiter(iterable: Union[Iterable[str], AsyncIterable[str]]):
+    if hasattr(iterable, "__aiter__"):
+        async for item in iterable:  # type: ignore
+            yield item
+    else:
+        for item in iterable:  # type: ignore
+            yield item
+
+
+def _read_run(path: str) -> Iterator[str]:
+    with open(path) as run:
+        for line in run:
+            yield json.loads(line)
+
+
+class BlobVacuum:
+    """
+    Deletes the objects of the current container that are not referenced.
+
+    The bucket listing, which S3 returns in key order, is merged with the
+    sorted referenced keys, so memory does not grow with the number of
+    objects. Referenced keys that do not come sorted are sorted on disk, in
+    runs of `run_size` keys under `path`.
+
+    Orphans are deleted in batches of `batch_size`, after which the last
+    listed key is saved to a checkpoint in `path`. A vacuum of the same
+    container started with the same `path` resumes listing from there.
+    With `dry_run`, orphans are only counted, and checkpoints are left
+    untouched.
+    """
+
+    def __init__(
+        self,
+        store,
+        path: str,
+        run_size: int = DEFAULT_RUN_SIZE,
+        batch_size: int = DEFAULT_DELETE_BATCH_SIZE,
+        min_age: timedelta = DEFAULT_MIN_AGE,
+        concurrency: Optional[int] = None,
+        dry_run: bool = False,
+    ):
+        self._store = store
+        self._path = path
+        self._run_size = run_size
+        self._batch_size = batch_size
+        self._min_age = min_age
+        self._concurrency = concurrency
+        self._dry_run = dry_run
+
+    async def run(
+        self,
+        referenced: Union[Iterable[str], AsyncIterable[str]],
+        presorted: bool = False,
+    ) -> VacuumResult:
+        """
+        Vacuum the container, keeping the `referenced` keys. With
+        `presorted`, they must already come in ascending order.
+        """
+        await self._run_in_executor(os.makedirs, self._path, exist_ok=True)
+        container = task_vars.container.get()
+        if container is None:
+            raise RuntimeError("Vacuuming blobs needs a current container")
+        bucket_name = await self._store.get_bucket_name()
+        prefix = f"{container.id}/"
+        # dry runs neither resume nor end an interrupted run
+        checkpoint = (
+            {} if self._dry_run else await self._load_checkpoint(bucket_name, prefix)
+        )
+        start_after = checkpoint.get("start_after")
+        if start_after:
+            log.info(f"Resuming vacuum of {bucket_name}/{prefix} after {start_after}")
+
+        result = VacuumResult()
+        cutoff = datetime.now(timezone.utc) - self._min_age
+        orphans: List[str] = []
+        if presorted:
+            references = _aiter(referenced)
+        else:
+            references = self._sort(referenced)
+        try:
+            reference = await self._next(references)
+            async for item in self._store.iterate_bucket(
+                self._concurrency, start_after=start_after
+            ):
+                key = item["Key"]
+                result.listed += 1
+                while reference is not None and reference < key:
+                    reference = await self._next(references)
+                if reference == key:
+                    continue
+                modified = item.get("LastModified")
+                if modified is not None and modified > cutoff:
+                    continue
+                orphans.append(key)
+                if len(orphans) >= self._batch_size:
+                    await self._delete(bucket_name, orphans, result)
+                    orphans = []
+                    if not self._dry_run:
+                        await self._save_checkpoint(bucket_name, prefix, key)
+            await self._delete(bucket_name, orphans, result)
+        finally:
+            await references.aclose()
+
+        if not self._dry_run:
+            await self._run_in_executor(self._remove, self._checkpoint_path)
+        log.info(f"Vacuumed {bucket_name}/{prefix}: {result}")
+        return result
+
+    async def _next(self, references: AsyncIterator[str]) -> Optional[str]:
+        try:
+            return await references.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    async def _delete(self, bucket_name: str, keys: List[str], result: VacuumResult):
+        index = getattr(self._store, "_dedup_index", None)
+        if keys and index is not None:
+            # objects of deduplicated files are deleted with their last
+            # reference, by the storage manager
+            shared = await index.referenced(bucket_name, keys)
+            keys = [key for key in keys if key not in shared]
+        result.orphans += len(keys)
+        if not keys or self._dry_run:
+            return
+        success, failed = await self._store.delete_blobs(keys, bucket_name)
+        result.deleted += len(success)
+        result.failed += len(failed)
+        for key in failed:
+            log.warning(f"Could not delete orphaned blob {key}")
+
+    async def _sort(
+        self, referenced: Union[Iterable[str], AsyncIterable[str]]
+    ) -> AsyncIterator[str]:
+        """
+        Yield the unique referenced keys in ascending order
+        """
+        runs: List[str] = []
+        keys: List[str] = []
+        try:
+            async for key in _aiter(referenced):
+                keys.append(key)
+                if len(keys) >= self._run_size:
+                    runs.append(await self._run_in_executor(self._spill, keys))
+                    keys = []
+            if runs:
+                runs.append(await self._run_in_executor(self._spill, keys))
+                merged: Iterator[str] = heapq.merge(*(_read_run(run) for run in runs))
+            else:
+                merged = iter(sorted(keys))
+            previous = None
+            for key in merged:
+                if key != previous:
+                    yield key
+                    previous = key
+        finally:
+            for run in runs:
+                await self._run_in_executor(self._remove, run)
+
+    def _spill(self, keys: List[str]) -> str:
+        keys.sort()
+        run_path = os.path.join(self._path, f"run-{uuid.uuid4().hex}")
+        with open(run_path, "w") as run:
+            for key in keys:
+                run.write(json.dumps(key) + "\n")
+        return run_path
+
+    @property
+    def _checkpoint_path(self) -> str:
+        return os.path.join(self._path, CHECKPOINT_NAME)
+
+    async def _load_checkpoint(self, bucket_name: str, prefix: str):
+        try:
+            checkpoint = await self._run_in_executor(self._read, self._checkpoint_path)
+        except (FileNotFoundError, ValueError):
+            return {}
+        if (
+            checkpoint.get("bucket") != bucket_name
+            or checkpoint.get("prefix") != prefix
+        ):
+            return {}
+        return checkpoint
+
+    async def _save_checkpoint(self, bucket_name: str, prefix: str, start_after: str):
+        await self._run_in_executor(
+            self._write,
+            self._checkpoint_path,
+            {"bucket": bucket_name, "prefix": prefix, "start_after": start_after},
+        )
+
+    def _read(self, path: str):
+        with open(path) as fi:
+            return json.load(fi)
+
+    def _write(self, path: str, data: Any):
+        tmp_path = f"{path}.{uuid.uuid4().hex}"
+        with open(tmp_path, "w") as fi:
+            json.dump(data, fi)
+        os.replace(tmp_path, path)
+
+    def _remove(self, path: str):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+
+    async def _run_in_executor(self, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, lambda: func(*args, **kwargs))
@@ -40,6 +40,8 @@ setup(
             "pytest-docker-fixtures",
             "async_asgi_testclient",
             "prometheus_client",
-        ]
+        ],
+        "crc32c": ["crc32c"],
+        "zstd": ["zstandard"],
     },
 )